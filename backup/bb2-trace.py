@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+## bb2-trace.py
+# Analyze and replay command traces recorded by bb2.py's 'trace' option
+# (or BACKUP_BTRFS2_TRACE), to profile real runs offline.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+USAGE = """Analyze or replay a bb2.py command trace. 'timeline' writes
+Chrome trace-event JSON (for chrome://tracing or Perfetto), 'top' lists
+the slowest commands, and 'replay' runs a command (like 'backup-btrfs
+backup') with a fake 'btrfs' on its PATH that answers each btrfs
+command as recorded, taking as long as it did, to reproduce a run's
+scheduling without touching any filesystem. A trace file may hold
+several runs; the last is used unless --run says otherwise."""
+
+# Stands in for 'btrfs' during replays. Each command is answered by
+# the next unused trace record with the same arguments: it waits as
+# long as the recorded command took (divided by REPLAY_SPEED), prints
+# its recorded output ('send' prints as many bytes as were sent, with
+# '--no-data' dry runs printing a stream of the recorded size), and
+# exits with its recorded status. Unrecorded commands succeed at once
+# and are logged to REPLAY_DIR/unmatched.
+FAKE_BTRFS = r'''#!/usr/bin/env python3
+import fcntl, json, os, struct, sys, time
+dir = os.environ['REPLAY_DIR']
+args = sys.argv[1:]
+key = json.dumps(args)
+with open(os.path.join(dir, 'answers.json')) as f:
+    answers = json.load(f).get(key, [])
+with open(os.path.join(dir, 'used'), 'a+') as used:
+    fcntl.flock(used, fcntl.LOCK_EX)
+    used.seek(0)
+    n = used.read().splitlines().count(key)
+    used.write(key + '\n')
+if n >= len(answers):
+    with open(os.path.join(dir, 'unmatched'), 'a') as log:
+        log.write(' '.join(['btrfs'] + args) + '\n')
+    if args[:1] == ['receive']:
+        sys.stdin.buffer.read()
+    sys.exit(0)
+answer = answers[n]
+time.sleep(answer['seconds'] / float(os.environ['REPLAY_SPEED']))
+out = sys.stdout.buffer
+if args[:1] == ['send'] and '--no-data' in args:
+    size = max(0, answer.get('bytes', 0) - 39)
+    body = struct.pack('<HH', 4, 8) + size.to_bytes(8, 'little')
+    out.write(b'btrfs-stream\0' + struct.pack('<I', 1) +
+              struct.pack('<IHI', len(body), 22, 0) + body)
+elif args[:1] == ['send']:
+    left = answer.get('bytes', 0)
+    while left:
+        out.write(bytes(min(left, 1 << 20)))
+        left -= min(left, 1 << 20)
+elif args[:1] == ['receive']:
+    sys.stdin.buffer.read()
+else:
+    out.write(answer.get('output', '').encode())
+sys.exit(answer['status'])
+'''
+
+# Runs its arguments as the current user.
+FAKE_SUDO = '#!/bin/sh\nexec "$@"\n'
+
+
+# Get the records of run number 'run' (as a list index) in trace file
+# 'path'. Each run starts with a 'run' record.
+def load_run(path, run):
+    runs = [[]]
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'run' and runs[-1]:
+                runs.append([])
+            runs[-1].append(record)
+    try:
+        return runs[run]
+    except IndexError:
+        sys.exit("There are only %d run(s) in '%s'." % (len(runs), path))
+
+
+# Get the btrfs arguments of a recorded command, after any wrappers
+# like sudo, ionice, or systemd-run, or None if it doesn't run btrfs.
+def btrfs_args(command):
+    for i, word in enumerate(command):
+        if os.path.basename(word) == 'btrfs':
+            return command[i + 1:]
+    return None
+
+
+# Get the answers for the fake btrfs: for each command's arguments (as
+# JSON), a list of what each recorded run of it did, in order.
+def answers(records):
+    found = {}
+    for r in records:
+        if r['kind'] not in ('cmd', 'pipe'):
+            continue
+        status = r.get('status', [])
+        ran = r['commands'][:len(status)] if r['kind'] == 'cmd' \
+            else r['commands']
+        for i, command in enumerate(ran):
+            args = btrfs_args(command)
+            if args is None:
+                continue
+            answer = {'status': status[i] if i < len(status) else 0,
+                      'seconds': r['seconds'] / max(1, len(ran))}
+            if r['kind'] == 'pipe':
+                answer['seconds'] = r['seconds']
+                answer['bytes'] = r.get('bytes', 0)
+            elif 'output' in r:
+                answer['output'] = r['output'][i]
+            found.setdefault(json.dumps(args), []).append(answer)
+    return found
+
+
+def timeline(records, out):
+    start = min(r['start'] for r in records)
+    pid = next((r['pid'] for r in records if 'pid' in r), 1)
+    threads = {}
+    events = []
+    for r in records:
+        if r['kind'] == 'run':
+            continue
+        tid = threads.setdefault(r['thread'], len(threads) + 1)
+        args = {k: r[k] for k in ('commands', 'status', 'out', 'err', 'bytes',
+                                  'ok') if k in r}
+        events.append({'name': r['goal'], 'cat': r['kind'], 'ph': 'X',
+                       'ts': (r['start'] - start) * 1e6,
+                       'dur': r['seconds'] * 1e6, 'pid': pid, 'tid': tid,
+                       'args': args})
+    events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': name}} for name, tid in threads.items()]
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+
+
+def top(records, count):
+    ran = sorted((r for r in records if r['kind'] in ('cmd', 'eval', 'pipe')),
+                 key=lambda r: r['seconds'], reverse=True)
+    for r in ran[:count]:
+        status = r.get('status', '?')
+        print('%10.3fs  %-4s  %-8s  %s' %
+              (r['seconds'], r['kind'],
+               ','.join(map(str, status)) if isinstance(status, list)
+               else status, r['goal']))
+    total = sum(r['seconds'] for r in records if r['kind'] == 'stage')
+    print('%d command(s) in %d stage(s) taking %.3fs in all.' %
+          (len(ran), sum(r['kind'] == 'stage' for r in records), total))
+
+
+def replay(records, speed, command):
+    tmp = tempfile.mkdtemp(prefix='bb2-replay.')
+    try:
+        bin = os.path.join(tmp, 'bin')
+        os.mkdir(bin)
+        for name, text in (('btrfs', FAKE_BTRFS), ('sudo', FAKE_SUDO)):
+            with open(os.path.join(bin, name), 'w') as f:
+                f.write(text)
+            os.chmod(os.path.join(bin, name), 0o755)
+        with open(os.path.join(tmp, 'answers.json'), 'w') as f:
+            json.dump(answers(records), f)
+        env = dict(os.environ, REPLAY_DIR=tmp, REPLAY_SPEED=str(speed),
+                   PATH=bin + os.pathsep + os.environ['PATH'])
+        status = subprocess.call(command, env=env)
+        unmatched = os.path.join(tmp, 'unmatched')
+        if os.path.exists(unmatched):
+            with open(unmatched) as f:
+                lines = f.read().splitlines()
+            print('%d btrfs command(s) weren\'t in the trace, like: %s' %
+                  (len(lines), lines[0]))
+        return status
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=USAGE)
+    parser.add_argument('--run', type=int, default=-1,
+                        help='which run in the trace (0 is the first)')
+    sub = parser.add_subparsers(dest='action', required=True)
+    p = sub.add_parser('timeline', help='write Chrome trace-event JSON')
+    p.add_argument('trace')
+    p.add_argument('-o', '--output', help='file to write (default stdout)')
+    p = sub.add_parser('top', help='list the slowest commands')
+    p.add_argument('trace')
+    p.add_argument('-n', '--count', type=int, default=10)
+    p = sub.add_parser('replay', help='run a command against a fake btrfs')
+    p.add_argument('trace')
+    p.add_argument('--speed', type=float, default=1.0,
+                   help='how many times faster than recorded to go')
+    p.add_argument('command', nargs='+', help='command to run, after --')
+    args = parser.parse_args()
+
+    records = load_run(args.trace, args.run)
+    if args.action == 'timeline':
+        if args.output:
+            with open(args.output, 'w') as out:
+                timeline(records, out)
+        else:
+            timeline(records, sys.stdout)
+    elif args.action == 'top':
+        top(records, args.count)
+    else:
+        sys.exit(replay(records, args.speed, args.command))
+
+
+if __name__ == '__main__':
+    main()
@@ -51,28 +51,82 @@ code:
 - generic utility functions
 -- exit traps
 -- messages
+-- privileged helper
+-- command tracing
 -- command-running
+-- transfer throttling
+-- send/receive pipelines
 -- path existence checking
 -- list formatting
+-- atomic file saving
 -- presence in list checking
+-- stage timing
+-- parallel running
+-- run summary
+-- run report
 - btrfs utility functions
+-- snapshot index
 -- last backup name retrieval
+-- common parent resolution
+-- send size estimation
+-- parent and clone source selection
+-- snapshot name parsing
+-- snapshot size retrieval
 -- subvolume path-to-name sanitization
+-- targeted filesystem syncing
+-- subvolume generation tracking
 - btrfs actions
 -- snapshot creation
 -- snapshot clone/update
+-- received copy recording
+-- resumable spooled transfer
+-- compressed stream archiving
+-- compressed stream restoring
+-- snapshot restoring
+-- stream verification
+-- deduplicated stream storing
+-- deduplicated stream restoring
+-- batched snapshot deletion
 -- old snapshot deletion
+-- sent parent pinning
+-- snapshot retention rules
+- free space management
+-- deferred snapshot deletion
+-- free space reading
+-- room making before sends
 - high-level snapshot actions
 -- subvolume-looping function
 -- snapshot creation
 -- snapshot clone/update
+-- snapshot archiving
+-- snapshot deduplicating
+-- snapshot restoring
 -- old snapshot deletion
+-- snapshot retention
+- plan scheduling
+-- planned actions
+-- cross-run locking
+-- plan execution
+-- plan display
+- config applying
+-- compiled config applying
+- daemon mode
+-- per-run state reset
+-- mount watching
+-- daemon loop
+-- daemon runs
 - initial checks and setup
 -- initialization
 - main stuff
 -- configuration getting
+-- configuration compiling
 -- configuration checking
 -- configuration running
+-- configuration planning
+-- copy verification
+-- backup restoring
+-- daemon running
+-- daemon status
 -- systemd service installation
 -- systemd service reinstallation
 -- systemd service uninstallation
@@ -138,14 +192,49 @@ Backup paths (assuming the backup drive wasn't available when the
 
 """
 
-from sh import Command, sudo
-from os import listdir
-from os.path import basename, join, lexists
+from sh import Command
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from os import listdir, stat
+from os.path import basename, dirname, join, lexists
+from subprocess import DEVNULL, PIPE, Popen
 from sys import argv, exit
+import atexit
+import bisect
 import datetime
-
-print("WARNING: Not ready for testing.")
-exit(1)
+import errno
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None  # Only needed to compile the config.
+
+# Importing (as the tests in ../test do) is fine; running isn't yet.
+if __name__ == '__main__':
+    print("WARNING: Not ready for testing.")
+    exit(1)
 
 # === global variable declarations ===
 
@@ -167,7 +256,7 @@ VERBOSITY = 0  # default
 EXIT_TRAPS = []
 
 # Set by init()
-LOCKDIR = None
+SUDO = ['sudo']  # prefix for root commands, emptied if already root
 TIMESTAMP = None  # invocation time, used as "latest snapshot time"
 
 # Set near check-config()
@@ -181,6 +270,86 @@ AUTOGEN_MSG = None
 # Set near usage()
 USAGE = None
 
+# Set by set_jobs() in the config: how many snapshots or transfers may
+# use a device at once, by path on that device
+DEVICE_JOBS = {}
+DEFAULT_JOBS = 2  # used for devices without a set_jobs() entry
+
+# Filled by stage(): a dict per timed stage of the run
+STAGES = []
+STAGES_LOCK = threading.Lock()
+
+# Compression for archive_latest(): command to compress stdin to
+# stdout, command to decompress likewise, and file extension. Both use
+# every CPU core, so compression keeps up with disk writes.
+COMPRESSORS = {
+    'zstd': (['zstd', '-q', '-T0', '-c'], ['zstd', '-q', '-d', '-c'],
+             '.zst'),
+    'lzma': (['xz', '-q', '-T0', '-c'], ['xz', '-q', '-d', '-c'], '.xz'),
+}
+
+# Size of each checkpointed chunk file when copy_latest() spools send
+# streams through a staging directory
+CHUNK_SIZE = 64 << 20
+
+# Content-defined chunking for dedup_latest(): chunks are DEDUP_MIN to
+# DEDUP_MAX bytes, and end where the bytes before, each mapped to 4
+# bits by DEDUP_GEAR, spell DEDUP_MARK (1 in 64 Ki places, so chunks
+# average about 80 KiB). Changing any of these makes new chunks unlike
+# stored ones, so they're fixed.
+DEDUP_MIN = 16 << 10
+DEDUP_MAX = 1 << 20
+DEDUP_GEAR = bytes(b & 15 for b in
+                   hashlib.shake_256(b'backup-btrfs2 gear').digest(256))
+DEDUP_MARK = b'\x05\x0a\x03\x0c'
+# How much of a stream the chunker reads at once
+DEDUP_READ = 4 << 20
+# Size a pack file of chunks grows to before another is started
+DEDUP_PACK = 256 << 20
+# How many new chunks are indexed per transaction
+DEDUP_BATCH = 1024
+# How many pack files restoring keeps open at once
+DEDUP_OPEN_PACKS = 64
+
+# Set by match_uuids() in the config: whether snapshots with other
+# names count as common if btrfs says they're received copies
+MATCH_UUIDS = False
+
+# Set by estimate_sends() in the config: whether to dry-run sends to
+# pick the parent and clone sources making the smallest stream
+ESTIMATE_SENDS = True
+
+# Where state kept between runs is saved, like the parents each
+# destination was last sent from (see sent_parents())
+STATE_DIR = '/var/lib/backup-btrfs2'
+# Version of the compiled config format; older compiled configs are
+# recompiled
+COMPILED_VERSION = 2
+
+# Filled by snapshot(): a dict per subvolume that wasn't snapshotted
+# because it hadn't changed since its latest snapshot
+SKIPPED = []
+
+# Set by scheduled() while the config runs: the config's actions,
+# recorded in order to be ran by run_plan() (None to run them directly)
+PLAN = None
+# Guessed seconds per planned action, for plan() when the last run
+# report doesn't say how long it took
+DEFAULT_COSTS = {'snapshot': 1, 'sync': 5, 'copy': 300, 'archive': 600,
+                 'dedup': 600, 'prune': 10}
+
+
+# Whether archives hash their streams as they pass thru, set by
+# hash_streams()
+HASH_STREAMS = False
+# Hash used for archived streams and copies' file trees. SHA-256 has
+# CPU instructions of its own on most x86 and ARM CPUs, making it
+# about twice as fast as BLAKE2b there.
+STREAM_HASH = 'sha256'
+# How many buffers a hashed stream cycles through, so hashing one can
+# overlap reading and writing the next (see reads())
+HASH_DEPTH = 4
+
 
 # === generic utility functions ===
 
@@ -188,13 +357,19 @@ USAGE = None
 EXIT_TRAPS = []
 
 
-# # TODO: Usage: trap run-exit-traps EXIT
-# Run everything in EXIT_TRAPS.
+# # Usage: atexit.register(run_exit_traps)
+# Run everything in EXIT_TRAPS, in reverse order of adding, like
+# unwinding. A failing trap doesn't stop the rest.
 def run_exit_traps():
-    for f in EXIT_TRAPS:
-        # TODO: msg "Running exit trap: $i"
-        f()
-# TODO: sh->py: `trap run-exit-traps EXIT`
+    for f in reversed(EXIT_TRAPS):
+        dbg("Running exit trap: %s" % f.__name__)
+        try:
+            f()
+        except Exception as e:
+            msg("Exit trap %s failed: %s" % (f.__name__, e))
+
+
+atexit.register(run_exit_traps)
 
 
 # # Usage: add_exit_trap(function1[, function2[, ...]])
@@ -226,6 +401,164 @@ def msg(text):
     VERBOSITY <= -1 or print(text)
 
 
+# Code for the privileged helper that start_helper() runs with sudo.
+# Each line of input is a JSON [request ID, commands] pair; it runs
+# the commands in order (stopping at the first failure) in a thread of
+# its own, so parallel requests stay parallel. Each reply is a line of
+# JSON [request ID, [[status, stdout, stderr], ...]].
+HELPER_CODE = r"""
+import json, subprocess, sys, threading
+lock = threading.Lock()
+def run(id, commands):
+    results = []
+    for command in commands:
+        try:
+            p = subprocess.run(command, stdin=subprocess.DEVNULL,
+                               capture_output=True)
+            results.append([p.returncode, p.stdout.decode(errors='replace'),
+                            p.stderr.decode(errors='replace')])
+        except OSError as e:
+            results.append([127, '', str(e)])
+        if results[-1][0]:
+            break
+    with lock:
+        sys.stdout.write(json.dumps([id, results]) + '\n')
+        sys.stdout.flush()
+for line in sys.stdin:
+    threading.Thread(target=run, args=json.loads(line)).start()
+"""
+
+# Set by start_helper(): the helper process, and replies it owes, by
+# request ID, as [threading.Event, results]
+HELPER = None
+HELPER_REPLIES = {}
+HELPER_LOCK = threading.Lock()
+HELPER_IDS = itertools.count()
+
+
+# # Usage: start_helper()
+# Start one root helper process (authenticating with sudo only this
+# once) to run root commands for the rest of the run, instead of
+# paying for a new sudo per command. It quits when this script does.
+def start_helper():
+    global HELPER
+    HELPER = Popen(SUDO + [sys.executable, '-c', HELPER_CODE],
+                   stdin=PIPE, stdout=PIPE, text=True)
+    threading.Thread(target=read_helper, args=(HELPER,), daemon=True).start()
+
+
+# # Usage: stop_helper()
+# Let the helper process quit once it's done with its requests.
+def stop_helper():
+    global HELPER
+    if HELPER is not None:
+        HELPER.stdin.close()
+        HELPER.wait()
+        HELPER = None
+
+
+# # Usage: read_helper(helper)
+# Hand each of the helper's replies to the thread waiting on it. If
+# the helper dies, every waiting thread is woken with no results.
+def read_helper(helper):
+    for line in helper.stdout:
+        id, results = json.loads(line)
+        with HELPER_LOCK:
+            HELPER_REPLIES[id][1] = results
+            HELPER_REPLIES[id][0].set()
+    with HELPER_LOCK:
+        for reply in HELPER_REPLIES.values():
+            reply[0].set()
+
+
+# Where init() records a trace of every command ran, or None not to
+# (see traced()). Set with the 'trace' option or BACKUP_BTRFS2_TRACE.
+TRACE_PATH = None
+# Where the 'trace' option records to
+TRACE_DEFAULT = '/var/log/backup-btrfs2/trace.jsonl'
+# The open trace file, if tracing
+TRACE = None
+TRACE_LOCK = threading.Lock()
+
+
+# # Usage: start_trace(path)
+# Start recording a trace to 'path', appending to any earlier runs'.
+def start_trace(path):
+    global TRACE
+    try:
+        os.makedirs(dirname(os.path.abspath(path)), exist_ok=True)
+        TRACE = open(path, 'a', buffering=1)
+    except OSError as e:
+        fatal("Could not open trace file '%s': %s" % (path, e))
+    add_exit_trap(TRACE.close)
+
+
+# # Usage: with traced(kind, goal, commands) as record: ...
+# Record the 'commands' ran in the 'with' block for 'goal' in the trace
+# (if tracing), as a JSON line with their start time, duration, and
+# thread. Code in the block should set record['status'] to the exit
+# status (a list of them for several commands), record['out'] and
+# record['err'] to bytes of output, and, for pipelines,
+# record['bytes'] to bytes moved. 'kind' is 'cmd', 'eval', 'pipe',
+# 'stage', or 'run' (the start of a run). Records without commands
+# needn't run anything.
+@contextmanager
+def traced(kind, goal, commands=()):
+    if TRACE is None:
+        yield {}
+        return
+    record = {'kind': kind, 'goal': goal, 'commands': commands,
+              'thread': threading.current_thread().name,
+              'start': time.time()}
+    start = time.monotonic()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.monotonic() - start, 6)
+        write_trace(record)
+
+
+# # Usage: write_trace(record)
+# Add a record (a dict, as per traced()) to the trace as a JSON line.
+def write_trace(record):
+    line = json.dumps(record, separators=(',', ':'))
+    with TRACE_LOCK:
+        TRACE.write(line + '\n')
+
+
+# # Usage: results = execute(commands, root=True)
+# Run each command (a list of program and arguments) in order,
+# stopping at the first failure, and return a list of [status,
+# stdout, stderr] per command ran. Root commands go to the helper as
+# one request when it's running; everything else is ran directly.
+def execute(commands, root=True):
+    if not root or HELPER is None:
+        results = []
+        for command in commands:
+            try:
+                p = subprocess.run((SUDO if root else []) + command,
+                                   stdin=DEVNULL, capture_output=True,
+                                   text=True, errors='replace')
+                results.append([p.returncode, p.stdout, p.stderr])
+            except OSError as e:
+                results.append([127, '', str(e)])
+            if results[-1][0]:
+                break
+        return results
+    done = threading.Event()
+    with HELPER_LOCK:
+        id = next(HELPER_IDS)
+        HELPER_REPLIES[id] = [done, None]
+        HELPER.stdin.write(json.dumps([id, commands]) + '\n')
+        HELPER.stdin.flush()
+    done.wait()
+    with HELPER_LOCK:
+        results = HELPER_REPLIES.pop(id)[1]
+    if results is None:
+        fatal("The root helper process quit unexpectedly.")
+    return results
+
+
 # # Usage: cmd(goal, command [args ...])
 # Normal function: Displays goal and runs given external command (with
 # given args as applicable). Exits script on error.
@@ -234,31 +567,62 @@ def msg(text):
 # attempted.
 ##
 # Note: Every simple system-changing command in this script should be
-# ran via cmd or similar. Use 'cmd-eval' if you need shell features
-# like unix pipes.
+# ran via cmd or similar. Use 'send_receive' to pipe 'btrfs send'
+# into 'btrfs receive', or 'cmd-eval' for other shell features.
 ##
 # TODO: This should be merged with cmd-eval, but that seems to require
 # a sophisticated string-escaping function to convert this one's
 # variadicness into an eval'able string.
 ##
+# Commands without side effects (side_effects=False) are ran even in
+# debug mode, since later steps need their output to decide what to
+# do. Returns the command's output, or 'dbg_result' when not ran.
+##
 # VERBOSITY: 0 (goals), 1 (commands), 2 (outputs)
+##
+# With fail_ok=True, failure returns None instead of exiting.
 def cmd(goal, cmd, *args,
-        root=True, side_effects=True,
+        root=True, side_effects=True, fail_ok=False,
         dbg_result=None, dbg_func=None):
     # TODO: 1.x: Better debug mode:
-    # - run command as-is if side_effects is False
     # - run dbg_func if side_effects is True
     # - blindly return return dbg_result if dbg_func is None
+    return cmd_batch(goal, [[cmd, *args]], root=root,
+                     side_effects=side_effects, fail_ok=fail_ok,
+                     dbg_result=dbg_result)
+
+
+# # Usage: cmd_batch(goal, [[command, args ...], ...])
+# Like cmd(), but runs several commands for one goal, in order, as a
+# single request to the root helper. Stops at the first failure.
+# Returns the commands' combined output.
+##
+# VERBOSITY: 0 (goals), 1 (commands), 2 (outputs)
+def cmd_batch(goal, commands, root=True, side_effects=True, fail_ok=False,
+              dbg_result=None):
     VERBOSITY >= 0 and msg("Doing task: %s." % goal)
     # TODO: '\e[33m' formatting
-    VERBOSITY >= 1 and msg("sudo %s %s" % (cmd, ' '.join(args)))
-    if not DEBUG:
-        if VERBOSITY >= 2:
-            print(sudo(cmd, *args))
-        else:
-            sudo(cmd, *args)
-        # TODO: sh->py: try/catch
-        # fatal("Could not %s." % goal)
+    for command in commands:
+        VERBOSITY >= 1 and msg(('sudo ' if root else '') + ' '.join(command))
+    if DEBUG and side_effects:
+        return dbg_result
+    with traced('cmd', goal, commands) as rec:
+        results = execute(commands, root)
+        rec['root'] = root
+        rec['status'] = [r[0] for r in results]
+        rec['out'] = sum(len(r[1].encode()) for r in results)
+        rec['err'] = sum(len(r[2].encode()) for r in results)
+        if not side_effects:  # Replays need what later steps read.
+            rec['output'] = [r[1] for r in results]
+    out = ''.join(r[1] for r in results)
+    VERBOSITY >= 2 and out and print(out)
+    if results[-1][0] or len(results) < len(commands):
+        if fail_ok:
+            dbg("cmd_batch: failed to %s" % goal)
+            return None
+        fatal("Could not %s.%s" % (goal, results[-1][2].rstrip() and
+                                   "\n" + results[-1][2].rstrip()))
+    return out
 
 
 # # Usage: cmd_eval(goal, "string to evaluate", side_effects=True)
@@ -281,11 +645,530 @@ def cmd_eval(goal, str2eval, side_effects=True, globals=None, locals=None):
     # TODO: '\e[33m' fmt
     VERBOSITY >= 1 and msg(str2eval)
     if not DEBUG:
+        with traced('eval', goal, [str2eval]) as rec:
+            ok = eval(str2eval, globals, locals)
+            rec['status'] = 0 if ok else 1
         if VERBOSITY >= 2:
-            eval(str2eval, globals, locals) or fatal("Could not %s." % goal)
+            ok or fatal("Could not %s." % goal)
         else:
             # TODO: suppress output
-            eval(str2eval, globals, locals) or fatal("Could not %s." % goal)
+            ok or fatal("Could not %s." % goal)
+
+
+# Size for the pipes between 'btrfs send' and 'btrfs receive'. Linux
+# defaults to 64 KiB, which makes both sides wait on each other.
+PIPE_SIZE = 1 << 20
+
+# Set by throttle() in the config: limits for transfers to each drive,
+# as dicts of throttle()'s arguments
+THROTTLES = []
+# ionice classes throttle() accepts, by name
+IONICE_CLASSES = {'best-effort': 2, 'idle': 3}
+# How much data pump() moves at once when rate-limited, and how many
+# seconds' worth of it may be sent in a burst
+THROTTLE_CHUNK = 256 << 10
+THROTTLE_BURST = 0.5
+# Adaptive throttling: seconds between disk latency checks, and the
+# starting rate (when there's no maximum), additive increase, and
+# minimum rate, in bytes per second
+ADAPT_INTERVAL = 1.0
+ADAPT_START = 64 << 20
+ADAPT_STEP = 4 << 20
+ADAPT_MIN = 1 << 20
+
+# Limits for one transfer, as merged by throttling(): bytes per second
+# (None for unlimited), (ionice class, level) or None, cgroup
+# IOWeight or None, disk latency in ms to back off at or None, and
+# the block devices (by name in /sys/class/block) to watch for that
+Throttle = namedtuple('Throttle', 'rate ionice weight latency disks')
+
+
+# # Usage: throttle(dest, rate=None, window=None, ionice=None,
+# #                 weight=None, latency=None)
+# Limit transfers to the drive holding 'dest' during 'window' (a
+# (start, end) pair of local 'HH:MM' times, which may wrap past
+# midnight; None for always). 'rate' is a byte rate like 20000000 or
+# '20M'. 'ionice' is 'idle' or 'best-effort[:LEVEL]', and 'weight' a
+# cgroup IOWeight (1 to 10000, 100 being normal) for the transfer's
+# processes. With 'latency', the rate backs off whenever the drive's
+# average IO latency exceeds that many milliseconds. This is meant to
+# be called from the config.
+def throttle(dest, rate=None, window=None, ionice=None, weight=None,
+             latency=None):
+    if ionice is not None and ionice.split(':')[0] not in IONICE_CLASSES:
+        fatal("Unknown ionice class '%s'." % ionice)
+    THROTTLES.append({'dest': dest, 'rate': parse_size(rate),
+                      'window': window, 'ionice': ionice, 'weight': weight,
+                      'latency': latency})
+
+
+# # Usage: parse_size(size)
+# Get a size in bytes from a number or a string like '20M' or '1.5GiB'
+# (with binary units), passing None thru.
+def parse_size(size):
+    if size is None or isinstance(size, (int, float)):
+        return size
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)(?:i?B)?\s*', size, re.I)
+    if not match:
+        fatal("Could not understand the size '%s'." % size)
+    return int(float(match[1]) * 1024 ** ' KMGT'.index(match[2].upper()
+                                                        or ' '))
+
+
+# # Usage: in_window(window, now)
+# Check if the local time of day 'now' is in 'window', as per throttle().
+def in_window(window, now):
+    if window is None:
+        return True
+    start, end = (datetime.time.fromisoformat(t) for t in window)
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end  # It wraps past midnight.
+
+
+# # Usage: throttle = throttling(*paths)
+# Get the limits for a transfer to all of 'paths' right now: the
+# strictest of every throttle() for their drives whose window is open,
+# or None if there are none.
+def throttling(*paths):
+    now = datetime.datetime.now().time()
+    devs = {device(p) for p in paths}
+    found = [t for t in THROTTLES if lexists(t['dest']) and
+             device(t['dest']) in devs and in_window(t['window'], now)]
+    if not found:
+        return None
+    ionice = [(IONICE_CLASSES[c], int(level or 7)) for t in found
+              if t['ionice'] for c, _, level in [t['ionice'].partition(':')]]
+    latency = min((t['latency'] for t in found if t['latency']), default=None)
+    return Throttle(min((t['rate'] for t in found if t['rate']), default=None),
+                    max(ionice, default=None),
+                    min((t['weight'] for t in found if t['weight']),
+                        default=None),
+                    latency,
+                    sorted({d for p in paths for d in block_devices(p)})
+                    if latency else [])
+
+
+# # Usage: names = block_devices(path)
+# Get the names (as in /sys/class/block) of the block devices holding
+# the filesystem 'path' is on, using /proc/self/mountinfo. For a
+# multi-device btrfs, that's every device in it.
+def block_devices(path):
+    path = os.path.realpath(path)
+    mount, source = '', None
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m[1], 8)),
+                           fields[4])
+            if ((path == point or path.startswith(point.rstrip('/') + '/'))
+                    and len(point) >= len(mount)):
+                mount, source = point, fields[fields.index('-') + 2]
+    if source is None or not source.startswith('/dev/'):
+        return []
+    name = basename(os.path.realpath(source))
+    try:
+        for fs in listdir('/sys/fs/btrfs'):
+            members = join('/sys/fs/btrfs', fs, 'devices')
+            if lexists(join(members, name)):
+                return listdir(members)
+    except FileNotFoundError:  # btrfs isn't loaded.
+        pass
+    return [name]
+
+
+# # Usage: ios, ms = disk_load(disks)
+# Get how many IOs the named block devices have completed, and how
+# many milliseconds they spent on them, from /sys/class/block/*/stat.
+def disk_load(disks):
+    ios = ms = 0
+    for disk in disks:
+        try:
+            with open(join('/sys/class/block', disk, 'stat')) as f:
+                stats = [int(n) for n in f.read().split()]
+        except (OSError, ValueError):
+            continue
+        ios += stats[0] + stats[4]  # reads and writes completed
+        ms += stats[3] + stats[7]  # time spent reading and writing
+    return ios, ms
+
+
+# # Usage: spend = limiter(throttle)
+# Make a token bucket for a Throttle's rate, or None if it has none.
+# spend(n) sleeps as long as needed for moving 'n' more bytes to keep
+# to the rate. With adaptive throttling, the rate is halved whenever
+# the disks' average latency since the last check is over the limit,
+# and otherwise grows by ADAPT_STEP up to the Throttle's rate.
+def limiter(throttle):
+    if throttle is None or not (throttle.rate or throttle.latency):
+        return None
+    ceiling = throttle.rate or float('inf')
+    rate = throttle.rate or ADAPT_START
+    tokens = 0.0
+    last = checked = time.monotonic()
+    load = disk_load(throttle.disks)
+
+    def spend(n):
+        nonlocal rate, tokens, last, checked, load
+        now = time.monotonic()
+        tokens = min(rate * THROTTLE_BURST, tokens + (now - last) * rate) - n
+        last = now
+        if throttle.latency and now - checked >= ADAPT_INTERVAL:
+            new = disk_load(throttle.disks)
+            ios, ms = new[0] - load[0], new[1] - load[1]
+            if ios and ms / ios > throttle.latency:
+                rate = max(ADAPT_MIN, rate / 2)
+            else:
+                rate = min(ceiling, rate + ADAPT_STEP)
+            checked, load = now, new
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+    return spend
+
+
+# # Usage: command = io_limited(command, throttle)
+# Prefix a (maybe sudo'd) command to run with a Throttle's ionice
+# class and cgroup IOWeight, if any.
+def io_limited(command, throttle):
+    if throttle is None:
+        return command
+    prefix = []
+    if throttle.weight:
+        prefix += ['systemd-run', '--scope', '--quiet',
+                   '-p', 'IOWeight=%d' % throttle.weight]
+    if throttle.ionice:
+        cls, level = throttle.ionice
+        prefix += ['ionice', '-c', str(cls)]
+        prefix += ['-n', str(level)] if cls == 2 else []
+    n = len(SUDO) if SUDO and command[:len(SUDO)] == SUDO else 0
+    return command[:n] + prefix + command[n:]
+
+
+# # Usage: read_fd, write_fd = big_pipe()
+# Make an OS pipe, enlarged to PIPE_SIZE where the kernel allows it.
+def big_pipe():
+    r, w = os.pipe()
+    try:
+        fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except (AttributeError, OSError):  # not Linux, or over pipe-max-size
+        pass
+    return r, w
+
+
+# # Usage: for chunk in reads(src, size, digest=None): ...
+# Read file descriptor 'src' until EOF, yielding each read as a
+# memoryview of up to 'size' bytes, which is only valid until the
+# next. If 'digest' (a hashlib object) is given, every chunk is also
+# hashed into it, in order, by a thread of its own: hashlib lets go of
+# the GIL while hashing, so it runs alongside the caller writing the
+# chunk out and reading the next instead of adding to their time.
+# Chunks go through HASH_DEPTH reused buffers, each reused only once
+# it's hashed. The digest is complete once the loop is done.
+def reads(src, size, digest=None):
+    if digest is None:
+        buf = memoryview(bytearray(size))
+        while True:
+            n = os.readv(src, [buf])
+            if not n:
+                return
+            yield buf[:n]
+    free, hashing = queue.Queue(), queue.Queue()
+    for _ in range(HASH_DEPTH):
+        free.put(memoryview(bytearray(size)))
+
+    def hasher():
+        for buf, n in iter(hashing.get, None):
+            digest.update(buf[:n])
+            free.put(buf)
+    thread = threading.Thread(target=hasher, daemon=True)
+    thread.start()
+    try:
+        while True:
+            buf = free.get()
+            n = os.readv(src, [buf])
+            if not n:
+                return
+            hashing.put((buf, n))
+            yield buf[:n]
+    finally:
+        hashing.put(None)
+        thread.join()
+
+
+# # Usage: got, put = pump(src, dst, spend=None, digest=None)
+# Move everything from file descriptor 'src' to 'dst' until EOF or
+# until 'dst' is closed by its reader. Returns how many bytes were
+# read from 'src' and written to 'dst'. Data is moved with splice()
+# where the kernel supports it, so it never enters this process;
+# otherwise it's copied through a single reused buffer. If 'spend' is
+# given (see limiter()), it's called with each amount moved. If
+# 'digest' (a hashlib object) is given, everything read is hashed
+# into it as it passes thru (see reads()), so splice() isn't used.
+def pump(src, dst, spend=None, digest=None):
+    got = put = 0
+    size = PIPE_SIZE if spend is None else THROTTLE_CHUNK
+    try:
+        if hasattr(os, 'splice') and digest is None:
+            try:
+                while True:
+                    n = os.splice(src, dst, size)
+                    if not n:
+                        return got, put
+                    got += n
+                    put += n
+                    spend is None or spend(n)
+            except OSError as e:
+                if e.errno != errno.EINVAL or got:
+                    raise
+        for buf in reads(src, size, digest):
+            n = len(buf)
+            got += n
+            while put < got:
+                put += os.write(dst, buf[n - (got - put):])
+            spend is None or spend(n)
+        return got, put
+    except BrokenPipeError:  # Reader quit; its exit status says why.
+        return got, put
+
+
+# # Usage: got, puts = tee(src, dsts, spend=None)
+# Copy everything from file descriptor 'src' to each file descriptor
+# in 'dsts' until EOF. Data goes thru a single reused buffer, since
+# splice() can't duplicate it. A destination whose reader quits is
+# dropped while the rest carry on. Returns how many bytes were read,
+# and a list of how many were written to each destination. 'spend' is
+# as for pump().
+def tee(src, dsts, spend=None):
+    buf = memoryview(bytearray(PIPE_SIZE if spend is None
+                               else THROTTLE_CHUNK))
+    got, puts = 0, [0] * len(dsts)
+    live = [*range(len(dsts))]
+    while live:
+        n = os.readv(src, [buf])
+        if not n:
+            break
+        got += n
+        for i in [*live]:
+            try:
+                while puts[i] < got:
+                    puts[i] += os.write(dsts[i], buf[n - (got - puts[i]):n])
+            except BrokenPipeError:  # Reader quit; its exit status says why.
+                live.remove(i)
+        spend is None or spend(n)
+    return got, puts
+
+
+# # Usage: send_command(snapshot, parent=None, clones=())
+# Get the command to send 'snapshot', incrementally from 'parent' if
+# it's not None, and sharing data with the 'clones' snapshots.
+def send_command(snap, parent=None, clones=()):
+    send = SUDO + ['btrfs', 'send', '--quiet']
+    if parent is not None:
+        send += ['-p', parent]
+    for clone in clones:
+        send += ['-c', clone]
+    return send + [snap]
+
+
+# # Usage: program(command)
+# Get the name of the program a command runs, skipping any 'sudo'.
+def program(command):
+    return basename(command[1] if command[0] == 'sudo' else command[0])
+
+
+# Result of run_pipe(): exit statuses and byte counts of both ends, and
+# the hex STREAM_HASH digest of the stream if it was hashed
+Transfer = namedtuple('Transfer',
+                      'send_status receive_status sent received digest',
+                      defaults=(None,))
+
+
+# # Usage: hash_streams(enabled=True)
+# Hash each archived send stream as it passes from 'btrfs send' to
+# its compressor, recording the digest in the archive's manifest for
+# verify_archive(). Without it, archives are verified by their
+# compressor's own checksums. Hashing costs moving streams thru a
+# buffer instead of splice(), and a core's worth of hashing, so it's
+# off by default. This is meant to be called from the config.
+def hash_streams(enabled=True):
+    global HASH_STREAMS
+    HASH_STREAMS = enabled
+
+
+# # Usage: result = run_pipe(goal, source, sink, source_in=None, sink_out=None,
+# #                          throttle=None, hashed=False)
+# Normal function: Displays goal and runs the 'source' command into
+# the 'sink' command. The two processes are joined by enlarged OS
+# pipes instead of a shell (see pump()). 'source_in' and 'sink_out'
+# are optional open files for the source's input and sink's output.
+# Both commands are limited by 'throttle' (see throttling()), if given.
+# With 'hashed', the stream is hashed on the way (see pump()). Exits
+# script on error, otherwise returns a Transfer.
+##
+# In debug mode: Displays goal and shows the pipeline that would have
+# been ran, returning an all-zero Transfer.
+##
+# VERBOSITY: 0 (goals), 1 (commands), 2 (outputs)
+def run_pipe(goal, source, sink, source_in=None, sink_out=None,
+             throttle=None, hashed=False):
+    source, sink = io_limited(source, throttle), io_limited(sink, throttle)
+    VERBOSITY >= 0 and msg("Doing task: %s." % goal)
+    VERBOSITY >= 1 and msg("%s%s | %s%s" % (
+        ' '.join(source), source_in and ' < ' + source_in.name or '',
+        ' '.join(sink), sink_out and ' > ' + sink_out.name or ''))
+    if DEBUG:
+        return Transfer(0, 0, 0, 0)
+    if sink_out is None:
+        sink_out = None if VERBOSITY >= 2 else DEVNULL
+    with stage('send', source_in.name if source_in else source[-1]) as rec, \
+            traced('pipe', goal, [source, sink]) as tr:
+        send_r, send_w = big_pipe()
+        recv_r, recv_w = big_pipe()
+        try:
+            sender = Popen(source, stdin=source_in, stdout=send_w)
+            os.close(send_w)
+            send_w = None
+            receiver = Popen(sink, stdin=recv_r, stdout=sink_out)
+            os.close(recv_r)
+            recv_r = None
+            digest = hashlib.new(STREAM_HASH) if hashed else None
+            sent, received = pump(send_r, recv_w, limiter(throttle), digest)
+        finally:
+            for fd in (send_r, send_w, recv_r, recv_w):
+                fd is None or os.close(fd)
+        result = Transfer(sender.wait(), receiver.wait(), sent, received,
+                          digest and digest.hexdigest())
+        rec['bytes'] = tr['bytes'] = received
+        tr['status'] = [result.send_status, result.receive_status]
+        dbg("run_pipe: %s" % (result,))
+        if result.send_status or result.receive_status:
+            fatal("Could not %s (%s exited %d, %s exited %d)." %
+                  (goal, program(source), result.send_status,
+                   program(sink), result.receive_status))
+    return result
+
+
+# # Usage: result = send_receive(goal, snapshot, into, parent=None, clones=(),
+# #                              throttle=None)
+# Runs 'btrfs send' for 'snapshot' (incrementally from 'parent' if
+# given, with 'clones' as clone sources) into 'btrfs receive' at
+# 'into', as per run_pipe().
+def send_receive(goal, snap, into, parent=None, clones=(), throttle=None):
+    return run_pipe(goal, send_command(snap, parent, clones),
+                    SUDO + ['btrfs', 'receive', into], throttle=throttle)
+
+
+# # Usage: result = run_chain(goal, sources, sink, throttle=None)
+# Like run_pipe(), but runs each of 'sources' (a list of command and
+# input file pairs, the file being None for none) in turn into a
+# single run of 'sink', as if their outputs were concatenated. This
+# suits 'btrfs receive', which takes any number of streams one after
+# another, so consecutive restore steps are pipelined: each source is
+# started as soon as the one before it starts being read, so it's
+# ready to go the moment that one ends, and the sink needn't be
+# restarted or wait for anything in between. The Transfer's
+# send_status is that of the first source that failed, if any.
+def run_chain(goal, sources, sink, throttle=None):
+    sources = [(io_limited(c, throttle), f) for c, f in sources]
+    sink = io_limited(sink, throttle)
+    VERBOSITY >= 0 and msg("Doing task: %s." % goal)
+    for command, source_in in sources:
+        VERBOSITY >= 1 and msg("%s%s | %s" % (
+            ' '.join(command), source_in and ' < ' + source_in.name or '',
+            ' '.join(sink)))
+    if DEBUG:
+        return Transfer(0, 0, 0, 0)
+    with stage('send', sink[-1]) as rec, \
+            traced('pipe', goal, [c for c, _ in sources] + [sink]) as tr:
+        recv_r, recv_w = big_pipe()
+        senders, reads = [], []  # started sources, and their output pipes
+        sent = received = 0
+        status = 0
+        try:
+            receiver = Popen(sink, stdin=recv_r,
+                             stdout=None if VERBOSITY >= 2 else DEVNULL)
+            os.close(recv_r)
+            recv_r = None
+            spend = limiter(throttle)
+
+            def start(command, source_in):
+                r, w = big_pipe()
+                reads.append(r)
+                try:
+                    senders.append(Popen(command, stdin=source_in, stdout=w))
+                finally:
+                    os.close(w)
+            start(*sources[0])
+            for i in range(len(sources)):
+                if i + 1 < len(sources):
+                    start(*sources[i + 1])
+                got, put = pump(reads[i], recv_w, spend)
+                sent += got
+                received += put
+                status = status or senders[i].wait()
+                if status or put < got:  # Don't send on a broken chain.
+                    break
+        finally:
+            for fd in (recv_r, recv_w, *reads):
+                fd is None or os.close(fd)
+            for sender in senders:
+                sender.wait()
+        result = Transfer(status, receiver.wait(), sent, received)
+        rec['bytes'] = tr['bytes'] = received
+        tr['status'] = [*(p.returncode for p in senders),
+                        result.receive_status]
+        dbg("run_chain: %s" % (result,))
+        if result.send_status or result.receive_status:
+            fatal("Could not %s (%s exited %d, %s exited %d)." %
+                  (goal, program(sources[0][0]), result.send_status,
+                   program(sink), result.receive_status))
+    return result
+
+
+# # Usage: results = run_tee(goal, source, sinks, throttle=None)
+# Like run_pipe(), but runs the 'source' command into every command in
+# 'sinks' at once (see tee()), so the source is only read once.
+# Returns a Transfer per sink, or exits script if 'source' failed.
+# Failed sinks are left to the caller, since the rest may have worked.
+##
+# VERBOSITY: 0 (goals), 1 (commands), 2 (outputs)
+def run_tee(goal, source, sinks, throttle=None):
+    source = io_limited(source, throttle)
+    sinks = [io_limited(sink, throttle) for sink in sinks]
+    VERBOSITY >= 0 and msg("Doing task: %s." % goal)
+    VERBOSITY >= 1 and msg("%s | tee to:\n\t%s" % (
+        ' '.join(source), '\n\t'.join(' '.join(s) for s in sinks)))
+    if DEBUG:
+        return [Transfer(0, 0, 0, 0)] * len(sinks)
+    sink_out = None if VERBOSITY >= 2 else DEVNULL
+    with stage('send', source[-1]) as rec, \
+            traced('pipe', goal, [source, *sinks]) as tr:
+        send_r, send_w = big_pipe()
+        pipes = [[*big_pipe()] for _ in sinks]
+        receivers = []
+        try:
+            sender = Popen(source, stdout=send_w)
+            os.close(send_w)
+            send_w = None
+            for pipe, sink in zip(pipes, sinks):
+                receivers.append(Popen(sink, stdin=pipe[0], stdout=sink_out))
+                os.close(pipe[0])
+                pipe[0] = None
+            sent, puts = tee(send_r, [w for _, w in pipes],
+                             limiter(throttle))
+        finally:
+            for fd in [send_r, send_w] + [fd for pipe in pipes for fd in pipe]:
+                fd is None or os.close(fd)
+        status = sender.wait()
+        results = [Transfer(status, r.wait(), sent, put)
+                   for r, put in zip(receivers, puts)]
+        rec['bytes'] = tr['bytes'] = sent
+        tr['status'] = [status] + [r.receive_status for r in results]
+        dbg("run_tee: %s" % (results,))
+        if status:
+            fatal("Could not %s (%s exited %d)." %
+                  (goal, program(source), status))
+    return results
 
 
 # # Usage: dbg(messages[, ...])
@@ -320,28 +1203,545 @@ def list(items, sep=', ', last=', and'):
     return last.join(sep.join(items[:-2]), items[-1])
 
 
+# # Usage: save_json(path, data)
+# Save 'data' as JSON to 'path' such that the file is either entirely
+# the old version or entirely the new one, even after a crash.
+def save_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# # Usage: device(path)
+# Get the device ID of the filesystem holding 'path', checking the
+# nearest existing parent directory if 'path' doesn't exist yet.
+def device(path):
+    while not lexists(path) and dirname(path) != path:
+        path = dirname(path)
+    return stat(path).st_dev
+
+
+# Semaphores limiting parallel jobs per device, made by slots()
+SLOTS = {}
+SLOTS_LOCK = threading.Lock()
+
+
+# # Usage: set_jobs(path, count)
+# Allow up to 'count' snapshots or transfers at once on the device
+# holding 'path'. This is meant to be called from the config, before
+# the actions using the device.
+def set_jobs(path, count):
+    DEVICE_JOBS[path] = count
+
+
+# # Usage: dev, semaphore = slots(path)
+# Get the device ID and job-limiting semaphore for the device holding
+# 'path', making the semaphore on first use.
+def slots(path):
+    dev = device(path)
+    with SLOTS_LOCK:
+        if dev not in SLOTS:
+            count = DEFAULT_JOBS
+            for p, jobs in DEVICE_JOBS.items():
+                if lexists(p) and device(p) == dev:
+                    count = jobs
+            SLOTS[dev] = threading.Semaphore(count)
+        return dev, SLOTS[dev]
+
+
+# # Usage: with stage(name, target) as record: ...
+# Time a stage of the run, such as 'snapshot', 'sync', 'send', or
+# 'delete', acting on 'target'. The stage's 'record' dict gets start
+# and end times, duration, and success, and is added to STAGES when
+# done. Code in the 'with' block should set record['bytes'] to how
+# many bytes the stage moved or freed, if applicable.
+@contextmanager
+def stage(name, target):
+    record = {'stage': name, 'target': target, 'start': time.time(),
+              'bytes': 0, 'ok': False}
+    start = time.monotonic()
+    try:
+        yield record
+        record['ok'] = True
+    finally:
+        record['end'] = time.time()
+        record['seconds'] = time.monotonic() - start
+        if record['bytes'] and record['seconds']:
+            record['MB/s'] = record['bytes'] / record['seconds'] / 1e6
+        with STAGES_LOCK:
+            STAGES.append(record)
+        if TRACE is not None:
+            write_trace({'kind': 'stage', 'goal': '%s %s' % (name, target),
+                         'commands': [],
+                         'thread': threading.current_thread().name,
+                         'start': record['start'],
+                         'seconds': round(record['seconds'], 6),
+                         'bytes': record['bytes'], 'ok': record['ok']})
+
+
+# # Usage: run_parallel(task, func, items, *paths)
+# Run func(item) for every item, in parallel as far as the job limits
+# of the devices holding 'paths' allow. Every item is attempted even
+# if others fail, and each item is timed as a stage named 'task' (with
+# the last of 'paths' as the item's location).
+# Returns True iff every item succeeded.
+##
+# NOTE: Device semaphores are always acquired in device ID order so
+# that jobs sharing devices can't deadlock each other.
+def run_parallel(task, func, items, *paths):
+    held = sorted(dict(slots(p) for p in paths).items())
+
+    def work(item):
+        for _, sem in held:
+            sem.acquire()
+        try:
+            with stage(task, join(paths[-1], item) if paths else item):
+                func(item)
+            return True
+        except SystemExit:  # fatal() already said what went wrong.
+            return False
+        except Exception as e:
+            msg("Could not %s '%s': %s" % (task, item, e))
+            return False
+        finally:
+            for _, sem in reversed(held):
+                sem.release()
+
+    if not items:
+        return True
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        results = [*pool.map(work, items)]
+    if not all(results):
+        msg("Failed to %s %d of %d subvolume(s)." %
+            (task, results.count(False), len(results)))
+    return all(results)
+
+
+# # Usage: summary()
+# Show how long each stage took, slowest first, with transfer rates.
+def summary():
+    for r in SKIPPED:
+        msg("Skipped unchanged '%s' (latest snapshot '%s')." %
+            (r['subvolume'], r['snapshot']))
+    if not STAGES:
+        return
+    msg("Run summary (wall time per stage):")
+    for r in sorted(STAGES, key=lambda r: -r['seconds']):
+        rate = '%.1f MB/s' % r['MB/s'] if 'MB/s' in r else ''
+        size = r['bytes'] or r.get('estimated')  # estimates' guesses
+        msg(("  %-8s %-40s %8.1fs %10s %11s%s" %
+             (r['stage'], r['target'], r['seconds'],
+              human(size) if size else '', rate,
+              '' if r['ok'] else '  FAILED')).rstrip())
+
+
+# Set by backup() or the installed script: where report() saves the
+# run report as JSON, and as Prometheus metrics for node_exporter's
+# textfile collector (None to skip either)
+REPORT_PATH = None
+METRICS_PATH = None
+
+
+# # Usage: metric_labels(**labels)
+# Format labels for a Prometheus metric line, like '{a="b"}'.
+def metric_labels(**labels):
+    escape = lambda v: (str(v).replace('\\', '\\\\').replace('"', '\\"')
+                        .replace('\n', '\\n'))
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v))
+                             for k, v in sorted(labels.items()))
+
+
+# # Usage: report(ok=True)
+# Save the timed stages of this run to REPORT_PATH as JSON and to
+# METRICS_PATH as Prometheus text, so slow or failing runs can be
+# noticed without reading logs. 'ok' is whether the run as a whole
+# succeeded.
+def report(ok=True):
+    if DEBUG:
+        return
+    end = time.time()
+    start = min((r['start'] for r in STAGES), default=end)
+    if REPORT_PATH:
+        os.makedirs(dirname(REPORT_PATH), exist_ok=True)
+        save_json(REPORT_PATH, {'timestamp': TIMESTAMP, 'start': start,
+                                'end': end, 'seconds': end - start,
+                                'ok': ok, 'stages': STAGES,
+                                'skipped': SKIPPED})
+    if METRICS_PATH:
+        totals = {}
+        for r in STAGES:
+            key = (r['stage'], r['target'])
+            secs, size, good = totals.get(key, (0, 0, True))
+            totals[key] = (secs + r['seconds'], size + r['bytes'],
+                           good and r['ok'])
+        lines = [
+            '# HELP backup_btrfs_run_seconds Wall time of the last run.',
+            '# TYPE backup_btrfs_run_seconds gauge',
+            'backup_btrfs_run_seconds %f' % (end - start),
+            '# HELP backup_btrfs_run_success Whether the last run worked.',
+            '# TYPE backup_btrfs_run_success gauge',
+            'backup_btrfs_run_success %d' % ok,
+            '# HELP backup_btrfs_run_end_seconds When the last run ended.',
+            '# TYPE backup_btrfs_run_end_seconds gauge',
+            'backup_btrfs_run_end_seconds %f' % end,
+            '# HELP backup_btrfs_skipped_subvolumes Unchanged subvolumes '
+            'not snapshotted.',
+            '# TYPE backup_btrfs_skipped_subvolumes gauge',
+            'backup_btrfs_skipped_subvolumes %d' % len(SKIPPED),
+        ]
+        for name, index, what in (('seconds', 0, 'Wall time'),
+                                  ('bytes', 1, 'Bytes moved or freed'),
+                                  ('success', 2, 'Whether it worked')):
+            lines += ['# HELP backup_btrfs_stage_%s %s per stage and target.'
+                      % (name, what),
+                      '# TYPE backup_btrfs_stage_%s gauge' % name]
+            lines += ['backup_btrfs_stage_%s%s %s' %
+                      (name, metric_labels(stage=st, target=target),
+                       float(total[index]))
+                      for (st, target), total in sorted(totals.items())]
+        os.makedirs(dirname(METRICS_PATH), exist_ok=True)
+        tmp = METRICS_PATH + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, METRICS_PATH)
+
+
 # === btrfs utility functions ===
 
+# Snapshot names in each snapshot directory, each directory scanned
+# once per run by snaps_in()
+SNAP_INDEX = {}
+# Each scanned directory's modification time when scanned, so a
+# long-running daemon can keep SNAP_INDEX for directories that haven't
+# changed since (see start_run())
+SNAP_MTIMES = {}
+# Subvolume details per filesystem (by device ID), each listed once
+# per run by subvolumes()
+SUBVOL_INDEX = {}
+INDEX_LOCK = threading.Lock()
+
+# A line of 'btrfs subvolume list -u -R' output. 'received_uuid' is
+# None unless the subvolume came from 'btrfs receive'.
+Subvol = namedtuple('Subvol', 'id gen uuid received_uuid path')
+
+
+# # Usage: snaps_in(dir)
+# Get the set of snapshot names in 'dir', scanning it only the first
+# time. Missing directories (and files) have no snapshots. Hidden
+# files are skipped.
+def snaps_in(dir):
+    with INDEX_LOCK:
+        if dir not in SNAP_INDEX:
+            try:
+                SNAP_MTIMES[dir] = stat(dir).st_mtime_ns
+                with os.scandir(dir) as items:
+                    SNAP_INDEX[dir] = {i.name for i in items
+                                       if not i.name.startswith('.')}
+            except (FileNotFoundError, NotADirectoryError):
+                SNAP_MTIMES[dir] = None
+                SNAP_INDEX[dir] = set()
+        return SNAP_INDEX[dir]
+
+
+# # Usage: indexed(dir, name, present=True)
+# Record that snapshot 'name' was just made in (or, with
+# present=False, deleted from) 'dir', so the index stays current
+# without rescanning.
+def indexed(dir, name, present=True):
+    snaps = snaps_in(dir)
+    with INDEX_LOCK:
+        if present:
+            snaps.add(name)
+        else:
+            snaps.discard(name)
+        SUBVOL_INDEX.pop(device(dir), None)  # Relist on next use.
+
+
+# # Usage: match_uuids(enabled=True)
+# Make snapshots count as common to two directories when btrfs says
+# one is a received copy of the other, even if their names differ.
+# This is meant to be called from the config.
+def match_uuids(enabled=True):
+    global MATCH_UUIDS
+    MATCH_UUIDS = enabled
+
+
+# # Usage: parse_subvol(line)
+# Turn a line of 'btrfs subvolume list -u -R' output into a Subvol.
+def parse_subvol(line):
+    head, _, path = line.partition(' path ')
+    f = head.replace('top level', 'top_level').split()
+    f = dict(zip(f[::2], f[1::2]))
+    received = f.get('received_uuid', '-')
+    return Subvol(int(f['ID']), int(f['gen']), f.get('uuid'),
+                  None if received == '-' else received, path)
+
+
+# # Usage: subvolumes(path)
+# Get a dict of every subvolume on the filesystem holding 'path',
+# keyed by the last two components of its path (snapshot directory
+# and snapshot name) to match how this script lays out snapshots. The
+# filesystem is listed with one btrfs command the first time.
+def subvolumes(path):
+    dev = device(path)
+    with INDEX_LOCK:
+        if dev in SUBVOL_INDEX:
+            return SUBVOL_INDEX[dev]
+    out = cmd("list subvolumes on the filesystem holding '%s'" % path,
+              'btrfs', 'subvolume', 'list', '-u', '-R', path,
+              side_effects=False)
+    subvols = {}
+    for line in out.splitlines():
+        if line.startswith('ID '):
+            sv = parse_subvol(line)
+            subvols['/'.join(sv.path.split('/')[-2:])] = sv
+    with INDEX_LOCK:
+        SUBVOL_INDEX[dev] = subvols
+    return subvols
+
+
+# # Usage: uuid_matches(src, dst)
+# Get the names of snapshots in directory 'src' that have a received
+# copy in directory 'dst', whatever the copy is named. A snapshot is
+# identified by its received_uuid if it's a copy itself, and by its
+# own uuid otherwise, since that's what 'btrfs receive' records.
+def uuid_matches(src, dst):
+    if not lexists(dst):
+        return set()
+    src_svs, dst_svs = subvolumes(src), subvolumes(dst)
+    prefix = basename(dst) + '/'
+    received = {sv.received_uuid for key, sv in dst_svs.items()
+                if key.startswith(prefix) and sv.received_uuid}
+    matches = set()
+    for name in snaps_in(src):
+        sv = src_svs.get(join(basename(src), name))
+        if sv and (sv.received_uuid or sv.uuid) in received:
+            matches.add(name)
+    return matches
+
+
 # # Usage: last_backup_name=last_backup(backup_dirs)
 # Get name of last backup found in all given backup directories, or
-# empty string if they have no backup in common.
+# None if they have no backup in common. Names returned are from the
+# first directory. See resolve_parents().
 ##
 # NOTE: This assumes that this script is the only source of items in
 # the snapshot directory.
 def last_backup(dirs):
-    # Go thru all snapshots in first directory, in reverse order
-    # (newest first).
-    for snap in sorted(listdir(dirs[0]), reverse=True):
-        # Get just the snapshot's name without containing directory.
-        snap = basename(snap)
-        for dir in dirs[1:]:
-            if not lexists(join(dir, snap)):
-                # Give up on current backup name at first failure.
+    return resolve_parents(dirs[0], dirs[1:]).common
+
+
+# Result of resolve_parents(): the newest snapshot in common with each
+# destination, by destination, and the newest in common with them all
+Parents = namedtuple('Parents', 'each common')
+
+
+# # Usage: parents = resolve_parents(src, dsts)
+# Find the newest snapshot in directory 'src' that each directory in
+# 'dsts' has (by name or, with match_uuids(), by received_uuid), and
+# the newest that all of them have, as Parents (with None for none).
+# Every directory is scanned only once per run (see snaps_in()), and
+# one walk of 'src' from its newest snapshot answers for every
+# destination at once, stopping as soon as all are found.
+def resolve_parents(src, dsts):
+    found = [snaps_in(dst) | uuid_matches(src, dst) if MATCH_UUIDS
+             else snaps_in(dst) for dst in dsts]
+    each = dict.fromkeys(dsts)
+    common = None
+    left = len(set(dsts))
+    # ISO-8601 makes the lexicographically last name the newest.
+    for name in sorted(snaps_in(src), reverse=True):
+        hits = [dst for dst, names in zip(dsts, found) if name in names]
+        for dst in hits:
+            if each[dst] is None:
+                each[dst] = name
+                left -= 1
+        if common is None and len(hits) == len(dsts):
+            common = name
+        if not left and common is not None:
+            break
+    return Parents(each, common)
+
+
+# # Usage: names = shared(src, dst)
+# Get the names of snapshots in directory 'src' that directory 'dst'
+# has too, by name or (with match_uuids()) by received_uuid.
+def shared(src, dst):
+    found = snaps_in(dst)
+    if MATCH_UUIDS:
+        found = found | uuid_matches(src, dst)
+    return snaps_in(src) & found
+
+
+# 'btrfs send' stream format details used by estimate_send(): the
+# stream header, the size of each command's header (length, command
+# and CRC), the command that --no-data sends instead of writing data,
+# and the attribute giving its size
+SEND_MAGIC = b'btrfs-stream\0'
+SEND_CMD_HEADER = struct.Struct('<IHI')
+SEND_UPDATE_EXTENT = 22
+SEND_ATTR_SIZE = 4
+
+
+# # Usage: size = estimate_send(snapshot, parent=None, clones=())
+# Estimate how many bytes sending 'snapshot' would take, as per
+# send_command(), via a 'btrfs send --no-data' dry run: the dry run's
+# own stream (the metadata) plus the size of every data write it
+# leaves out. Data that can be cloned from 'parent' or 'clones' isn't
+# written, so isn't counted. Returns None if the dry run failed.
+def estimate_send(snap, parent=None, clones=()):
+    send = send_command(snap, parent, clones)
+    send.insert(send.index('send') + 1, '--no-data')
+    VERBOSITY >= 1 and msg(' '.join(send))
+    size = 0
+    with traced('pipe', "estimate sending '%s'" % snap, [send]) as tr, \
+            Popen(send, stdout=PIPE, stderr=DEVNULL) as sender:
+        stream = sender.stdout
+        if stream.read(len(SEND_MAGIC) + 4)[:len(SEND_MAGIC)] != SEND_MAGIC:
+            return None
+        size += len(SEND_MAGIC) + 4
+        while True:
+            header = stream.read(SEND_CMD_HEADER.size)
+            if len(header) < SEND_CMD_HEADER.size:
                 break
-        else:  # This else executes iff the preceding loop completed.
-            # The first (newest) success is correct.
-            return snap
-    return None  # Failed to find common snapshot
+            length, command, _ = SEND_CMD_HEADER.unpack(header)
+            body = stream.read(length)
+            size += len(header) + len(body)
+            at = 0
+            while command == SEND_UPDATE_EXTENT and at + 4 <= len(body):
+                kind, n = struct.unpack_from('<HH', body, at)
+                if kind == SEND_ATTR_SIZE:
+                    size += int.from_bytes(body[at + 4:at + 4 + n], 'little')
+                at += 4 + n
+        tr['status'], tr['bytes'] = [sender.wait()], size
+    return None if sender.returncode else size
+
+
+# How many sets of send sources choose_sources() may estimate per send
+MAX_ESTIMATES = 4
+
+
+# # Usage: estimate_sends(enabled=True)
+# Let copy_latest choose each send's parent and clone sources by
+# estimating their stream sizes with dry runs, instead of always using
+# the newest common snapshot as the parent. This is meant to be called
+# from the config.
+def estimate_sends(enabled=True):
+    global ESTIMATE_SENDS
+    ESTIMATE_SENDS = enabled
+
+
+# # Usage: parent, clones, size = choose_sources(fro, to, sv, last)
+# Choose the parent and clone sources for sending fro/sv/last to
+# to/sv that should make the smallest stream. Every snapshot 'to'
+# already has is a candidate, including those of other subvolumes
+# (like @home's for @home-user), but only the newest shared snapshot
+# per subvolume is used, leaving out any being deleted (see claim()).
+# If there's more than the newest shared snapshot of 'sv' to choose
+# from (and estimate_sends() is on), each choice's stream size is
+# estimated (see estimate_send()) and recorded as an 'estimate' stage
+# with the same target as the send's stage, to compare with what's
+# actually sent. Returns paths relative to 'fro' (with 'parent' None
+# for a full send), and the chosen stream's estimated size, if any.
+def choose_sources(fro, to, sv, last):
+    newest = {}  # newest shared snapshot, by snapshot directory
+    with USE_LOCK:
+        gone = set(DELETING)
+    for dir in snaps_in(fro) if ESTIMATE_SENDS else [sv]:
+        names = {n for n in shared(join(fro, dir), join(to, dir))
+                 if join(fro, dir, n) not in gone and
+                 join(to, dir, n) not in gone}
+        if dir == sv:
+            names = {n for n in names if n < last}
+        if names:
+            newest[dir] = join(dir, max(names))
+    parent = newest.pop(sv, None)
+    others = tuple(sorted(newest.values()))
+    choices = [(parent, ())]
+    if others:
+        choices.append((parent, others))
+        if parent is None:  # Any other subvolume's snapshot may do.
+            choices += [(p, tuple(o for o in others if o != p))
+                        for p in others[:MAX_ESTIMATES - 2]]
+    if len(choices) == 1:
+        return (*choices[0], None)
+    snap = join(fro, sv, last)
+    with stage('estimate', snap) as rec:
+        sizes = [estimate_send(snap, p and join(fro, p),
+                               [join(fro, c) for c in cs])
+                 for p, cs in choices]
+        if sizes[0] is None:
+            return (*choices[0], None)  # Nothing to compare with.
+        best = min((s, i) for i, s in enumerate(sizes) if s is not None)[1]
+        rec['estimated'], rec['baseline'] = sizes[best], sizes[0]
+    if best:
+        msg("Sending '%s'%s should take about %s, instead of %s." %
+            (snap, via(*choices[best]), human(sizes[best]),
+             human(sizes[0])))
+    return (*choices[best], sizes[best])
+
+
+# # Usage: parse_stamp(name)
+# Get the time a snapshot was made from its name, as a UTC datetime,
+# or None if the name isn't an ISO-8601 timestamp. Names without a
+# UTC offset are taken as UTC, as this script makes them. Each name is
+# parsed only once per run, however many directories have it.
+@functools.lru_cache(maxsize=None)
+def parse_stamp(name):
+    try:
+        t = datetime.datetime.fromisoformat(name)
+    except ValueError:
+        return None
+    return utc(t)
+
+
+# # Usage: utc(time)
+# Get a datetime as an aware UTC datetime, taking naive ones as UTC.
+def utc(t):
+    if t.tzinfo is None:
+        return t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc)
+
+
+# # Usage: parse_time(time)
+# Get 'time' as a UTC datetime, given either a datetime (naive ones
+# being UTC) or a date/time string as used by "date --date=STRING",
+# like "3 days ago".
+def parse_time(time):
+    if isinstance(time, datetime.datetime):
+        return utc(time)
+    out = cmd("find the time '%s'" % time, 'date', '--utc',
+              '--iso-8601=seconds', '--date=' + time,
+              root=False, side_effects=False)
+    return utc(datetime.datetime.fromisoformat(out.strip()))
+
+
+# # Usage: sizes = exclusive_sizes(path)
+# Get a dict of each subvolume ID's exclusive size in bytes (about
+# what deleting it frees) on the filesystem holding 'path'. This only
+# works when btrfs quotas are enabled, giving an empty dict otherwise.
+def exclusive_sizes(path):
+    out = cmd("get subvolume sizes on the filesystem holding '%s'" % path,
+              'btrfs', 'qgroup', 'show', '--raw', path,
+              side_effects=False, fail_ok=True)
+    sizes = {}
+    for line in (out or '').splitlines():
+        f = line.split()
+        if len(f) >= 3 and f[0].startswith('0/') and f[2].isdigit():
+            sizes[int(f[0][2:])] = int(f[2])
+    return sizes
+
+
+# # Usage: human(bytes)
+# Format a byte count for people, like '1.5 GiB'.
+def human(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(n) < 1024 or unit == 'TiB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (n, unit)
+        n /= 1024
 
 
 # # Usage: sanitize(subvol)
@@ -353,90 +1753,1511 @@ def sanitize(subvol):
     return subvol.replace('/', '-')
 
 
+# # Usage: escape_path(path)
+# Turn 'path' into a file name no other path turns into, like
+# 'systemd-escape --path': each '/' becomes a '-', after escaping any
+# '\' and '-' it had. The root is '-'.
+def escape_path(path):
+    return path.strip('/').replace('\\', '\\x5c').replace(
+        '-', '\\x2d').replace('/', '-') or '-'
+
+
+# # Usage: sync_fs(why, *paths)
+# Flush each filesystem holding any of 'paths' once, via 'btrfs
+# filesystem sync', instead of a global 'sync' that also waits on
+# every other mounted (and maybe slow) drive. Each sync is timed as a
+# stage.
+def sync_fs(why, *paths):
+    done = set()
+    for path in paths:
+        dev = device(path)
+        if dev in done:
+            continue
+        done.add(dev)
+        with stage('sync', path):
+            cmd("sync '%s' %s" % (path, why),
+                'btrfs', 'filesystem', 'sync', path)
+
+
+# # Usage: info = subvolume_info(path)
+# Get the fields 'btrfs subvolume show' lists for the subvolume at
+# 'path' (like 'UUID', 'Parent UUID', 'Generation', and 'Gen at
+# creation') as a dict of strings, empty if btrfs doesn't say.
+def subvolume_info(path):
+    out = cmd("show subvolume '%s'" % path,
+              'btrfs', 'subvolume', 'show', path,
+              side_effects=False, fail_ok=True)
+    # Snapshot paths listed after 'Snapshot(s):' can contain ':' too.
+    fields = (out or '').split('Snapshot(s):')[0]
+    return dict(re.findall(r'^\s*(\w[\w ]*):[ \t]*(.*?)\s*$', fields, re.M))
+
+
+# # Usage: unchanged_since(subvolume, snapshot)
+# Check whether the subvolume at path 'subvolume' is unchanged since
+# the snapshot at path 'snapshot' was taken of it. That's so if the
+# snapshot's parent is the subvolume and the subvolume's generation
+# (last transaction ID to change it) is no newer than the snapshot's
+# generation at creation, since any write after the snapshot lands in
+# a later transaction. Both come from btrfs at once, so no write
+# between taking and syncing the snapshot can be missed.
+def unchanged_since(subvol, snap):
+    src, old = subvolume_info(subvol), subvolume_info(snap)
+    try:
+        return (src['UUID'] == old['Parent UUID'] and
+                int(src['Generation']) <= int(old['Gen at creation']))
+    except (KeyError, ValueError):
+        return False
+
+
 # === btrfs actions ===
 
 # # Usage: snapshot(from_root, to_snapshot_dir, subvol)
 # Snapshots from-root/subvol to to-snapshot-dir/subvol/$TIMESTAMP
 # (sanitizing subvol and making the directory for the to-snapshot-dir
-# side, as applicable) and runs 'sync' to workaround a bug in btrfs.
+# side, as applicable).
+##
+# If the subvolume hasn't changed since its latest snapshot there (see
+# unchanged_since()), no snapshot is made and it's added to SKIPPED
+# instead.
+##
+# NOTE: The snapshot must be synced before it can be sent. This is
+# left to the caller, so that a batch of snapshots needs only one
+# sync_fs() per filesystem.
 def snapshot(from_root, to_snap_dir, subvol):
     sanSv = sanitize(subvol) or fatal("WTF? (sanitize %s)" % subvol)
     target = join(to_snap_dir, sanSv)
     fro = join(from_root, subvol)
     to = join(target, TIMESTAMP)
-    if not lexists(target):  # Make sure target directory exists.
-        cmd("make snap target directory '%s'" % target,
-            "mkdir", "-p", target)
-    cmd("snapshot '%s' to '%s'" % (fro, to),
-        'btrfs', 'subvolume', 'snapshot', '-r', fro, to)
-    # TODO: Remove 'sync' when cloning stops requiring it after
-    # snapshots. See
-    # https://btrfs.wiki.kernel.org/index.php/Incremental_Backup#Initial_Bootstrapping
-    cmd_eval("'sync' so 'btrfs send' works later", 'sync')  # TODO: sh->py
-
-
-# # Usage: clone_or_update(fro, to, subvolume)
+    old = last_backup([target])
+    if old is not None and unchanged_since(fro, join(target, old)):
+        msg("Skipping snapshot of '%s' since it hasn't changed since '%s'." %
+            (fro, join(target, old)))
+        with STAGES_LOCK:
+            SKIPPED.append({'subvolume': fro, 'to': target,
+                            'snapshot': old})
+        return
+    # Make sure target directory exists, in the same request.
+    cmd_batch("snapshot '%s' to '%s'" % (fro, to),
+              [['mkdir', '-p', target]] * (not lexists(target)) +
+              [['btrfs', 'subvolume', 'snapshot', '-r', fro, to]])
+    indexed(target, TIMESTAMP)
+
+
+# # Usage: clone_or_update(fro, to, subvolume, staging=None)
 # Use btrfs commands to make it so that to/sanitized-subvolume
 # contains a copy of the latest btrfs subvolume at
-# from/sanitized-subvolume.
+# from/sanitized-subvolume. If 'staging' is given, the send stream is
+# spooled through it so an interrupted copy can resume. 'to' may also
+# be a list of destinations: those needing the same parent are sent
+# to from one 'btrfs send' at once, and the rest one at a time. Each
+# send first makes room for itself on its destinations, if they have
+# deferred deletions (see room()).
 ##
 # Result: to/sanitized-subvolume/latest-snapshot-date matches
 # from/sanitized-subvolume/latest-snapshot-date.
-def clone_or_update(fro, to, subvol):
+def clone_or_update(fro, to, subvol, staging=None):
+    sv = sanitize(subvol)
+    last = last_backup([join(fro, sv)])
+    if last is None:
+        fatal("Could not get last backup in '%s'." % join(fro, sv))
+    groups = {}  # destinations by (parent, clone sources)
+    sizes = {}  # estimated stream size by (parent, clone sources)
+    dests = [to] if isinstance(to, str) else to
+    have = resolve_parents(join(fro, sv), [join(d, sv) for d in dests]).each
+    claimed = []  # parents and clone sources in use, on both sides
+    try:
+        for dest in dests:
+            if not exists(join(dest, sv)):  # Make sure target dir exists.
+                cmd("make clone target directory '%s'" % join(dest, sv),
+                    'mkdir', '-p', join(dest, sv))
+            if have[join(dest, sv)] == last:  # Nothing to do.
+                msg(("Skipping '%s' because '%s' already has the latest " +
+                     "snapshot '%s' from '%s'.") %
+                    (subvol, dest, join(sv, last), fro))
+                continue
+            # Choose again if a prune took a choice before it was claimed.
+            while True:
+                parent, clones, size = choose_sources(fro, dest, sv, last)
+                using = [join(d, p) for d in (fro, dest)
+                         for p in (parent, *clones) if p]
+                if claim(using):
+                    break
+            claimed += using
+            sizes[parent, clones] = size
+            dbg("clone_or_update: fro='%s' to='%s' subvol='%s'" %
+                (fro, dest, subvol))
+            dbg("                 sv='%s' last='%s' parent='%s' clones=%s" %
+                (sv, last, parent, clones))
+            groups.setdefault((parent, clones), []).append(dest)
+
+        for (parent, clones), dests in groups.items():
+            send_group(fro, dests, sv, last, parent, clones,
+                       sizes[parent, clones], staging)
+    finally:
+        release(claimed)
+
+
+# # Usage: send_group(fro, tos, sv, last, parent, clones, size, staging)
+# Send fro/sv/last to every 'to' in 'tos' with the same 'parent' and
+# 'clones', for clone_or_update(): at once if it can, otherwise one at
+# a time. 'size' is the estimated stream size, if known.
+def send_group(fro, tos, sv, last, parent, clones, size, staging):
+    if size is None and any(deferred(to) for to in tos):
+        size = estimate_send(join(fro, sv, last), parent and
+                             join(fro, parent),
+                             [join(fro, c) for c in clones])
+    # Snapshots the receiving side needs, kept from make_room()
+    needed = [p for p in (parent, *clones) if p]
+    if len(tos) > 1 and staging is None:
+        with room(tos, size, needed):
+            transfer_many(fro, tos, sv, last, parent, clones)
+        return
+    for to in tos:
+        try:
+            with room([to], size, needed):
+                transfer(fro, to, sv, last, parent, staging, clones)
+            indexed(join(to, sv), last)
+            record_copy(fro, to, sv, last)
+        except BaseException:
+            remove_partial(join(to, sv, last))
+            raise
+
+
+# # Usage: remove_partial(snapshot)
+# Delete a half-received snapshot, if any, so it isn't mistaken for a
+# parent next time.
+def remove_partial(snap):
+    if lexists(snap):
+        cmd("remove partial clone '%s'" % snap,
+            'btrfs', 'subvolume', 'delete', snap)
+
+
+# # Usage: transfer_many(fro, tos, sv, last, parent, clones=())
+# Send fro/sv/last to to/sv for every 'to' in 'tos' with a single
+# 'btrfs send' (see run_tee()), as per transfer(). The 'to's that did
+# receive it keep it even if others failed.
+def transfer_many(fro, tos, sv, last, parent, clones=()):
+    goal = "clone snapshot '%s' from '%s' to '%s'" % (
+        join(sv, last), fro, "', '".join(tos))
+    goal += via(parent, clones)
+    send = send_command(join(fro, sv, last), parent and join(fro, parent),
+                        [join(fro, c) for c in clones])
+    try:
+        results = run_tee(goal, send,
+                          [SUDO + ['btrfs', 'receive', join(to, sv)]
+                           for to in tos], throttling(*tos))
+    except BaseException:
+        for to in tos:
+            remove_partial(join(to, sv, last))
+        raise
+    failed = []
+    for to, result in zip(tos, results):
+        if result.receive_status:
+            remove_partial(join(to, sv, last))
+            failed.append(to)
+        else:
+            indexed(join(to, sv), last)
+            record_copy(fro, to, sv, last)
+    if failed:
+        fatal("Could not %s (btrfs receive failed for '%s')." %
+              (goal, "', '".join(failed)))
+
+
+# Receive-time records of copies, by path, loaded from STATE_DIR by
+# received_copies(): each one's source path, its received_uuid, and
+# the digest of its file tree once verify_copy() has compared it
+COPIES = None
+COPIES_LOCK = threading.Lock()
+
+
+# # Usage: copies = received_copies()
+# Get the dict of copies recorded by record_copy(), loading it the
+# first time.
+def received_copies():
+    global COPIES
+    if COPIES is None:
+        try:
+            with open(join(STATE_DIR, 'copies.json')) as f:
+                COPIES = json.load(f)
+        except (OSError, ValueError):
+            COPIES = {}
+    return COPIES
+
+
+# # Usage: save_copies()
+# Save the records of received_copies() to STATE_DIR, warning if that
+# fails. Call this holding COPIES_LOCK.
+def save_copies():
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        save_json(join(STATE_DIR, 'copies.json'), received_copies())
+    except OSError as e:
+        msg("Could not save copy records: %s" % e)
+
+
+# # Usage: record_copy(fro, to, sv, name)
+# Record that to/sv/name was just received from fro/sv/name, with the
+# received_uuid btrfs gave it, for verify_copy(). Records of copies no
+# longer in to/sv are dropped.
+def record_copy(fro, to, sv, name):
+    if DEBUG:
+        return
+    copy = join(to, sv, name)
+    uuid = subvolume_info(copy).get('Received UUID')
+    have = snaps_in(join(to, sv))
+    with COPIES_LOCK:
+        copies = received_copies()
+        for path in [p for p in copies if dirname(p) == join(to, sv)]:
+            if basename(path) not in have:
+                del copies[path]
+        copies[copy] = {'from': join(fro, sv, name), 'received_uuid': uuid,
+                        'tree': None}
+        save_copies()
+
+
+# Code tree_digest() runs as root to hash a file tree: every entry's
+# relative path, type and mode, owner, extended attributes, and
+# symlink target or size, mtime, device, and contents, walked in name
+# order. That's what 'btrfs receive' reproduces; inode numbers,
+# ctimes, directory mtimes, and extent layout aren't compared, since
+# a copy's differ from its source's.
+TREE_HASH_CODE = r'''
+import hashlib, os, stat, sys
+top, tree, stack = os.fsencode(sys.argv[1]), hashlib.new(sys.argv[2]), [b'']
+while stack:
+    rel = stack.pop()
+    path = os.path.join(top, rel) if rel else top
+    st = os.lstat(path)
+    entry = [rel, st.st_mode, st.st_uid, st.st_gid]
+    if stat.S_ISDIR(st.st_mode):
+        stack += sorted((os.path.join(rel, n) for n in os.listdir(path)),
+                        reverse=True)
+    elif stat.S_ISLNK(st.st_mode):
+        entry.append(os.readlink(path))
+    else:
+        entry += [st.st_size, st.st_mtime_ns, st.st_rdev]
+        if stat.S_ISREG(st.st_mode):
+            data = hashlib.new(sys.argv[2])
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    data.update(block)
+            entry.append(data.digest())
+    for name in sorted(os.listxattr(path, follow_symlinks=False)):
+        entry.append((name, os.getxattr(path, name, follow_symlinks=False)))
+    tree.update(repr(entry).encode() + b'\n')
+print(tree.hexdigest())
+'''
+
+
+# # Usage: digest = tree_digest(path)
+# Get the hex STREAM_HASH digest of the file tree at 'path' (see
+# TREE_HASH_CODE), read as root.
+def tree_digest(path):
+    return cmd("hash the file tree of '%s'" % path,
+               sys.executable, '-c', TREE_HASH_CODE, path, STREAM_HASH,
+               side_effects=False).strip()
+
+
+# # Usage: uuid = received_as(info)
+# Get the received_uuid a copy of the subvolume described by 'info'
+# (from subvolume_info()) gets: its own received_uuid if it's a copy
+# itself, since 'btrfs send' passes that on, or else its UUID.
+def received_as(info):
+    uuid = info.get('Received UUID', '-')
+    return info.get('UUID') if uuid == '-' else uuid
+
+
+# # Usage: ok = verify_copy(to, subvol, name=None)
+# Check that copy 'name' (default: the newest) of 'subvol' in 'to' is
+# still what was received: that btrfs still says it's a copy of the
+# same snapshot, and that its file tree hashes the same as its
+# source's did (see tree_digest()). The source is only hashed the
+# first time, while it's there; the digest is recorded for next time.
+# Returns whether it matches, or None if there's nothing to check it
+# against.
+##
+# NOTE: Send streams can't be compared instead, since sending a copy
+# again never gives the same stream: its transids and extent layout
+# differ from the original's.
+def verify_copy(to, subvol, name=None):
+    sv = sanitize(subvol)
+    name = name or last_backup([join(to, sv)])
+    copy = name and join(to, sv, name)
+    with COPIES_LOCK:
+        entry = dict(received_copies().get(copy) or {})
+    if not entry:
+        msg("No record of receiving a copy of '%s' in '%s' to verify." %
+            (subvol, to))
+        return None
+    goal = "verify copy '%s' in '%s'" % (join(sv, name), to)
+    if DEBUG:
+        dbg(goal)
+        return True
+    if received_as(subvolume_info(copy)) != entry['received_uuid']:
+        msg("Copy '%s' is no longer the snapshot received there." % copy)
+        return False
+    want = entry['tree']
+    with stage('verify', join(to, sv)):
+        if want is None:
+            src = entry['from']
+            uuid = lexists(src) and received_as(subvolume_info(src))
+            if uuid != entry['received_uuid']:
+                msg("Can't verify copy '%s' since its source '%s' is gone." %
+                    (copy, src))
+                return None
+            want = tree_digest(src)
+        digest = tree_digest(copy)
+    ok = digest == want
+    if ok and entry['tree'] is None:
+        with COPIES_LOCK:
+            if copy in received_copies():
+                received_copies()[copy]['tree'] = digest
+                save_copies()
+    msg("Copy '%s' in '%s' %s its source." %
+        (join(sv, name), to, 'matches' if ok else 'DOES NOT match'))
+    return ok
+
+
+# # Usage: result = transfer(fro, to, sv, last, parent, staging=None,
+# #                          clones=())
+# Send fro/sv/last to to/sv, incrementally if 'parent' isn't None,
+# with 'clones' as clone sources ('parent' and 'clones' being paths
+# relative to 'fro'). This is the part of clone_or_update() that
+# moves data. If 'staging' is given, the stream is spooled through a
+# directory in it for this destination, since each destination's
+# stream can differ (see spooled_transfer()). Transfers are limited by
+# any throttle() for 'to'.
+def transfer(fro, to, sv, last, parent, staging=None, clones=()):
+    goal = "clone snapshot '%s' from '%s' to '%s'" % (join(sv, last), fro, to)
+    goal += via(parent, clones)
+    # Incremental backup if there's a parent. Otherwise bootstrap.
+    parent = parent and join(fro, parent)
+    clones = [join(fro, c) for c in clones]
+    limits = throttling(to)
+    if staging is not None:
+        spool = join(staging, escape_path(to), sv, last)
+        return spooled_transfer(goal, join(fro, sv, last), join(to, sv),
+                                parent, spool, clones, limits)
+    return send_receive(goal, join(fro, sv, last), join(to, sv), parent,
+                        clones, limits)
+
+
+# # Usage: goal += via(parent, clones)
+# Describe a send's parent and clone sources for its goal, if any.
+def via(parent, clones):
+    text = '' if parent is None else " via parent '%s'" % parent
+    if clones:
+        text += " with clone source(s) '%s'" % "', '".join(clones)
+    return text
+
+
+# # Usage: size, digest = read_chunk(fd, buf, out=None)
+# Read up to CHUNK_SIZE bytes from file descriptor 'fd' through the
+# memoryview 'buf', writing them to the file 'out' if given. Returns
+# how many bytes were read and their hex BLAKE2b digest.
+def read_chunk(fd, buf, out=None):
+    digest = hashlib.blake2b()
+    size = 0
+    while size < CHUNK_SIZE:
+        n = os.readv(fd, [buf[:min(len(buf), CHUNK_SIZE - size)]])
+        if not n:
+            break
+        digest.update(buf[:n])
+        out is None or out.write(buf[:n])
+        size += n
+    return size, digest.hexdigest()
+
+
+# # Usage: state = spool(goal, send, dir, parent, clones=())
+# Runs the 'send' command, saving its output as CHUNK_SIZE chunk files
+# in 'dir' and checkpointing each finished chunk in dir/state.json.
+# If an earlier spool of the same stream into 'dir' was interrupted,
+# the chunks it finished are checked against the new stream and
+# skipped instead of written again. Exits script on error; finished
+# chunks are kept for the next try.
+def spool(goal, send, dir, parent, clones=()):
+    state_path = join(dir, 'state.json')
+    state = {'parent': parent, 'clones': [*clones], 'chunk_size': CHUNK_SIZE,
+             'digests': [], 'complete': False}
+    try:
+        with open(state_path) as f:
+            old = json.load(f)
+        if ((old['parent'], old.get('clones', []), old['chunk_size']) ==
+                (parent, state['clones'], CHUNK_SIZE)):
+            state = old
+    except (OSError, ValueError, KeyError):
+        pass  # Nothing usable spooled yet.
+    chunks = state['digests']
+    if state['complete']:
+        msg("Reusing %d spooled chunk(s) in '%s'." % (len(chunks), dir))
+        return state
+    os.makedirs(dir, exist_ok=True)
+    VERBOSITY >= 0 and msg("Doing task: %s." % goal)
+    VERBOSITY >= 1 and msg("%s > %s" % (' '.join(send), join(dir, '*')))
+    chunks and msg("Resuming after %d spooled chunk(s)." % len(chunks))
+    with stage('spool', dir) as rec, traced('pipe', goal, [send]) as tr:
+        status = spool_chunks(send, dir, state)
+        rec['bytes'] = tr['bytes'] = state.pop('spooled')
+        tr['status'] = [status]
+        if status:
+            fatal("Could not %s (send exited %d); kept %d spooled chunk(s)." %
+                  (goal, status, len(chunks)))
+    if status is None:  # Spool didn't match the stream; start over.
+        return spool(goal, send, dir, parent, clones)
+    state['complete'] = True
+    save_json(state_path, state)
+    return state
+
+
+# # Usage: status = spool_chunks(send, dir, state)
+# The part of spool() that runs 'send' and saves its output. Returns
+# the send's exit status, or None if already-spooled chunks didn't
+# match the stream (and so were dropped). Counts the bytes written in
+# state['spooled'].
+def spool_chunks(send, dir, state):
+    state_path = join(dir, 'state.json')
+    chunks = state['digests']
+    state['spooled'] = 0
+    buf = memoryview(bytearray(PIPE_SIZE))
+    r, w = big_pipe()
+    sender = None
+    try:
+        sender = Popen(send, stdout=w)
+        os.close(w)
+        w = None
+        i = 0
+        while True:
+            if i < len(chunks):  # Already spooled: just check it.
+                size, digest = read_chunk(r, buf)
+                if size < CHUNK_SIZE and sender.wait():
+                    break  # Send failed, not the spool.
+                if digest != chunks[i]:
+                    msg("Spooled chunk %d doesn't match; respooling." % i)
+                    del chunks[:]
+                    save_json(state_path, state)
+                    return None
+            else:
+                partial = join(dir, 'partial')
+                with open(partial, 'wb') as out:
+                    size, digest = read_chunk(r, buf, out)
+                    out.flush()
+                    os.fsync(out.fileno())
+                if not size or size < CHUNK_SIZE and sender.wait():
+                    # Nothing left, or cut short by a failed send.
+                    os.remove(partial)
+                    break
+                os.replace(partial, join(dir, '%06d' % i))
+                chunks.append(digest)
+                state['spooled'] += size
+                save_json(state_path, state)
+            i += 1
+            if size < CHUNK_SIZE:
+                break
+        return sender.wait()
+    finally:
+        os.close(r)
+        w is None or os.close(w)
+        if sender is not None and sender.poll() is None:
+            sender.kill()
+            sender.wait()
+
+
+# # Usage: result = unspool(goal, dir, state, into, throttle=None)
+# Feeds the chunks spooled by spool() into 'btrfs receive' at 'into',
+# limited by 'throttle' if given. Exits script on error, otherwise
+# returns a Transfer.
+def unspool(goal, dir, state, into, throttle=None):
+    receive = io_limited(SUDO + ['btrfs', 'receive', into], throttle)
+    spend = limiter(throttle)
+    VERBOSITY >= 1 and msg("cat %s | %s" %
+                           (join(dir, '*'), ' '.join(receive)))
+    r, w = big_pipe()
+    sent = received = 0
+    with stage('send', dir) as rec, traced('pipe', goal, [receive]) as tr:
+        try:
+            receiver = Popen(receive, stdin=r,
+                             stdout=None if VERBOSITY >= 2 else DEVNULL)
+            os.close(r)
+            r = None
+            for i in range(len(state['digests'])):
+                with open(join(dir, '%06d' % i), 'rb') as chunk:
+                    got, put = pump(chunk.fileno(), w, spend)
+                sent += got
+                received += put
+                if put < got:  # receive quit early
+                    break
+        finally:
+            os.close(w)
+            r is None or os.close(r)
+        result = Transfer(0, receiver.wait(), sent, received)
+        rec['bytes'] = tr['bytes'] = received
+        tr['status'] = [result.receive_status]
+        if result.receive_status:
+            fatal("Could not %s (receive exited %d); kept spooled stream in "
+                  "'%s'." % (goal, result.receive_status, dir))
+    return result
+
+
+# # Usage: result = spooled_transfer(goal, snapshot, into, parent, dir,
+# #                                  clones=(), throttle=None)
+# Like send_receive(), but the stream is first spooled to checkpointed
+# chunk files in 'dir' (a staging directory), and then fed to 'btrfs
+# receive'. If the send is interrupted, the next try resumes after
+# the last finished chunk. If the receive is interrupted, the next try
+# needn't send at all. The staging directory is removed on success.
+def spooled_transfer(goal, snap, into, parent, dir, clones=(),
+                     throttle=None):
+    send = send_command(snap, parent, clones)
+    if DEBUG:
+        VERBOSITY >= 0 and msg("Doing task: %s." % goal)
+        VERBOSITY >= 1 and msg("%s > %s; cat %s | btrfs receive %s" %
+                               (' '.join(send), join(dir, '*'),
+                                join(dir, '*'), into))
+        return Transfer(0, 0, 0, 0)
+    state = spool(goal, send, dir, parent, clones)
+    result = unspool(goal, dir, state, into, throttle)
+    shutil.rmtree(dir)
+    return result
+
+
+# # Usage: manifest = load_manifest(store)
+# Get the manifest of the stream archive directory 'store': a dict of
+# archived snapshot names to their stream file, parent snapshot name
+# (None for full streams), sizes, and stream digest. Missing manifests
+# are empty.
+def load_manifest(store):
+    try:
+        with open(join(store, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# # Usage: archive(fro, to, subvol, compress='zstd')
+# Save the latest snapshot of fro/sanitized-subvolume as a compressed
+# 'btrfs send' stream in to/sanitized-subvolume, which needn't be on
+# btrfs. The stream is incremental from the newest snapshot that's
+# both archived and still in 'fro', if any. The stream's parent,
+# sizes, and digest (if hash_streams() is on) are recorded in the
+# directory's manifest.json, for restore_archive() and
+# verify_archive().
+##
+# NOTE: Stream files are named without ':', which some filesystems
+# (like exFAT) forbid.
+def archive(fro, to, subvol, compress='zstd'):
+    sv = sanitize(subvol)
+    store = join(to, sv)
+    last = last_backup([join(fro, sv)])
+    if last is None:
+        fatal("Could not get last backup in '%s'." % join(fro, sv))
+    manifest = load_manifest(store)
+    if last in manifest:
+        msg("Skipping '%s' because '%s' already has the latest snapshot." %
+            (subvol, store))
+        return
+    common = snaps_in(join(fro, sv)) & set(manifest)
+    parent = max(common, default=None)
+    squeeze, _, ext = COMPRESSORS[compress]
+    file = last.replace(':', '') + ('.full' if parent is None else '') + ext
+    goal = "archive snapshot '%s' from '%s' to '%s'" % (join(sv, last),
+                                                       fro, to)
+    if parent is not None:
+        goal += " via parent '%s'" % join(sv, parent)
+    if DEBUG:
+        run_pipe(goal, send_command(join(fro, sv, last),
+                                    parent and join(fro, sv, parent)),
+                 squeeze)
+        return
+    os.makedirs(store, exist_ok=True)
+    tmp = join(store, '.' + file + '.tmp')
+    try:
+        with open(tmp, 'wb') as out:
+            result = run_pipe(goal,
+                              send_command(join(fro, sv, last),
+                                           parent and join(fro, sv, parent)),
+                              squeeze, sink_out=out, hashed=HASH_STREAMS)
+            os.fsync(out.fileno())
+        os.replace(tmp, join(store, file))
+    finally:
+        lexists(tmp) and os.remove(tmp)
+    manifest[last] = {'file': file, 'parent': parent,
+                      'size': result.received,
+                      'stored': stat(join(store, file)).st_size}
+    if result.digest is not None:
+        manifest[last][STREAM_HASH] = result.digest
+    save_json(join(store, 'manifest.json'), manifest)
+    dbg("archive: %s is %s, compressed to %s" %
+        (file, human(result.received), human(manifest[last]['stored'])))
+
+
+# # Usage: restore_archive(store, to, subvol, name=None)
+# Restore snapshot 'name' (default: the newest) of 'subvol' from the
+# stream archive directory 'store' (as made by archive_latest()) into
+# the btrfs directory to/sanitized-subvolume. Only the streams after
+# the newest snapshot on the way to 'name' that 'to' already has (or
+# else from the last full stream) are needed, and they're
+# decompressed one after another into a single 'btrfs receive' (see
+# run_chain()).
+def restore_archive(store, to, subvol, name=None):
+    sv = sanitize(subvol)
+    manifest = load_manifest(join(store, sv))
+    if not manifest:
+        fatal("No archived snapshots in '%s'." % join(store, sv))
+    name = name or max(manifest)
+    if name not in manifest:
+        fatal("Snapshot '%s' isn't in '%s'." % (name, join(store, sv)))
+    have = snaps_in(join(to, sv))
+    chain = [name]
+    while chain[-1] not in have and manifest[chain[-1]]['parent'] is not None:
+        chain.append(manifest[chain[-1]]['parent'])
+    chain = [snap for snap in reversed(chain) if snap not in have]
+    if not chain:
+        msg("Skipping '%s' because '%s' already has it." % (name, to))
+        return
+    if not exists(join(to, sv)):
+        cmd("make restore target directory '%s'" % join(to, sv),
+            'mkdir', '-p', join(to, sv))
+    streams = []
+    try:
+        for snap in chain:
+            file = manifest[snap]['file']
+            unsqueeze = next(c[1] for c in COMPRESSORS.values()
+                             if file.endswith(c[2]))
+            streams.append((unsqueeze, open(join(store, sv, file), 'rb')))
+        goal = "restore snapshot(s) '%s' from '%s' to '%s'" % (
+            "', '".join(join(sv, snap) for snap in chain), store, to)
+        try:
+            run_chain(goal, streams,
+                      SUDO + ['btrfs', 'receive', join(to, sv)])
+        except BaseException:  # Only the last one started can be partial.
+            made = [snap for snap in chain if lexists(join(to, sv, snap))]
+            made and remove_partial(join(to, sv, made[-1]))
+            raise
+        finally:
+            for snap in chain:
+                lexists(join(to, sv, snap)) and indexed(join(to, sv), snap)
+    finally:
+        for _, stream in streams:
+            stream.close()
+
+
+# # Usage: parent = restore_base(fro, to, sv, name, have)
+# Choose which of 'have', the names of snapshots of 'sv' that both
+# 'fro' and 'to' have, to send fro/sv/name to 'to' incrementally from,
+# or None for a full send. Any of them will do, since 'btrfs send'
+# only needs a parent with data in common, not an older one; so it's
+# the nearest in time, older or newer. If there's one of each (and
+# estimate_sends() is on), the one with the smaller estimated stream
+# is used instead. Returns a path relative to 'fro'.
+def restore_base(fro, to, sv, name, have):
+    older = max((n for n in have if n < name), default=None)
+    newer = min((n for n in have if n > name), default=None)
+    if older is None or newer is None:
+        base = older or newer
+        return base and join(sv, base)
+    if ESTIMATE_SENDS:
+        snap = join(fro, sv, name)
+        with stage('estimate', snap) as rec:
+            sizes = [estimate_send(snap, join(fro, sv, n))
+                     for n in (older, newer)]
+            if None not in sizes:
+                rec['estimated'] = min(sizes)
+                return join(sv, newer if sizes[1] < sizes[0] else older)
+    at, before, after = map(parse_stamp, (name, older, newer))
+    if None in (at, before, after):
+        return join(sv, older)
+    return join(sv, newer if after - at < at - before else older)
+
+
+# # Usage: restore_snapshots(fro, to, subvol, names=())
+# Restore the named snapshots (default: the newest) of 'subvol' from
+# the btrfs backup directory 'fro' (as made by copy_latest()) into
+# to/sanitized-subvolume, skipping any it already has. Each is sent
+# incrementally from the best snapshot both sides have by then (see
+# restore_base()), so restoring an old snapshot next to a recent one
+# only sends what differs between them. All the sends go one after
+# another into a single 'btrfs receive' (see run_chain()), oldest
+# first, so later ones can use earlier ones as parents.
+##
+# NOTE: Restored snapshots are read-only, like all received ones. Make
+# a writable snapshot of one to use it.
+def restore_snapshots(fro, to, subvol, names=()):
     sv = sanitize(subvol)
-    last = last_backup(join(fro, sv))
+    names = sorted(names) or [last_backup([join(fro, sv)])]
+    for name in names:
+        if name is None or name not in snaps_in(join(fro, sv)):
+            fatal("Snapshot '%s' isn't in '%s'." % (name, join(fro, sv)))
+    have = set(shared(join(fro, sv), join(to, sv)))
+    steps = []  # (snapshot, parent) pairs
+    for name in names:
+        if name in have:
+            msg("Skipping '%s' because '%s' already has it." % (name, to))
+            continue
+        steps.append((name, restore_base(fro, to, sv, name, have)))
+        have.add(name)
+    if not steps:
+        return
+    if not exists(join(to, sv)):
+        cmd("make restore target directory '%s'" % join(to, sv),
+            'mkdir', '-p', join(to, sv))
+    goal = "restore snapshot(s) %s from '%s' to '%s'" % (', '.join(
+        "'%s'%s" % (join(sv, name), via(parent, ()))
+        for name, parent in steps), fro, to)
+    try:
+        run_chain(goal, [(send_command(join(fro, sv, name),
+                                       parent and join(fro, parent)), None)
+                         for name, parent in steps],
+                  SUDO + ['btrfs', 'receive', join(to, sv)], throttling(to))
+    except BaseException:  # Only the last one started can be partial.
+        made = [n for n, _ in steps if lexists(join(to, sv, n))]
+        made and remove_partial(join(to, sv, made[-1]))
+        raise
+    finally:
+        for name, _ in steps:
+            lexists(join(to, sv, name)) and indexed(join(to, sv), name)
+
+
+# # Usage: digest, size, status = hash_command(goal, command, stdin=None,
+# #                                           hash=STREAM_HASH)
+# Run 'command' (with 'stdin' as its input, if given) and hash all it
+# outputs with 'hash' (a hashlib name), without keeping it. Returns the
+# hex digest, the output's size, and the command's exit status.
+def hash_command(goal, command, stdin=None, hash=STREAM_HASH):
+    digest = hashlib.new(hash)
+    dbg("hash_command: %s" % ' '.join(command))
+    with traced('pipe', goal, [command]) as tr, \
+            open(os.devnull, 'wb') as null:
+        proc = Popen(command, stdin=stdin, stdout=PIPE)
+        try:
+            size, _ = pump(proc.stdout.fileno(), null.fileno(),
+                           digest=digest)
+        finally:
+            proc.stdout.close()
+        tr['status'], tr['bytes'] = [proc.wait()], size
+    return digest.hexdigest(), size, tr['status'][0]
+
+
+# # Usage: ok = verify_archive(store, subvol, name=None)
+# Check that the archived stream of snapshot 'name' (default: the
+# newest) of 'subvol' in 'store' (as made by archive_latest()) still
+# decompresses to what was sent: to its digest in the manifest, if
+# hash_streams() was on, and otherwise cleanly, which checks it with
+# the compressor's own checksums (zstd's XXH64 and xz's CRC64 of the
+# whole stream). Returns whether it does, or None if it's not there.
+def verify_archive(store, subvol, name=None):
+    sv = sanitize(subvol)
+    manifest = load_manifest(join(store, sv))
+    name = name or max(manifest, default=None)
+    if name not in manifest:
+        msg("No archived snapshot to verify for '%s' in '%s'." %
+            (subvol, store))
+        return None
+    entry = manifest[name]
+    hash = next((h for h in (STREAM_HASH, 'blake2b') if entry.get(h)), None)
+    goal = "verify archived snapshot '%s' in '%s'" % (join(sv, name), store)
+    if DEBUG:
+        dbg(goal)
+        return True
+    unsqueeze = next(c[1] for c in COMPRESSORS.values()
+                     if entry['file'].endswith(c[2]))
+    with stage('verify', join(store, sv)) as rec, \
+            open(join(store, sv, entry['file']), 'rb') as stream:
+        digest, size, status = hash_command(goal, unsqueeze, stdin=stream,
+                                            hash=hash or STREAM_HASH)
+        rec['bytes'] = size
+    ok = not status and (hash is None or digest == entry[hash])
+    msg("Archived snapshot '%s' in '%s' %s its %s." %
+        (join(sv, name), store, 'matches' if ok else 'DOES NOT match',
+         'stream digest' if hash else "compressor's checksums"))
+    return ok
+
+
+# # Usage: for chunk in cut_chunks(fd): ...
+# Read file descriptor 'fd' until EOF, yielding its data in
+# content-defined chunks (as bytearrays) of DEDUP_MIN to DEDUP_MAX
+# bytes, so the same data makes the same chunks wherever it is in a
+# stream. A chunk ends where a 16-bit Gear rolling hash of its last
+# bytes hits DEDUP_MARK; with 4-bit gear values shifted 4 bits a byte,
+# that hash is just the last 4 bytes' gear values in order, so it's
+# found for a whole buffer at once by mapping every byte with
+# bytes.translate() and searching with find().
+##
+# NOTE: A 4-byte window is much shorter than the usual 32 to 64 bytes
+# of Gear hashing, but it's enough: cut points still depend only on
+# the data at them, so an edit moves only the cut points within 4
+# bytes of it, and chunks after it come out the same. What a short
+# window does worse is data with few distinct 4-byte sequences, like
+# runs of zeros or a repeated pattern, which gives either no cut
+# points (so DEDUP_MAX chunks) or one every repeat (so DEDUP_MIN
+# chunks); both are still the same wherever that data turns up. It
+# isn't widened since that would change every chunk boundary, so new
+# streams wouldn't share chunks with stored ones.
+def cut_chunks(fd):
+    data = bytearray()
+    eof = False
+    while True:
+        while not eof and len(data) < DEDUP_READ:
+            more = os.read(fd, DEDUP_READ)
+            eof = not more
+            data += more
+        bits = data.translate(DEDUP_GEAR)
+        start = 0
+        while len(data) - start >= (1 if eof else DEDUP_MAX):
+            at = bits.find(DEDUP_MARK, start + DEDUP_MIN - len(DEDUP_MARK),
+                           start + DEDUP_MAX)
+            end = (min(len(data), start + DEDUP_MAX) if at < 0
+                   else at + len(DEDUP_MARK))
+            yield data[start:end]
+            start = end
+        del data[:start]
+        if eof:
+            return
+
+
+# # Usage: index = chunk_index(to)
+# Open the chunk index of the deduplicating stream store 'to' (see
+# dedup()), making it if needed: an SQLite table of each stored chunk's
+# BLAKE2b hash, the pack file holding it, where, and its stored and
+# real sizes. SQLite keeps it on disk, so memory use stays the same
+# however many millions of chunks there are, and several runs or
+# threads can add to it at once.
+def chunk_index(to):
+    index = sqlite3.connect(join(to, 'chunks.db'), timeout=600,
+                            check_same_thread=False)
+    index.execute('PRAGMA journal_mode = WAL')
+    index.execute('CREATE TABLE IF NOT EXISTS chunks (hash BLOB PRIMARY KEY, '
+                  'pack TEXT NOT NULL, offset INTEGER NOT NULL, '
+                  'stored INTEGER NOT NULL, size INTEGER NOT NULL) '
+                  'WITHOUT ROWID')
+    return index
+
+
+# # Usage: dedup(fro, to, subvol, compress=True)
+# Save the latest snapshot of fro/sanitized-subvolume as a full 'btrfs
+# send' stream in the deduplicating store 'to', which needn't be on
+# btrfs. The stream is cut into content-defined chunks (see
+# cut_chunks()) and only chunks the store doesn't have yet are added,
+# to pack files in to/packs, so repeated full sends of mostly
+# unchanged subvolumes take little more space than what changed. With
+# 'compress', each new chunk is zlib-compressed if that makes it
+# smaller, on every CPU core at once. The stream is recorded as the
+# list of its chunks' hashes in to/sanitized-subvolume, and in that
+# directory's manifest.json with its sizes and digest, for
+# restore_dedup().
+##
+# NOTE: Streams are always full, so any snapshot can be restored by
+# itself; deduplication saves what incremental streams would.
+# NOTE: Pack files are synced before the index refers to them, so an
+# interrupted run at worst leaves chunks nothing uses.
+def dedup(fro, to, subvol, compress=True):
+    sv = sanitize(subvol)
+    store = join(to, sv)
+    last = last_backup([join(fro, sv)])
     if last is None:
         fatal("Could not get last backup in '%s'." % join(fro, sv))
-    if not exists(join(to, sv)):  # Make sure target directory exists.
-        cmd("make clone target directory '%s'" % join(to, sv),
+    manifest = load_manifest(store)
+    if last in manifest:
+        msg("Skipping '%s' because '%s' already has the latest snapshot." %
+            (subvol, store))
+        return
+    goal = "dedup snapshot '%s' from '%s' to '%s'" % (join(sv, last), fro, to)
+    send = send_command(join(fro, sv, last))
+    if DEBUG:
+        dbg(goal)
+        return
+    os.makedirs(join(to, 'packs'), exist_ok=True)
+    os.makedirs(store, exist_ok=True)
+    recipe = last.replace(':', '') + '.chunks'
+    tmp = join(store, '.' + recipe + '.tmp')
+    index = chunk_index(to)
+    pack, pending = None, {}  # current pack file, and its unindexed chunks
+    compressing = deque()  # new chunks' keys, sizes, and data
+    queued = set()  # keys in 'compressing'
+    stats = {'size': 0, 'chunks': 0, 'new': 0, 'stored': 0}
+    digest = hashlib.blake2b()
+    workers = os.cpu_count() or 1
+    pool = ThreadPoolExecutor(workers)
+
+    def squeeze(chunk):
+        data = zlib.compress(chunk, 1) if compress else chunk
+        return chunk if len(data) >= len(chunk) else data
+
+    def add(key, size, data):  # Add a new chunk to the pack.
+        nonlocal pack
+        if pack is None or pack.tell() >= DEDUP_PACK:
+            flush()
+            pack and pack.close()
+            pack = open(join(to, 'packs', '%x-%d-%d.pack' % (
+                time.time_ns(), os.getpid(), threading.get_native_id())),
+                'ab')
+        pending[key] = (basename(pack.name), pack.tell(), len(data), size)
+        pack.write(data)
+        stats['new'] += size
+        stats['stored'] += len(data)
+        if len(pending) >= DEDUP_BATCH:
+            flush()
+
+    def flush():  # Sync the pack, then index what's in it.
+        if pending:
+            pack.flush()
+            os.fsync(pack.fileno())
+            with index:
+                index.executemany('INSERT OR IGNORE INTO chunks VALUES '
+                                  '(?, ?, ?, ?, ?)',
+                                  [(k, *v) for k, v in pending.items()])
+            pending.clear()
+
+    try:
+        with stage('dedup', store) as rec, \
+                traced('pipe', goal, [send]) as tr, open(tmp, 'wb') as out:
+            sender = Popen(send, stdout=PIPE)
+            try:
+                for chunk in cut_chunks(sender.stdout.fileno()):
+                    digest.update(chunk)
+                    key = hashlib.blake2b(chunk, digest_size=32).digest()
+                    out.write(key)
+                    stats['size'] += len(chunk)
+                    stats['chunks'] += 1
+                    if key in pending or key in queued or index.execute(
+                            'SELECT 1 FROM chunks WHERE hash = ?',
+                            (key,)).fetchone():
+                        continue
+                    queued.add(key)
+                    compressing.append((key, len(chunk),
+                                        pool.submit(squeeze, chunk)))
+                    while len(compressing) > 2 * workers:
+                        key, size, data = compressing.popleft()
+                        queued.discard(key)
+                        add(key, size, data.result())
+                while compressing:
+                    key, size, data = compressing.popleft()
+                    add(key, size, data.result())
+            finally:
+                sender.stdout.close()
+            status = sender.wait()
+            tr['status'], tr['bytes'] = [status], stats['size']
+            if status:
+                fatal("Could not %s ('btrfs send' failed)." % goal)
+            flush()
+            out.flush()
+            os.fsync(out.fileno())
+            os.replace(tmp, join(store, recipe))
+            rec['bytes'], rec['stored'] = stats['size'], stats['stored']
+    finally:
+        pool.shutdown(cancel_futures=True)
+        pack and pack.close()
+        index.close()
+        lexists(tmp) and os.remove(tmp)
+    manifest[last] = {'chunks': recipe, 'size': stats['size'],
+                      'count': stats['chunks'], 'new': stats['new'],
+                      'stored': stats['stored'], 'blake2b': digest.hexdigest()}
+    save_json(join(store, 'manifest.json'), manifest)
+    msg("Stored %s of '%s' as %s of new chunks (%s in all: %s)." %
+        (human(stats['size']), join(sv, last), human(stats['stored']),
+         to, dedup_ratio(to)))
+
+
+# # Usage: text = dedup_ratio(to)
+# Describe how much the deduplicating store 'to' saves: the size of
+# every stream it holds, the space its chunks take, and their ratio.
+def dedup_ratio(to):
+    streams = 0
+    for sv in listdir(to):
+        if sv != 'packs' and os.path.isdir(join(to, sv)):
+            streams += sum(e['size'] for e in load_manifest(join(to, sv))
+                           .values())
+    index = chunk_index(to)
+    try:
+        stored = index.execute('SELECT SUM(stored) FROM chunks').fetchone()[0]
+    finally:
+        index.close()
+    return '%s of streams in %s of chunks, %.1fx' % (
+        human(streams), human(stored or 0), streams / (stored or 1))
+
+
+# # Usage: for chunk in undedup(store, sv, name): ...
+# Yield the stream of snapshot 'name' of sanitized subvolume 'sv' in
+# the deduplicating store 'store' (see dedup()), chunk by chunk. Exits
+# script if a chunk is missing or doesn't match its hash.
+def undedup(store, sv, name):
+    index = chunk_index(store)
+    packs = {}  # open pack files by name
+    try:
+        with open(join(store, sv, load_manifest(join(store, sv))[name]
+                       ['chunks']), 'rb') as recipe:
+            for key in iter(lambda: recipe.read(32), b''):
+                row = index.execute('SELECT pack, offset, stored, size FROM '
+                                    'chunks WHERE hash = ?', (key,)).fetchone()
+                if row is None:
+                    fatal("Chunk %s of '%s' is missing from '%s'." %
+                          (key.hex(), join(sv, name), store))
+                file, offset, stored, size = row
+                if file not in packs:
+                    if len(packs) >= DEDUP_OPEN_PACKS:
+                        packs.pop(next(iter(packs))).close()
+                    packs[file] = open(join(store, 'packs', file), 'rb')
+                data = os.pread(packs[file].fileno(), stored, offset)
+                chunk = zlib.decompress(data) if stored < size else data
+                if hashlib.blake2b(chunk, digest_size=32).digest() != key:
+                    fatal("Chunk %s of '%s' in '%s' is damaged." %
+                          (key.hex(), join(sv, name), store))
+                yield chunk
+    finally:
+        for f in packs.values():
+            f.close()
+        index.close()
+
+
+# # Usage: restore_dedup(store, to, subvol, name=None)
+# Restore snapshot 'name' (default: the newest) of 'subvol' from the
+# deduplicating store 'store' (as made by dedup_latest()) into the
+# btrfs directory to/sanitized-subvolume, rebuilding its stream from
+# its chunks straight into 'btrfs receive'.
+def restore_dedup(store, to, subvol, name=None):
+    sv = sanitize(subvol)
+    manifest = load_manifest(join(store, sv))
+    if not manifest:
+        fatal("No deduplicated snapshots in '%s'." % join(store, sv))
+    name = name or max(manifest)
+    if name not in manifest:
+        fatal("Snapshot '%s' isn't in '%s'." % (name, join(store, sv)))
+    if name in snaps_in(join(to, sv)):
+        msg("Skipping '%s' because '%s' already has it." % (name, to))
+        return
+    if not exists(join(to, sv)):
+        cmd("make restore target directory '%s'" % join(to, sv),
             'mkdir', '-p', join(to, sv))
-    parent = last_backup(join(to, sv), join(fro, sv))
-    dbg("clone_or_update: fro='%s' to='%s' subvol='%s'" % (fro, to, subvol))
-    dbg("                 sv='%s' last='%s' parent='%s'" % (sv, last, parent))
-
-    if parent is None:  # No subvols found, so bootstrap.
-        # TODO: sh->py
-        cmd_eval("clone snapshot '%s' from '%s' to '%s'" %
-                 (join(sv, last), fro, to),
-                 "sudo btrfs send --quiet '$from/$sv/$last' | " +
-                 "sudo btrfs receive '$to/$sv'")
-    elif exists(join(to, sv, last)):  # Nothing to do.
-        msg("Skipping '%s' because '%s' already has the latest snapshot " +
-            "'%s' from '%s'." %
-            (subvol, to, join(sv, last), fro))
-    else:  # Incremental backup.
-        # TODO: sh->py
-        cmd_eval("clone snapshot '%s' from '%s' to '%s' via parent '%s'" %
-                 (join(sv, last), fro, to, join(sv, parent)),
-                 "sudo btrfs send --quiet -p '%s' " % join(fro, sv, parent) +
-                 "'%s' | sudo btrfs receive '%s'" %
-                 (join(fro, sv, last), join(to, sv)))
-
-
-# # Usage: delete_older_than(location, time, min_keep_count, subvolume)
+    goal = "restore snapshot '%s' from '%s' to '%s'" % (join(sv, name),
+                                                       store, to)
+    receive = SUDO + ['btrfs', 'receive', join(to, sv)]
+    with stage('restore', join(to, sv)) as rec, \
+            traced('pipe', goal, [receive]) as tr:
+        receiver = Popen(receive, stdin=PIPE)
+        try:
+            for chunk in undedup(store, sv, name):
+                receiver.stdin.write(chunk)
+                rec['bytes'] += len(chunk)
+            receiver.stdin.close()
+        except BrokenPipeError:  # Receiver quit; its exit status says why.
+            pass
+        except BaseException:  # like a missing chunk, via fatal()
+            # Cut off, the stream makes 'btrfs receive' fail and exit.
+            try:
+                receiver.stdin.close()
+            except BrokenPipeError:
+                pass
+            receiver.wait()
+            remove_partial(join(to, sv, name))
+            raise
+        tr['status'], tr['bytes'] = [receiver.wait()], rec['bytes']
+    if tr['status'][0]:
+        remove_partial(join(to, sv, name))
+        fatal("Could not %s ('btrfs receive' failed)." % goal)
+    indexed(join(to, sv), name)
+
+
+# # Usage: ok = verify_dedup(store, subvol, name=None)
+# Check that snapshot 'name' (default: the newest) of 'subvol' in the
+# deduplicating store 'store' still rebuilds to the stream that was
+# sent, by its digest in the manifest. Returns whether it does.
+def verify_dedup(store, subvol, name=None):
+    sv = sanitize(subvol)
+    manifest = load_manifest(join(store, sv))
+    name = name or max(manifest, default=None)
+    if name not in manifest:
+        msg("No recorded stream digest to verify '%s' in '%s' with." %
+            (subvol, store))
+        return None
+    goal = "verify deduplicated snapshot '%s' in '%s'" % (join(sv, name),
+                                                          store)
+    if DEBUG:
+        dbg(goal)
+        return True
+    digest = hashlib.blake2b()
+    with stage('verify', join(store, sv)) as rec:
+        for chunk in undedup(store, sv, name):
+            digest.update(chunk)
+            rec['bytes'] += len(chunk)
+    ok = digest.hexdigest() == manifest[name]['blake2b']
+    msg("Deduplicated snapshot '%s' in '%s' %s its stream digest." %
+        (join(sv, name), store, 'matches' if ok else 'DOES NOT match'))
+    return ok
+
+
+# How many snapshots to delete per 'btrfs subvolume delete' call
+DELETE_BATCH = 100
+
+# Snapshots sends in progress use as parents or clone sources, as a
+# count of sends by path, and snapshots being deleted, by path, so
+# neither delete_snaps() nor a send takes what the other is using
+IN_USE = {}
+DELETING = set()
+USE_LOCK = threading.Lock()
+
+
+# # Usage: ok = claim(paths)
+# Mark the snapshots at 'paths' as used by a send until release(), so
+# delete_snaps() in this run keeps them. Claims nothing and returns
+# False if any of them is already being deleted. (Other runs' pruning
+# keeps them by pinned() instead.)
+def claim(paths):
+    with USE_LOCK:
+        if DELETING.intersection(paths):
+            return False
+        for path in paths:
+            IN_USE[path] = IN_USE.get(path, 0) + 1
+    return True
+
+
+# # Usage: release(paths)
+# Let delete_snaps() have snapshots claim() marked as used again.
+def release(paths):
+    with USE_LOCK:
+        for path in paths:
+            IN_USE[path] -= 1
+            if not IN_USE[path]:
+                del IN_USE[path]
+
+
+# # Usage: count, freed = delete_snaps(location, names)
+# Deletes the named snapshots in 'location' with a few batched 'btrfs
+# subvolume delete --commit-after' calls instead of one process per
+# snapshot. Returns how many were deleted and about how many bytes
+# that reclaims (0 if unknown because btrfs quotas are disabled).
+# Snapshots a send is using (see claim()) are kept.
+def delete_snaps(location, names):
+    with USE_LOCK:
+        busy = [n for n in names if join(location, n) in IN_USE]
+        names = [n for n in names if join(location, n) not in IN_USE]
+        DELETING.update(join(location, n) for n in names)
+    if busy:
+        msg("Keeping %d snapshot(s) in '%s' that sends are using." %
+            (len(busy), location))
+    try:
+        return delete_listed(location, names)
+    finally:
+        with USE_LOCK:
+            DELETING.difference_update(join(location, n) for n in names)
+
+
+# # Usage: count, freed = delete_listed(location, names)
+# Do the deleting for delete_snaps(), once it's left out what's used.
+def delete_listed(location, names):
+    if not names:
+        return 0, 0
+    sizes = exclusive_sizes(location)
+    svs = subvolumes(location) if sizes else {}
+    freed = 0
+    for name in names:
+        sv = svs.get(join(basename(location), name))
+        freed += sizes.get(sv.id, 0) if sv else 0
+    with stage('delete', location) as rec:
+        rec['bytes'] = freed
+        rec['count'] = len(names)
+        for i in range(0, len(names), DELETE_BATCH):
+            batch = names[i:i + DELETE_BATCH]
+            cmd("delete %d old snapshot(s) from '%s' (%s to %s)" %
+                (len(batch), location, batch[0], batch[-1]),
+                'btrfs', 'subvolume', 'delete', '--commit-after',
+                *(join(location, name) for name in batch))
+            for name in batch:
+                indexed(location, name, present=False)
+    return len(names), freed
+
+
+# # Usage: count, freed = delete_older_than(location, time, min_keep_count,
+# #                                          subvolume)
 # Deletes btrfs snapshots for 'subvolume' at 'location' that are older
 # than 'time', keeping at least the latest 'min_keep_count' regardless
 # of age. Age is determined by the name of the snapshot, expected to
 # be in ISO-8601 format and UTC, as used by the rest of this
 # script. This is useful for deleting old snapshot archives to free up
-# space.
+# space. Returns the same as delete_snaps().
 ##
-# NOTE: time must be given as a datetime object, and utc is assumed.
+# NOTE: 'time' may be a datetime (taken as UTC if naive) or a string
+# for "date --date=STRING" (see parse_time()). Times are compared as
+# UTC datetimes, never as strings.
 def delete_older_than(loc, time, keep, sv):
-    location = join(loc, sanitize(sv))
-    stamp = time.isoformat(timespec='seconds')  # TODO: convert to utc?
-    targets = map(lambda x: join(location, x), sorted(listdir(location)))
-    i = 0
-    while i + keep < len(targets):
-        target = targets[i]
-        # "<" works because ISO-8601 makes chronological and
-        # lexicographical sorting identical.
-        if target < join(location, stamp):
-            cmd("delete old subvolume '%s'" % target,
-                'btrfs', 'subvolume', 'delete', target)
-        else:
-            break
-        i += 1
+    return delete_snaps(join(loc, sanitize(sv)), expired(loc, time, keep, sv))
+
+
+# # Usage: names = expired(location, time, min_keep_count, subvolume)
+# Get the names of the snapshots delete_older_than() deletes, oldest
+# first. Parents copies from 'location' need are kept (see pinned()).
+def expired(loc, time, keep, sv):
+    snaps = stamped(join(loc, sanitize(sv)))
+    stamps = [t for t, _ in snaps]
+    # Everything before the cutoff is old enough to delete.
+    cutoff = min(bisect.bisect_left(stamps, parse_time(time)),
+                 len(snaps) - keep)
+    needed = pinned(loc, sv)
+    return [name for _, name in snaps[:max(0, cutoff)]
+            if name not in needed]
+
+
+# # Usage: snaps = stamped(location)
+# Get (time, name) for each snapshot in 'location' named by its time,
+# oldest first. Other names are left out, so they're never deleted.
+def stamped(location):
+    return sorted((t, name) for name in snaps_in(location)
+                  for t in [parse_stamp(name)] if t is not None)
+
+
+# Set by copy_latest() as the config runs: the directories each
+# snapshot directory is copied to
+COPY_DESTS = {}
+
+# The parent each destination last had, by source and destination
+# directory, loaded from STATE_DIR by sent_parents()
+PARENTS = None
+PARENTS_LOCK = threading.Lock()
+
+
+# # Usage: parents = sent_parents()
+# Get the dict of parents recorded by pinned(), keyed by source and
+# destination snapshot directory, loading it the first time.
+def sent_parents():
+    global PARENTS
+    if PARENTS is None:
+        try:
+            with open(join(STATE_DIR, 'parents.json')) as f:
+                PARENTS = json.load(f)
+        except (OSError, ValueError):
+            PARENTS = {}
+    return PARENTS
+
+
+# # Usage: names = pinned(snap_dir, subvolume)
+# Get the names of the snapshots in snap_dir/sanitized-subvolume that
+# copies need as parents to stay incremental, so pruning keeps them:
+# the newest snapshot each directory it's copied to has, and the
+# newest they all have (see resolve_parents()). Destinations that
+# aren't there (like unplugged drives) count with the parent they had
+# when last seen, saved in STATE_DIR. Copies into snap_dir need the
+# newest snapshot it shares with each of their sources too, as their
+# parent or a clone source, so that's kept as well. Everything else
+# may go.
+def pinned(loc, sv):
+    sv = sanitize(sv)
+    src = join(loc, sv)
+    received = {resolve_parents(src, [join(fro, sv)]).common
+                for fro, tos in COPY_DESTS.items()
+                if loc in tos and os.path.isdir(fro)}
+    tos = sorted(COPY_DESTS.get(loc, ()))
+    if not tos:
+        return received - {None}
+    here = [join(to, sv) for to in tos if os.path.isdir(to)]
+    parents = resolve_parents(src, here)
+    with PARENTS_LOCK:
+        saved = sent_parents()
+        for dst, name in parents.each.items():
+            key = '%s -> %s' % (src, dst)
+            if name is None:
+                saved.pop(key, None)
+            else:
+                saved[key] = name
+        keep = {saved.get('%s -> %s' % (src, join(to, sv)))
+                for to in tos} | {parents.common} | received
+        if not DEBUG:
+            try:
+                os.makedirs(STATE_DIR, exist_ok=True)
+                save_json(join(STATE_DIR, 'parents.json'), saved)
+            except OSError as e:
+                msg("Could not save sent parents: %s" % e)
+    return keep - {None}
+
+
+# Bucketing for retain()'s rules: rule name to a function giving the
+# period a UTC time is in
+PERIODS = {
+    'hourly': lambda t: (t.year, t.month, t.day, t.hour),
+    'daily': lambda t: (t.year, t.month, t.day),
+    'weekly': lambda t: t.isocalendar()[:2],
+    'monthly': lambda t: (t.year, t.month),
+    'yearly': lambda t: t.year,
+}
+
+
+# # Usage: kept = retained(stamps, rules, keep=1)
+# Get the indices of the times in 'stamps' (sorted newest first) that
+# grandfather-father-son 'rules' keep: for each rule name in PERIODS
+# mapped to a count N, the newest time in each of the latest N periods
+# that have any times, like the latest 24 hours with snapshots for
+# {'hourly': 24}. The newest 'keep' times are always kept. Each rule
+# is a single pass over the times, stopping once it has its N, so the
+# whole is linear in the number of times.
+def retained(stamps, rules, keep=1):
+    kept = set(range(min(keep, len(stamps))))
+    for rule, count in rules.items():
+        period = PERIODS[rule]
+        last = None
+        for i, t in enumerate(stamps):
+            if count <= 0:
+                break
+            if period(t) != last:
+                last = period(t)
+                kept.add(i)
+                count -= 1
+    return kept
+
+
+# # Usage: count, freed = delete_unretained(location, subvolume, rules, keep=1)
+# Deletes btrfs snapshots for 'subvolume' at 'location' that 'rules'
+# don't keep (see retained()). Returns the same as delete_snaps().
+def delete_unretained(loc, sv, rules, keep=1):
+    return delete_snaps(join(loc, sanitize(sv)),
+                        unretained(loc, sv, rules, keep))
+
+
+# # Usage: names = unretained(location, subvolume, rules, keep=1)
+# Get the names of the snapshots delete_unretained() deletes, oldest
+# first. Parents copies from 'location' need are kept (see pinned()).
+def unretained(loc, sv, rules, keep=1):
+    snaps = stamped(join(loc, sanitize(sv)))[::-1]
+    kept = retained([t for t, _ in snaps], rules, keep)
+    needed = pinned(loc, sv)
+    return [name for i, (_, name) in reversed([*enumerate(snaps)])
+            if i not in kept and name not in needed]
+
+
+# === free space management ===
+
+# Deletions put off until their space is needed, as (snapshot
+# directory, subvolume, eligible) where eligible(subvolume) gives the
+# names of the snapshots that may be deleted, oldest first. Added by
+# delete_old() and retain() with defer=True.
+DEFERRED = []
+# Free space to leave on top of a send's estimated size, for metadata
+# and estimation error
+SPACE_RESERVE = 1 << 30
+# Sends in progress, each as [device ID, estimated size, snapshot
+# paths it needs], so concurrent sends count each other's space and
+# don't delete each other's parents
+RESERVED = []
+# Locks serializing room-making per device
+SPACE_LOCKS = {}
+SPACE_LOCK = threading.Lock()
+
+# Free space on a filesystem: 'free' is the estimated free space for
+# data, and 'unallocated' the space not yet given to data or metadata
+Space = namedtuple('Space', 'free unallocated')
+
+
+# # Usage: space = free_space(path)
+# Get the Space on the filesystem holding 'path', via 'btrfs filesystem
+# usage', in bytes.
+def free_space(path):
+    out = cmd("get free space on the filesystem holding '%s'" % path,
+              'btrfs', 'filesystem', 'usage', '-b', path,
+              side_effects=False)
+    found = {}
+    for line in out.splitlines():
+        key, _, value = line.strip().partition(':')
+        if value.split() and value.split()[0].isdigit():
+            found.setdefault(key, int(value.split()[0]))
+    return Space(found.get('Free (estimated)', 0),
+                 found.get('Device unallocated', 0))
+
+
+# # Usage: defer_deletes(snap_dir, subvolumes, eligible)
+# Put off deleting the snapshots of 'subvolumes' in 'snap_dir' that
+# eligible(subvolume) gives until a send there needs their space. This
+# is the deferred part of delete_old() and retain().
+def defer_deletes(snap_dir, svs, eligible):
+    if not exists(snap_dir):
+        return False
+    with SPACE_LOCK:
+        DEFERRED.extend((snap_dir, sv, eligible) for sv in svs)
+    msg("Deleting old snapshots from '%s' only as sends need space." %
+        snap_dir)
+    return True
+
+
+# # Usage: deferred(path)
+# Check if the filesystem holding 'path' has any deferred deletions.
+def deferred(path):
+    dev = device(path)
+    return any(device(d) == dev for d, _, _ in DEFERRED if lexists(d))
+
+
+# # Usage: with room(paths, size, needed): ...
+# Make room for a send of about 'size' bytes (None if unknown) on the
+# filesystem holding each of 'paths' before the 'with' block, and hold
+# it until the end. Snapshots 'needed' (relative to each path) are
+# never deleted to make room, by this or any concurrent send.
+@contextmanager
+def room(paths, size, needed=()):
+    held = []
+    for path in paths:
+        entry = [device(path), size or 0, {join(path, n) for n in needed}]
+        with SPACE_LOCK:
+            RESERVED.append(entry)
+        held.append(entry)
+        if size is not None and deferred(path):
+            make_room(path, entry)
+    try:
+        yield
+    finally:
+        with SPACE_LOCK:
+            for entry in held:
+                RESERVED.remove(entry)
+
+
+# # Usage: make_room(path, entry)
+# Delete the oldest snapshots that deferred deletions allow on the
+# filesystem holding 'path', only until there's room for the sends
+# in RESERVED (including 'entry', this send's) plus SPACE_RESERVE.
+# Each batch's space is waited for with 'btrfs subvolume sync' on
+# just its subvolume IDs, since btrfs frees it in the background. If
+# quotas give snapshots' sizes, each batch is just big enough;
+# otherwise snapshots are deleted one at a time.
+def make_room(path, entry):
+    dev = entry[0]
+    with SPACE_LOCK:
+        lock = SPACE_LOCKS.setdefault(dev, threading.Lock())
+    with lock, stage('room', path) as rec:
+        rec['count'] = 0
+        candidates = None
+        while True:
+            space = free_space(path)
+            with SPACE_LOCK:
+                wanted = sum(e[1] for e in RESERVED if e[0] == dev)
+                needed = set().union(*(e[2] for e in RESERVED))
+            short = wanted + SPACE_RESERVE - space.free
+            rec['free'], rec['unallocated'] = space
+            if short <= 0:
+                return
+            if candidates is None:  # Oldest first, across every rule.
+                candidates = sorted(
+                    {(parse_stamp(name), location, name)
+                     for d, sv, eligible in DEFERRED
+                     if lexists(d) and device(d) == dev
+                     for location in [join(d, sanitize(sv))]
+                     for name in eligible(sv)
+                     if join(location, name) not in needed})
+            if not candidates:
+                msg(("Only %s free on the filesystem holding '%s' for " +
+                     "about %s; sending anyway.") %
+                    (human(space.free), path, human(wanted)))
+                return
+            sizes = exclusive_sizes(path)
+            svs = subvolumes(path)
+            batch, ids, freed = [], [], 0
+            while candidates and (not batch or sizes and freed < short):
+                _, location, name = candidates.pop(0)
+                sv = svs.get(join(basename(location), name))
+                freed += sizes.get(sv.id, 0) if sv else 0
+                batch.append((location, name))
+                sv and ids.append(str(sv.id))
+            msg("Making room on '%s' with %s free for about %s." %
+                (path, human(space.free), human(wanted)))
+            for location in sorted({location for location, _ in batch}):
+                count, size = delete_snaps(location, [
+                    name for loc, name in batch if loc == location])
+                rec['count'] += count
+                rec['bytes'] += size
+            cmd("wait for btrfs to free %d deleted snapshot(s) on '%s'" %
+                (len(batch), path), 'btrfs', 'subvolume', 'sync', path, *ids)
 
 
 # === high-level snapshot actions ===
@@ -446,43 +3267,740 @@ def delete_older_than(loc, time, keep, sv):
 # 'from'. This is directly useful for being able to revert file
 # changes (which is _NOT_ a backup!), and the snapshots are useful for
 # (incrementally) copying subvolumes to other devices for real
-# backups.
+# backups. Subvolumes are snapshotted in parallel, limited by
+# set_jobs(), and then synced together. Subvolumes that haven't
+# changed since their latest snapshot are skipped (see snapshot()).
 def make_snaps(fro, to, *svs):
     if not exists(fro, to):
         return False
-    for sv in svs:
-        snapshot(fro, to, sv)
+    if PLAN is not None:
+        for sv in svs:
+            plan_action('snapshot', join(to, sv),
+                        lambda sv=sv: snapshot(fro, to, sv), (fro, to),
+                        reads=[join(fro, sv)], writes=[(to, sv)])
+        plan_action('sync', to, lambda: sync_snaps(fro, to, *svs),
+                    (to,), writes=[(to, sv) for sv in svs])
+        return True
+    ok = run_parallel('snapshot', lambda sv: snapshot(fro, to, sv),
+                      svs, fro, to)
+    sync_snaps(fro, to, *svs)
+    return ok
+
+
+# # Usage: sync_snaps(fro, to, *subvolumes)
+# Sync the snapshots make_snaps() just made, if any (so not when every
+# subvolume was unchanged).
+def sync_snaps(fro, to, *svs):
+    if not any(TIMESTAMP in snaps_in(join(to, sanitize(sv))) for sv in svs):
+        return
+    # TODO: Remove sync when cloning stops requiring it after
+    # snapshots. See
+    # https://btrfs.wiki.kernel.org/index.php/Incremental_Backup#Initial_Bootstrapping
+    sync_fs("so 'btrfs send' works later", to)
 
 
-# # Usage: copy_latest(fro, to, *subvolumes)
+# # Usage: copy_latest(fro, to, *subvolumes, staging=None)
 # Copy the latest snapshot for each given subvolume in 'from' to
 # 'to'. This is useful for real backups, (incrementally) copying
-# entire subvolumes between devices.
-def copy_latest(fro, to, svs):
+# entire subvolumes between devices. Subvolumes are copied in
+# parallel, limited by set_jobs() for both the 'from' and 'to'
+# devices. With 'staging', streams are spooled through that directory
+# in resumable chunks, for slow or unreliable 'to' devices. 'to' may
+# be a list of directories to copy to, reading 'from' only once for
+# all of them that have the same parent snapshot; those not found
+# (like unplugged drives) are skipped.
+##
+# NOTE: A planned copy only declares its own subvolume's directories,
+# so copies of different subvolumes run at once. The parent and clone
+# sources it picks are kept from pruning by claim() and pinned().
+def copy_latest(fro, to, *svs, staging=None):
+    COPY_DESTS.setdefault(fro, set()).update([to] if isinstance(to, str)
+                                             else to)
+    tos = [to] if isinstance(to, str) else [t for t in to if exists(t)]
+    if not tos or not exists(fro, *tos):
+        return False
+    if PLAN is not None:
+        for sv in svs:
+            plan_action('copy', join(tos[-1], sv),
+                        lambda sv=sv: clone_or_update(fro, tos, sv, staging),
+                        (fro, *tos), reads=[(fro, sv)],
+                        writes=[(t, sv) for t in tos])
+        return True
+    return run_parallel('copy',
+                        lambda sv: clone_or_update(fro, tos, sv, staging),
+                        svs, fro, *tos)
+
+
+# # Usage: archive_latest(fro, to, *subvolumes, compress='zstd')
+# Archive the latest snapshot for each given subvolume in 'from' as
+# compressed send streams in 'to', which can be any filesystem. This
+# is useful for backups to drives that aren't formatted as btrfs. Use
+# restore_archive() to get the snapshots back.
+def archive_latest(fro, to, *svs, compress='zstd'):
     if not exists(fro, to):
         return False
-    for sv in svs:
-        clone_or_update(fro, to, sv)
+    if compress not in COMPRESSORS:
+        fatal("Unknown compression '%s'." % compress)
+    if PLAN is not None:
+        for sv in svs:
+            plan_action('archive', join(to, sv),
+                        lambda sv=sv: archive(fro, to, sv, compress),
+                        (fro, to), reads=[(fro, sv)], writes=[(to, sv)])
+        return True
+    return run_parallel('archive', lambda sv: archive(fro, to, sv, compress),
+                        svs, fro, to)
+
+
+# # Usage: dedup_latest(fro, to, *subvolumes, compress=True)
+# Save the latest snapshot for each given subvolume in 'from' as a
+# full send stream in the deduplicating store 'to', which can be any
+# filesystem and is shared by all subvolumes saved there (see
+# dedup()). Unlike archive_latest(), every snapshot saved can be
+# restored by itself with restore_dedup(), while only taking the space
+# of what changed.
+def dedup_latest(fro, to, *svs, compress=True):
+    if not exists(fro, to):
+        return False
+    if PLAN is not None:
+        for sv in svs:
+            plan_action('dedup', join(to, sv),
+                        lambda sv=sv: dedup(fro, to, sv, compress),
+                        (fro, to), reads=[(fro, sv)], writes=[(to, sv)])
+        return True
+    return run_parallel('dedup', lambda sv: dedup(fro, to, sv, compress),
+                        svs, fro, to)
+
+
+# # Usage: restore_from(fro, to, *targets)
+# Restore snapshots from the backups in 'fro' into 'to'. Each target
+# is a subvolume directory in 'fro' (like '@home-kelci'), for its
+# newest snapshot, or that and a snapshot name, like
+# '@home/2026-04-01T00:00:00+00:00'. With no targets, the newest
+# snapshot of every subvolume is restored. 'fro' may be a btrfs backup
+# directory (see restore_snapshots()), a stream archive (see
+# restore_archive()), or a deduplicating store (see restore_dedup()).
+# Subvolumes are restored in parallel. Returns True iff all worked.
+def restore_from(fro, to, *targets):
+    if not exists(fro, to):
+        return False
+    wanted = {}  # snapshot names by subvolume
+    for target in targets or sorted(
+            d for d in snaps_in(fro)
+            if d != 'packs' and os.path.isdir(join(fro, d))):
+        sv, _, name = target.partition('/')
+        wanted.setdefault(sv, [])
+        name and wanted[sv].append(name)
+
+    def restore(sv):
+        with locked_dirs(reads=[(fro, sv)], writes=[(to, sv)]):
+            restore_one(sv)
+
+    def restore_one(sv):
+        if lexists(join(fro, 'chunks.db')):
+            for name in wanted[sv] or [None]:
+                restore_dedup(fro, to, sv, name)
+        elif lexists(join(fro, sv, 'manifest.json')):
+            for name in sorted(wanted[sv]) or [None]:
+                restore_archive(fro, to, sv, name)
+        else:
+            restore_snapshots(fro, to, sv, wanted[sv])
+    return run_parallel('restore', restore, [*wanted], fro, to)
 
 
-# # Usage: delete_old(snap_dir, time, *subvolumes, keep=1)
+# # Usage: delete_old(snap_dir, time, *subvolumes, keep=1, defer=False)
 # Delete snapshots older than 'time' from 'snap_dir', keeping at least
 # the latest 'min_keep_count' snapshots regardless of age. 'time' is a
 # date/time string as used by "date --date=STRING". For example, a
 # time of "3 days ago" will delete snapshots which are more than 3
 # days old. This is useful when the device for 'from' doesn't have
 # much space and the device for 'to' acts as an archive of the old
-# states of 'from'.
-def delete_old(snap_dir, time, *svs, keep=1):
+# states of 'from'. With 'defer', they're only deleted as sends to
+# 'snap_dir' need their space, oldest first (see defer_deletes()).
+def delete_old(snap_dir, time, *svs, keep=1, defer=False):
+    if defer:
+        return defer_deletes(snap_dir, svs,
+                             lambda sv: expired(snap_dir, time, keep, sv))
+    return prune(snap_dir, svs,
+                 lambda sv: delete_older_than(snap_dir, time, keep, sv))
+
+
+# # Usage: retain(snap_dir, *subvolumes, hourly=24, daily=14, weekly=8,
+# #               monthly=12, yearly=0, keep=1, defer=False)
+# Delete snapshots from 'snap_dir' except those that
+# grandfather-father-son rules keep: the newest snapshot of each of
+# the last 'hourly' hours, 'daily' days, and so on that have any
+# (periods being in UTC), plus the latest 'keep' regardless. This
+# thins out old snapshots instead of keeping all or none of them.
+# 'defer' works as for delete_old().
+def retain(snap_dir, *svs, hourly=24, daily=14, weekly=8, monthly=12,
+           yearly=0, keep=1, defer=False):
+    rules = {'hourly': hourly, 'daily': daily, 'weekly': weekly,
+             'monthly': monthly, 'yearly': yearly}
+    if defer:
+        return defer_deletes(snap_dir, svs,
+                             lambda sv: unretained(snap_dir, sv, rules, keep))
+    return prune(snap_dir, svs,
+                 lambda sv: delete_unretained(snap_dir, sv, rules, keep))
+
+
+# # Usage: prune(snap_dir, subvolumes, delete)
+# Run delete(subvolume) for each of 'subvolumes' in 'snap_dir', then
+# sync to free their space. 'delete' returns the same as
+# delete_snaps(). This is the common part of delete_old() and retain().
+def prune(snap_dir, svs, delete):
     if not exists(snap_dir):
         return False
+    if PLAN is not None:
+        for sv in svs:
+            plan_action('prune', join(snap_dir, sv),
+                        lambda sv=sv: delete(sv),
+                        (snap_dir,), writes=[(snap_dir, sv)])
+        plan_action('sync', snap_dir,
+                    lambda: sync_fs("to free deleted snapshots' space",
+                                    snap_dir),
+                    (snap_dir,), writes=[(snap_dir, sv) for sv in svs])
+        return True
+    count = freed = 0
     for sv in svs:
-        delete_older_than(snap_dir, time, keep, sv)
-    # Sync everything to free up cleared space.
-    cmd("sync '$1' to free deleted snapshots' space",
-        'btrfs', 'filesystem', 'sync', snap_dir)
+        deleted, size = delete(sv)
+        count += deleted
+        freed += size
+    msg("Deleted %d old snapshot(s) from '%s', reclaiming %s." %
+        (count, snap_dir,
+         human(freed) if freed or not count else 'an unknown amount'))
+    # Sync to free up cleared space.
+    sync_fs("to free deleted snapshots' space", snap_dir)
     # TODO: remove message when/if obsolete
     msg("Note that btrfs' cleanup of freed space may take a while longer.")
+    return True
+
+
+# === plan scheduling ===
+
+# One planned action: a 'kind' of work (snapshot, sync, copy, archive,
+# or prune) on 'target', done by func(). 'paths' are where it uses
+# device slots, and 'reads' and 'writes' are the snapshot directories
+# it uses, as paths. 'deps' are the earlier actions it must wait for.
+Action = namedtuple('Action', 'id kind target func paths reads writes deps')
+
+
+# # Usage: resource(place)
+# Get the path naming a snapshot directory, given either a path or a
+# (snapshot_dir, subvol) pair, so both spellings of it compare equal.
+def resource(place):
+    if isinstance(place, tuple):
+        place = join(place[0], sanitize(place[1]))
+    return os.path.normpath(place)
+
+
+# # Usage: plan_action(kind, target, func, paths, reads=(), writes=())
+# Add an action to PLAN, depending on every earlier action that writes
+# anything it reads or writes, or reads anything it writes. Because
+# the config's order is kept for conflicting actions, a snapshot can't
+# be pruned until it's been sent, and is kept as the next parent.
+def plan_action(kind, target, func, paths, reads=(), writes=()):
+    reads = {resource(p) for p in reads}
+    writes = {resource(p) for p in writes}
+    deps = {a.id for a in PLAN
+            if writes & (a.reads | a.writes) or reads & a.writes}
+    PLAN.append(Action(len(PLAN) + 1, kind, target, func, paths, reads,
+                       writes, deps))
+
+
+# Where locked() keeps lock files, one per snapshot directory
+LOCK_DIR = '/run/lock/backup-btrfs2'
+# Locks this process holds, by snapshot directory, as [file descriptor,
+# number of actions holding it]
+LOCKS = {}
+LOCKS_LOCK = threading.Lock()
+
+
+# # Usage: with locked(action): ...
+# Hold a shared lock on each snapshot directory 'action' reads and an
+# exclusive one on each it writes, so another run (like a daemon's
+# and a manual one, or an hourly run while yesterday's slow copy to an
+# external drive goes on) waits only for actions using the same
+# snapshot directories. Waits are timed as 'lock' stages. Actions in
+# this process share its locks, since the plan already orders them.
+##
+# NOTE: These are flock() locks, so they're released when the process
+# ends, even if it's killed. They're acquired in path order, so runs
+# can't deadlock each other. Debug runs don't lock anything, since
+# they don't change anything.
+@contextmanager
+def locked(action):
+    if DEBUG:
+        yield
+        return
+    modes = {**{r: fcntl.LOCK_SH for r in action.reads},
+             **{w: fcntl.LOCK_EX for w in action.writes}}
+    held = []
+    try:
+        for place, mode in sorted(modes.items()):
+            with LOCKS_LOCK:
+                if place in LOCKS:
+                    LOCKS[place][1] += 1
+                    held.append(place)
+                    continue
+            fd = open_lock(escape_path(place) + '.lock')
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                msg("Waiting for another run using '%s'." % place)
+                with stage('lock', place):
+                    fcntl.flock(fd, mode)
+            with LOCKS_LOCK:
+                LOCKS[place] = [fd, 1]
+            held.append(place)
+        yield
+    finally:
+        with LOCKS_LOCK:
+            for place in held:
+                LOCKS[place][1] -= 1
+                if not LOCKS[place][1]:
+                    os.close(LOCKS.pop(place)[0])  # which unlocks it
+
+
+# # Usage: fd = open_lock(name)
+# Open lock file 'name' in LOCK_DIR (as made by init()), first making
+# it if it's not there. Exits script if it can't.
+##
+# NOTE: LOCK_DIR is sticky and world-writable, like /tmp, so runs as
+# any user can make lock files there. Where fs.protected_regular is
+# set, opening another user's file there with O_CREAT fails even if
+# it exists, so files are only opened with O_CREAT (and O_EXCL) when
+# they're not there yet. They're made mode 0666 so anyone can open
+# them, though flock() only needs read access.
+def open_lock(name):
+    path = join(LOCK_DIR, name)
+    while True:
+        try:
+            return os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            fatal("Could not open lock file '%s': %s" % (path, e))
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue  # Another run just made it.
+        except OSError as e:
+            fatal("Could not make lock file '%s': %s" % (path, e))
+        os.fchmod(fd, 0o666)  # regardless of umask
+        return fd
+
+
+# # Usage: with locked_dirs(reads=(), writes=()): ...
+# Lock snapshot directories (as paths or (snapshot_dir, subvol) pairs)
+# as locked() does for a planned action's, for work done outside a
+# plan, like restoring or verifying backups.
+@contextmanager
+def locked_dirs(reads=(), writes=()):
+    with locked(Action(0, 'use', None, None, (),
+                       {resource(p) for p in reads},
+                       {resource(p) for p in writes}, set())):
+        yield
+
+
+# # Usage: ok = run_action(action)
+# Run a planned action once it has the locks it needs (see locked())
+# and device slots for all its paths, timing it as a stage. Returns
+# whether it worked.
+##
+# NOTE: Device semaphores are acquired in device ID order, as in
+# run_parallel(), so concurrent actions can't deadlock each other.
+def run_action(action):
+    held = sorted(dict(slots(p) for p in action.paths).items())
+    try:
+        with locked(action):
+            for _, sem in held:
+                sem.acquire()
+            try:
+                if action.kind == 'sync':  # sync_fs() times each itself.
+                    action.func()
+                else:
+                    with stage(action.kind, action.target):
+                        action.func()
+                return True
+            finally:
+                for _, sem in reversed(held):
+                    sem.release()
+    except SystemExit:  # fatal() already said what went wrong.
+        return False
+    except Exception as e:
+        msg("Could not %s '%s': %s" % (action.kind, action.target, e))
+        return False
+
+
+# # Usage: ok = run_plan(actions)
+# Run planned actions, each as soon as the actions it depends on are
+# done, so independent branches (like sends between other drives)
+# overlap within set_jobs() limits. Actions depending on a failed
+# action are skipped.
+# Returns True iff every action ran and worked.
+def run_plan(actions):
+    waiting = {a.id: a for a in actions}
+    done, failed = set(), set()
+    with ThreadPoolExecutor(max_workers=max(1, len(actions))) as pool:
+        running = {}
+        while waiting or running:
+            for a in [*waiting.values()]:
+                if a.deps & failed:
+                    msg("Skipping %s '%s' since #%d failed." %
+                        (a.kind, a.target, min(a.deps & failed)))
+                    failed.add(waiting.pop(a.id).id)
+                elif a.deps <= done:
+                    running[pool.submit(run_action, a)] = waiting.pop(a.id)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                a = running.pop(future)
+                (done if future.result() else failed).add(a.id)
+    if failed:
+        msg("%d of %d planned action(s) failed or were skipped." %
+            (len(failed), len(actions)))
+    return not failed
+
+
+# # Usage: ok = scheduled(config)
+# Run config() (like apply_config() for the config) to plan its
+# actions, then run the plan.
+def scheduled(config):
+    global PLAN
+    PLAN = []
+    try:
+        config()
+        actions = PLAN
+    finally:
+        PLAN = None
+    return run_plan(actions)
+
+
+# # Usage: costs = last_costs()
+# Get how many seconds each (stage, target) took in the last run
+# report, if any, for predicting how long planned actions take.
+def last_costs():
+    try:
+        with open(REPORT_PATH) as f:
+            stages = json.load(f)['stages']
+    except (TypeError, OSError, ValueError, KeyError):
+        return {}
+    costs = {}
+    for r in stages:
+        key = (r['stage'], r['target'])
+        costs[key] = costs.get(key, 0) + r['seconds']
+    return costs
+
+
+# # Usage: show_plan(actions)
+# Print each planned action with what it directly waits for and its
+# predicted duration, then the critical path: the chain of dependent
+# actions predicted to take longest, which bounds the run's wall time.
+def show_plan(actions):
+    costs = last_costs()
+    cost, finish, before, above = {}, {}, {}, {}
+    for a in actions:  # Dependencies always come first.
+        cost[a.id] = costs.get((a.kind, a.target), DEFAULT_COSTS[a.kind])
+        above[a.id] = set(a.deps).union(*(above[d] for d in a.deps))
+        before[a.id] = max(a.deps, key=finish.get, default=None)
+        finish[a.id] = cost[a.id] + finish.get(before[a.id], 0)
+    msg("Plan (%d actions):" % len(actions))
+    for a in actions:
+        # Leave out dependencies implied by other dependencies.
+        direct = sorted(d for d in a.deps
+                        if not any(d in above[e] for e in a.deps))
+        msg(("  #%-3d %-8s %-40s %8.1fs  %s" %
+             (a.id, a.kind, a.target, cost[a.id],
+              'after ' + ', '.join('#%d' % d for d in direct)
+              if direct else '')).rstrip())
+    if not actions:
+        return
+    path = [max(finish, key=finish.get)]
+    while before[path[-1]] is not None:
+        path.append(before[path[-1]])
+    msg("Critical path (%.1fs, vs %.1fs for everything in order):" %
+        (finish[path[0]], sum(cost.values())))
+    for i in reversed(path):
+        a = actions[i - 1]
+        msg("  #%-3d %-8s %s" % (a.id, a.kind, a.target))
+
+
+# === config applying ===
+
+# # Usage: apply_config(compiled)
+# Run a config compiled by compile_config(): apply its settings, then
+# call the high-level action for each of its actions, in order. Within
+# scheduled(), that plans the actions instead of running them.
+def apply_config(compiled):
+    settings = compiled['settings']
+    match_uuids(settings.get('match_uuids', False))
+    estimate_sends(settings.get('estimate_sends', True))
+    hash_streams(settings.get('hash_streams', False))
+    DEVICE_JOBS.clear()
+    for path, count in compiled['jobs'].items():
+        set_jobs(path, count)
+    THROTTLES.clear()
+    COPY_DESTS.clear()
+    DEFERRED.clear()
+    for limits in compiled['throttles']:
+        throttle(**limits)
+    for action in compiled['actions']:
+        args = dict(action)
+        do, svs = args.pop('do'), args.pop('subvolumes')
+        if do == 'snapshot':
+            make_snaps(args['from'], args['to'], *svs)
+        elif do == 'copy':
+            copy_latest(args.pop('from'), args.pop('to'), *svs, **args)
+        elif do == 'archive':
+            archive_latest(args.pop('from'), args.pop('to'), *svs, **args)
+        elif do == 'dedup':
+            dedup_latest(args.pop('from'), args.pop('to'), *svs, **args)
+        elif do == 'delete':
+            delete_old(args.pop('in'), args.pop('older_than'), *svs, **args)
+        elif do == 'retain':
+            retain(args.pop('in'), *svs, **args)
+        else:
+            fatal("WTF? (config action %s)" % do)
+
+
+# === daemon mode ===
+
+# Minutes between a daemon's scheduled runs, unless its config's
+# [daemon] table says otherwise
+DAEMON_INTERVAL = 60
+# Where a daemon answers status requests, unless its config's [daemon]
+# table says otherwise
+STATUS_SOCKET = '/run/backup-btrfs2.sock'
+# Seconds to wait after a mount before running, for the mount to settle
+MOUNT_SETTLE = 5
+# The daemon's state, as reported by status requests
+DAEMON = {}
+
+
+# # Usage: start_run()
+# Reset per-run state before each run: a new TIMESTAMP for new
+# snapshots, no stages or skipped subvolumes yet, and no cached
+# snapshot directory listings that may be out of date. Directories
+# whose modification time hasn't changed keep theirs, so a daemon's
+# runs only rescan what changed.
+def start_run():
+    global TIMESTAMP
+    TIMESTAMP = datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec='seconds')
+    del STAGES[:], SKIPPED[:]
+    if TRACE is not None:
+        write_trace({'kind': 'run', 'goal': 'run at %s' % TIMESTAMP,
+                     'commands': [argv], 'thread': 'MainThread',
+                     'start': time.time(), 'seconds': 0,
+                     'pid': os.getpid()})
+    with INDEX_LOCK:
+        for dir, mtime in [*SNAP_MTIMES.items()]:
+            try:
+                current = stat(dir).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                SNAP_INDEX.pop(dir, None)
+                del SNAP_MTIMES[dir]
+        SUBVOL_INDEX.clear()
+
+
+# # Usage: points = mount_points()
+# Get the set of paths things are mounted on, from /proc/self/mounts.
+def mount_points():
+    with open('/proc/self/mounts') as f:
+        return {re.sub(r'\\([0-7]{3})', lambda m: chr(int(m[1], 8)),
+                       line.split()[1]) for line in f}
+
+
+# # Usage: paths = config_paths(compiled)
+# Get every path the actions of a compiled config use.
+def config_paths(compiled):
+    return {p for action in compiled['actions']
+            for key in ('from', 'to', 'in', 'staging')
+            for p in ([action[key]] if isinstance(action.get(key), str)
+                      else action.get(key, ()))}
+
+
+# # Usage: serve(load, reload=None)
+# Run as a daemon: run backups for the config load() gives every
+# [daemon] 'interval' minutes, and also as soon as something is
+# mounted on or above a path the config uses (like an external drive
+# being plugged in). The config and the snapshot directory index stay
+# loaded between runs (see start_run()). On SIGHUP, the config is
+# loaded again with reload() (default load()) once any run in
+# progress is done, along with its [daemon] options. Each status
+# request on the [daemon] 'socket' gets the daemon's state as JSON.
+# Runs until SIGTERM or SIGINT.
+##
+# NOTE: Backups run in a separate thread, so the main thread can
+# answer status requests and notice mounts and signals meanwhile.
+def serve(load, reload=None):
+    global REPORT_PATH, METRICS_PATH
+    compiled = load()
+    options = compiled.get('daemon', {})
+    path = options.get('socket', STATUS_SOCKET)
+    interval = options.get('interval', DAEMON_INTERVAL) * 60
+    REPORT_PATH, METRICS_PATH = compiled['report'], compiled['metrics']
+    DAEMON.update({'pid': os.getpid(), 'config': compiled['config'],
+                   'state': 'idle', 'runs': 0, 'started': None,
+                   'last': None,
+                   'next': time.time(), 'reason': 'startup'})
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signals = []
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda sig, _: signals.append(sig))
+    server = status_socket(path)
+    mounts = open('/proc/self/mounts')
+    mounted = mount_points()
+    poller = select.poll()
+    poller.register(wake_r, select.POLLIN)
+    poller.register(server, select.POLLIN)
+    poller.register(mounts, select.POLLPRI)
+    worker = None
+    reloading = False
+    msg("Running as a daemon, every %d minute(s), with status on '%s'." %
+        (interval // 60, path))
+    try:
+        while True:
+            if worker and not worker.is_alive():
+                worker = None
+                DAEMON['state'] = 'idle'
+            if reloading and not worker:
+                msg("Reloading config.")
+                compiled = (reload or load)()
+                REPORT_PATH, METRICS_PATH = (compiled['report'],
+                                             compiled['metrics'])
+                options = compiled.get('daemon', {})
+                interval = options.get('interval', DAEMON_INTERVAL) * 60
+                DAEMON['next'] = min(DAEMON['next'], time.time() + interval)
+                if options.get('socket', STATUS_SOCKET) != path:
+                    poller.unregister(server)
+                    server.close()
+                    lexists(path) and os.unlink(path)
+                    path = options.get('socket', STATUS_SOCKET)
+                    server = status_socket(path)
+                    poller.register(server, select.POLLIN)
+                    msg("Status is now on '%s'." % path)
+                with SLOTS_LOCK:
+                    SLOTS.clear()  # for new set_jobs() limits
+                reloading = False
+            if not worker and time.time() >= DAEMON['next']:
+                worker = threading.Thread(target=daemon_run,
+                                          args=(compiled,), daemon=True)
+                DAEMON['next'] = time.time() + interval
+                DAEMON['state'] = 'running'
+                worker.start()
+            wait_ms = (1000 if worker else
+                       max(0, DAEMON['next'] - time.time()) * 1000)
+            for fd, _ in poller.poll(wait_ms):
+                if fd == wake_r:
+                    os.read(wake_r, 512)
+                elif fd == server.fileno():
+                    client, _ = server.accept()
+                    with client:
+                        client.sendall(json.dumps(DAEMON).encode() + b'\n')
+                else:  # The mount table changed.
+                    mounts.seek(0)
+                    mounts.read()
+                    now = mount_points()
+                    new = now - mounted
+                    mounted = now
+                    if any(p == m or p.startswith(m.rstrip('/') + '/')
+                           for m in new for p in config_paths(compiled)):
+                        msg("Running soon since '%s' was mounted." %
+                            "', '".join(sorted(new)))
+                        DAEMON['reason'] = 'mount'
+                        DAEMON['next'] = min(DAEMON['next'],
+                                             time.time() + MOUNT_SETTLE)
+            while signals:
+                sig = signals.pop()
+                if sig == signal.SIGHUP:
+                    reloading = True
+                    DAEMON['reason'] = 'reload'
+                else:
+                    msg("Stopping daemon%s." %
+                        (" after the current run" if worker else ''))
+                    if worker:
+                        worker.join()
+                    return
+    finally:
+        signal.set_wakeup_fd(-1)
+        server.close()
+        mounts.close()
+        if lexists(path):
+            os.unlink(path)
+
+
+# # Usage: server = status_socket(path)
+# Listen for serve()'s status requests on a Unix socket at 'path',
+# replacing any left by an earlier daemon. Anyone may connect, so
+# 'backup-btrfs status' works for users other than the daemon's.
+def status_socket(path):
+    if lexists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o666)
+    server.listen()
+    return server
+
+
+# # Usage: compiled = cached_config(fallback)
+# Get the config compiled_config() last compiled and cached in
+# STATE_DIR, or 'fallback' if there's none of this version. This is
+# how the installed daemon reloads, since it can't compile the config
+# itself. Warns if the config file has changed since it was compiled.
+def cached_config(fallback):
+    try:
+        with open(join(STATE_DIR, 'config.json')) as f:
+            compiled = json.load(f)
+        if compiled['version'] != COMPILED_VERSION:
+            raise ValueError('compiled by another version')
+    except (OSError, ValueError, KeyError) as e:
+        msg("Could not load the compiled config from '%s' (%s), so "
+            "keeping the current one." % (STATE_DIR, e))
+        return fallback
+    try:
+        with open(compiled['config'], 'rb') as f:
+            stale = hashlib.blake2b(f.read()).hexdigest() != \
+                compiled['digest']
+    except OSError:
+        stale = False  # Nothing newer to compile, then.
+    if stale:
+        msg("Config '%s' has changed since it was compiled; run "
+            "'backup-btrfs plan' to compile it, then reload again." %
+            compiled['config'])
+    return compiled
+
+
+# # Usage: daemon_run(compiled)
+# Run backups once for serve(), recording how it went in DAEMON.
+def daemon_run(compiled):
+    start_run()
+    DAEMON['started'] = time.time()
+    ok = False
+    try:
+        ok = scheduled(lambda: apply_config(compiled))
+    except SystemExit:  # fatal() already said what went wrong.
+        pass
+    except Exception as e:
+        msg("Backup run failed: %s" % e)
+    finally:
+        summary()
+        try:
+            report(ok)
+        except OSError as e:
+            msg("Could not save run report: %s" % e)
+        DAEMON['runs'] += 1
+        DAEMON['last'] = {'timestamp': TIMESTAMP, 'ok': ok,
+                          'start': DAEMON['started'], 'end': time.time(),
+                          'reason': DAEMON['reason'],
+                          'skipped': len(SKIPPED), 'stages': len(STAGES)}
+        DAEMON['reason'] = 'schedule'
 
 
 # === initial checks and setup ===
@@ -491,45 +4009,44 @@ def delete_old(snap_dir, time, *svs, keep=1):
 # Runs initialization for the script. This should be called by main()
 # and only main(), once and only once.
 def init():
-    global LOCKDIR, TIMESTAMP
+    global SUDO, TRACE_PATH
     # Notify of debug mode if active
     if DEBUG:
         msg("Debug mode active. External commands will not really be ran.")
     # Also notify of VERBOSITY level if it's high enough
     dbg("VERBOSITY=%s" % VERBOSITY)
 
+    # No need to sudo pipeline commands when ran as root, as by systemd.
+    if os.geteuid() == 0:
+        SUDO = []
+
     # Check that required programs are installed.
-    deps = ("btrfs cat chmod cp date find get-config get-data mkdir" +
-            "mktemp readlink rm rmdir sleep sudo sync systemctl").split(' ')
-    # TODO: sh->py
-    cmd_eval("make sure commands exist:\n\t%s" % deps,
-             'type', '-P', *deps)  # TODO: supress output
-
-    # Check lock directory to prevent parallel runs.
-    LOCKDIR = "/tmp/.backup-btrfs.lock"
-    cmd("acquire lock", 'mkdir', LOCKDIR)
-    # This is the only copy of the script running. Make sure we'll
-    # clean up at the end.
-    # TODO: sh->py
-    add_exit_trap("cmd 'remove lock directory' rmdir '$LOCKDIR'")
-
-    # This loop repeatedly runs "sudo -v" to keep sudo from timing
-    # out, enabling the script to continue as long as necessary,
-    # without pausing for credentials.
-    ##
-    # Note: It's not necessary to explicitly activate sudo mode first,
-    # since the lock acquisition already uses sudo.
-    ##
-    # TODO: sh->py
-    # msg "Starting sudo-refreshing loop."
-    # ( while true; do
-    #      cmd "wait just under a minute" sleep 50
-    #      cmd-eval "refresh sudo timeout" "sudo -v"
-    #  done; ) >/dev/null &
-    # add-exit-trap "kill $! # sudo-refreshing loop"
+    deps = ("btrfs cat chmod cp date find get-config get-data mkdir " +
+            "mktemp readlink rm rmdir sleep sudo systemctl").split(' ')
+    cmd_eval("make sure commands exist:\n\t%s" % ' '.join(deps),
+             'all(shutil.which(dep) for dep in deps)',
+             globals=globals(), locals=locals())
+
+    # Start one root helper for all root commands, instead of running
+    # (and maybe authenticating) sudo for each one.
+    if SUDO:
+        start_helper()
+        add_exit_trap(stop_helper)
+
+    # Make the directory for locked()'s lock files, which any user's
+    # runs may add to. /run is emptied on each boot.
+    if not DEBUG and not os.path.isdir(LOCK_DIR):
+        cmd_batch("make lock directory '%s'" % LOCK_DIR,
+                  [['mkdir', '-p', LOCK_DIR], ['chmod', '1777', LOCK_DIR]])
+
+    # Record every command ran, if asked to.
+    if os.environ.get('BACKUP_BTRFS2_TRACE'):
+        TRACE_PATH = os.environ['BACKUP_BTRFS2_TRACE']
+    if TRACE_PATH:
+        start_trace(TRACE_PATH)
 
     # Get timestamp for new snapshots.
-    TIMESTAMP = datetime.utcnow().timeformat(timespec='seconds')
+    start_run()
 
 
 # Do not change the autogen stop line without also changing install()
@@ -540,69 +4057,451 @@ def init():
 
 # Returns the the path of the script's config file.
 def get_config_path():
-    return Command('get-config')('backup-btrfs2/control_script.py', '-path')
+    return str(Command('get-config')('backup-btrfs2/config.toml',
+                                     '-path')).strip()
 
 
-# Returns text containing the contents of the config file.
-def get_config():
-    with open(get_config_path(), 'rt') as f:
-        cfg = ''
-        for line in f:
-            cfg += line
-        return cfg
+# Returns the contents of the config file at 'path', as bytes.
+def get_config(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Keys allowed in each kind of config table: a dict of required keys
+# and a dict of optional ones, each giving the allowed type(s)
+##
+# NOTE: list() is this script's own, so ARRAY is the list type.
+ARRAY = type([])
+ACTION_KEYS = {
+    'snapshot': ({'from': str, 'to': str}, {}),
+    'copy': ({'from': str, 'to': (str, ARRAY)}, {'staging': str}),
+    'archive': ({'from': str, 'to': str}, {'compress': str}),
+    'dedup': ({'from': str, 'to': str}, {'compress': bool}),
+    'delete': ({'in': str, 'older_than': str}, {'keep': int, 'defer': bool}),
+    'retain': ({'in': str}, {'hourly': int, 'daily': int, 'weekly': int,
+                             'monthly': int, 'yearly': int, 'keep': int,
+                             'defer': bool}),
+}
+THROTTLE_KEYS = ({'dest': str},
+                 {'rate': (str, int), 'window': ARRAY, 'ionice': str,
+                  'weight': int, 'latency': (int, float)})
+CONFIG_KEYS = ({}, {'subvolumes': dict, 'report': dict, 'settings': dict,
+                    'jobs': dict, 'throttle': ARRAY, 'action': ARRAY,
+                    'daemon': dict})
+REPORT_KEYS = ({}, {'json': str, 'prometheus': str})
+SETTINGS_KEYS = ({}, {'match_uuids': bool, 'estimate_sends': bool,
+                      'hash_streams': bool})
+DAEMON_KEYS = ({}, {'interval': int, 'socket': str})
+
+
+# # Usage: check_keys(what, table, keys)
+# Check that config 'table' has every required key in 'keys' (a pair of
+# required and optional keys, as in ACTION_KEYS) and no others, each
+# of the right type. Exits script with an error about 'what' if not.
+def check_keys(what, table, keys):
+    if not isinstance(table, dict):
+        fatal("Config %s should be a table." % what)
+    required, optional = keys
+    for key in required:
+        if key not in table:
+            fatal("Config %s is missing '%s'." % (what, key))
+    for key, value in table.items():
+        kind = required.get(key, optional.get(key))
+        if kind is None:
+            fatal("Config %s has unknown key '%s'." % (what, key))
+        # TOML booleans are Python ints too, but not the other way.
+        if (not isinstance(value, kind) or isinstance(value, bool) and
+                bool not in (kind if isinstance(kind, tuple) else (kind,))):
+            fatal("Config %s has the wrong type of value for '%s'." %
+                  (what, key))
+
+
+# # Usage: compiled = compile_config(path, text)
+# Parse and validate the TOML config 'text' from 'path', and compile it
+# into a dict of plain settings and actions for apply_config(), with
+# subvolume set names expanded and sizes and paths checked. This is
+# done once per config change, so runs needn't parse or check it.
+# Exits script on any error in the config.
+def compile_config(path, text):
+    if tomllib is None:
+        fatal("Reading the config needs Python 3.11+ or the 'tomli' module.")
+    try:
+        config = tomllib.loads(text.decode())
+    except (UnicodeDecodeError, tomllib.TOMLDecodeError) as e:
+        fatal("Could not read config '%s': %s" % (path, e))
+    check_keys('file', config, CONFIG_KEYS)
+    sets = config.get('subvolumes', {})
+    for name, svs in sets.items():
+        if not (isinstance(svs, ARRAY) and
+                all(isinstance(sv, str) for sv in svs)):
+            fatal("Config subvolume set '%s' should be a list of names." %
+                  name)
+
+    def paths(what, *values):
+        for value in values:
+            for p in [value] if isinstance(value, str) else value:
+                if not isinstance(p, str) or not os.path.isabs(p):
+                    fatal("Config %s should have absolute paths, not %r." %
+                          (what, p))
+
+    actions = []
+    for n, action in enumerate(config.get('action', []), 1):
+        what = 'action #%d' % n
+        if not isinstance(action, dict) or action.get('do') not in ACTION_KEYS:
+            fatal("Config %s should have 'do' set to one of: %s." %
+                  (what, ', '.join(ACTION_KEYS)))
+        action = dict(action)
+        do, svs = action.pop('do'), action.pop('subvolumes', None)
+        check_keys('%s (%s)' % (what, do), action, ACTION_KEYS[do])
+        paths(what, *(action[k] for k in ('from', 'to', 'in', 'staging')
+                      if k in action))
+        if not isinstance(svs, ARRAY) or not svs:
+            fatal("Config %s needs a list of 'subvolumes'." % what)
+        expanded = []
+        for sv in svs:
+            if not isinstance(sv, str):
+                fatal("Config %s has a subvolume that isn't a string." % what)
+            if sv.startswith('$'):
+                if sv[1:] not in sets:
+                    fatal("Config %s uses unknown subvolume set '%s'." %
+                          (what, sv))
+                expanded += sets[sv[1:]]
+            else:
+                expanded.append(sv)
+        if (do == 'archive' and
+                action.get('compress', 'zstd') not in COMPRESSORS):
+            fatal("Config %s has unknown compression '%s'." %
+                  (what, action['compress']))
+        actions.append({'do': do, 'subvolumes': expanded, **action})
+
+    throttles = []
+    for n, limits in enumerate(config.get('throttle', []), 1):
+        what = 'throttle #%d' % n
+        check_keys(what, limits, THROTTLE_KEYS)
+        paths(what, limits['dest'])
+        limits = dict(limits)
+        limits['rate'] = parse_size(limits.get('rate'))
+        try:
+            window = limits.get('window')
+            window is None or in_window(window, datetime.time())
+        except (TypeError, ValueError):
+            fatal("Config %s should have a 'window' like ['09:00', '18:00']."
+                  % what)
+        if limits.get('ionice', 'idle').split(':')[0] not in IONICE_CLASSES:
+            fatal("Config %s has unknown ionice class '%s'." %
+                  (what, limits['ionice']))
+        throttles.append(limits)
+
+    jobs = config.get('jobs', {})
+    paths('jobs', *jobs)
+    if not all(type(count) is int and count > 0 for count in jobs.values()):
+        fatal("Config jobs should be positive whole numbers.")
+    report = config.get('report', {})
+    check_keys('report', report, REPORT_KEYS)
+    settings = config.get('settings', {})
+    check_keys('settings', settings, SETTINGS_KEYS)
+    daemon = config.get('daemon', {})
+    check_keys('daemon', daemon, DAEMON_KEYS)
+    if 'socket' in daemon:
+        paths('daemon', daemon['socket'])
+    if daemon.get('interval', 1) <= 0:
+        fatal("Config daemon interval should be a positive whole number.")
+    return {'version': COMPILED_VERSION, 'config': path,
+            'digest': hashlib.blake2b(text).hexdigest(),
+            'report': report.get('json'), 'metrics': report.get('prometheus'),
+            'settings': settings, 'jobs': jobs, 'throttles': throttles,
+            'actions': actions, 'daemon': daemon}
+
+
+# # Usage: compiled = compiled_config(path)
+# Get the config at 'path' compiled by compile_config(), reusing the
+# copy cached in STATE_DIR if the config hasn't changed since.
+def compiled_config(path):
+    text = get_config(path)
+    cache = join(STATE_DIR, 'config.json')
+    try:
+        with open(cache) as f:
+            compiled = json.load(f)
+        if (compiled['version'], compiled['config'], compiled['digest']) == \
+                (COMPILED_VERSION, path, hashlib.blake2b(text).hexdigest()):
+            return compiled
+    except (OSError, ValueError, KeyError):
+        pass  # Nothing usable cached.
+    compiled = compile_config(path, text)
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        save_json(cache, compiled)
+    except OSError as e:  # Fine; it's compiled again next time.
+        dbg("Could not cache compiled config: %s" % e)
+    return compiled
 
 
 # This explains how the config file works.
 CONFIG_USE = """
-Python script to run backup-btrfs2 functions. It works by calling
-the make-snaps', 'copy-latest', and 'delete-old' functions with the
-desired arguments. These functions work as follows:
+TOML file listing backup-btrfs2 actions to run, in order, and settings
+for them. Each action is an [[action]] table whose 'do' says what it
+does, and whose 'subvolumes' lists the subvolumes to do it to, where
+"$name" stands for every subvolume in the list 'name' under
+[subvolumes]. The actions work as follows:
 
-make_snaps(fro, to, *subvolumes)
+do = "snapshot", from = ..., to = ...
 
-    Snapshot each listed subvolume under 'fro', saving the snapshots
-    under 'to'. Note that 'fro' and 'to' must be under the same btrfs
+    Snapshot each listed subvolume under 'from', saving the snapshots
+    under 'to'. Note that 'from' and 'to' must be under the same btrfs
     mount point, since snapshots merely copy references to the
-    underlying data.
-
-copy_latest(fro, to, *subvolumes)
-
-    Copy the latest snapshot of each listed subvolume from 'fro' to
-    'to'. Note that this is only useful if 'fro' and 'to' are on
-    different partitions (and usually on different physical devices,
-    like for backups), since otherwise lightweight snapshots could be
-    used for the same effect without doubling disk usage.
-
-delete_old(location, time, *subvolumes)
-
-    Delete all snapshots older than 'time' from listed subvolumes
-    under 'location'. Note that 'time' is recommended to be relative
-    like 'three weeks ago' and should be longer than the frequency
-    that backups are done to the location.
+    underlying data. Subvolumes that haven't changed since their
+    latest snapshot there are skipped, so they aren't synced or sent
+    either.
+
+do = "copy", from = ..., to = ..., staging = ... (optional)
+
+    Copy the latest snapshot of each listed subvolume from 'from' to
+    'to', which may be a list of directories to copy to at once,
+    reading each snapshot only once for all of them that share a
+    parent snapshot with 'from'. Note that this is only useful if
+    'from' and 'to' are on different partitions (and usually on
+    different physical devices, like for backups), since otherwise
+    lightweight snapshots could be used for the same effect without
+    doubling disk usage. If 'staging' is a directory path, each stream
+    is first saved there in 64 MiB checkpointed chunks, so a copy to an
+    unreliable drive that gets interrupted resumes from the last chunk
+    on the next run instead of sending everything again.
+
+do = "archive", from = ..., to = ..., compress = "zstd" (optional)
+
+    Like "copy", but 'to' needn't be btrfs: each snapshot is saved as a
+    full or incremental 'btrfs send' stream file, compressed with
+    "zstd" or "lzma" (xz) on all CPU cores. Each subvolume's
+    manifest.json records which stream is based on which, so they can
+    be restored into btrfs later.
+
+do = "dedup", from = ..., to = ..., compress = true (optional)
+
+    Like "archive", but each snapshot is saved as a full stream, cut
+    into content-defined chunks of which only new ones are stored (in
+    'to'/packs, zlib-compressed unless 'compress' is false). So every
+    snapshot can be restored by itself, while repeated sends of mostly
+    unchanged subvolumes take little more space than what changed.
+    Chunks are shared by every subvolume in 'to', and each run shows
+    the store's deduplication ratio.
+
+do = "delete", in = ..., older_than = ..., keep = 1 (optional),
+defer = false (optional)
+
+    Delete all snapshots older than 'older_than' from listed
+    subvolumes 'in' a location, but the latest 'keep'. Note that
+    'older_than' is recommended to be relative like "3 weeks ago" and
+    should be longer than the frequency that backups are done to the
+    location. With 'defer', old snapshots are instead only deleted
+    when a copy to the location's filesystem needs their space, oldest
+    first and just enough for the copy's estimated size (plus 1 GiB),
+    so backup drives keep as much history as fits. Either way, the
+    newest snapshot each "copy" destination of the location has is
+    kept as its next incremental parent, even while it's unplugged.
+
+do = "retain", in = ..., hourly = 24, daily = 14, weekly = 8,
+monthly = 12, yearly = 0, keep = 1, defer = false (all optional)
+
+    Like "delete", but thin out snapshots by grandfather-father-son
+    rules instead of by age: keep the newest snapshot of each of the
+    last 24 hours, 14 days, 8 weeks, and 12 months that have snapshots
+    (by default), plus the latest 'keep', and delete the rest. Periods
+    are in UTC. 'defer' works as for "delete".
+
+These tables hold settings for the actions:
+
+[jobs]
+
+    Maps paths to how many snapshots or copies may use the device
+    holding each at once (default 2), like "/hdds" = 1. Subvolumes are
+    snapshotted and copied in parallel within the limits of both the
+    'from' and 'to' devices.
+
+[settings]
+
+    'match_uuids' (default false) lets copies find common snapshots by
+    btrfs' received_uuid instead of by name only, so renamed copies can
+    still be used as incremental parents. 'estimate_sends' (default
+    true) estimates before each copy with 'btrfs send --no-data' dry
+    runs whether it'd be smaller from another parent or with clone
+    sources ('-c') from other subvolumes' snapshots that 'to' already
+    has, and uses whichever is smallest; turn it off if the dry runs
+    take longer than they save. 'hash_streams' (default false) hashes
+    each archive's stream as it's sent, for 'backup-btrfs verify',
+    which otherwise checks archives by their compressor's checksums;
+    it's off since it makes streams take a copy thru memory.
+
+[report]
+
+    'json' and 'prometheus' are paths to save a JSON report and
+    Prometheus textfile metrics of each run to (default none).
+
+[daemon]
+
+    'interval' is how many minutes the daemon action waits between
+    runs (default 60), and 'socket' is where it answers status
+    requests (default '/run/backup-btrfs2.sock'). The daemon also runs
+    as soon as something is mounted where the actions' paths are, like
+    an external drive being plugged in.
+
+[[throttle]]
+
+    Limits copies to the drive holding 'dest', like dest = "/hdds",
+    rate = "40M", window = ["09:00", "18:00"], ionice = "idle" to keep
+    hourly backups from stalling the machine during working hours.
+    'rate' is bytes per second, 'window' is a [start, end] pair of
+    local times (always, if left out), 'ionice' is "idle" or
+    "best-effort[:LEVEL]", and 'weight' is a cgroup IOWeight from 1 to
+    10000 (100 being normal; this needs systemd and an IO scheduler
+    that honors it, like BFQ). With 'latency', the rate halves whenever
+    the drive's average IO latency is over that many milliseconds, and
+    creeps back up (to 'rate', if given) otherwise. When several
+    throttles apply, the strictest limits win.
+
+The config is checked and compiled once whenever it changes (and at
+install time), so mistakes are caught before anything runs. The
+actions are then planned, and each runs as soon as the earlier actions
+it conflicts with are done, so actions on unrelated drives overlap.
+For example, a "delete" of a subvolume's snapshots waits for any
+earlier "copy" of them, and a "copy" waits for the "snapshot" making
+what it copies. Run 'backup-btrfs plan' to see the resulting order.
 
 To see an example for clarity, it is recommended to choose to edit the
 default config. It is a reasonable starting template for basic backup
 cases."""
 
 
-# # Usage: check_config()
-# Checks that the config exists, exiting the script with a fatal error
-# if not.
+# # Usage: path = check_config()
+# Checks that the config exists, returning its path for
+# compiled_config() so get-config only runs once, or exiting the
+# script with a fatal error if not.
 def check_config():
-    # Check the config, explaining how it works if it isn't already set.
+    path = get_config_path()
+    if os.path.isfile(path):
+        return path
+    # Make the config, explaining how it works since it isn't set yet.
     # TODO: sh->py: turn exit code into return bool
-    if not Command('get-config')('backup-btrfs2/control_script.py',
+    if not Command('get-config')('backup-btrfs2/config.toml',
                                  '-verbatim', '-what-do', CONFIG_USE):
         fatal("Could not get config.")
+    return path
 
 
 # # Usage: backup()
 # Gets the backup config and runs it to do backups.
 def backup():
     msg("Running backups.")
-    check_config()  # Don't try running an imaginary config.
-    # Read the config script to run it.
-    eval(get_config(), globals(), locals())
+    path = check_config()  # Don't try running an imaginary config.
+    global REPORT_PATH, METRICS_PATH
+    compiled = compiled_config(path)
+    REPORT_PATH, METRICS_PATH = compiled['report'], compiled['metrics']
+    # Plan the config's actions, then run them.
+    ok = False
+    try:
+        ok = scheduled(lambda: apply_config(compiled))
+    finally:
+        summary()
+        report(ok)
+
+
+# # Usage: plan()
+# Gets the backup config and shows what it would do, in what order,
+# without running anything.
+def plan():
+    path = check_config()
+    global REPORT_PATH, PLAN
+    compiled = compiled_config(path)
+    REPORT_PATH = compiled['report']  # for last run's timings
+    PLAN = []
+    try:
+        apply_config(compiled)
+        show_plan(PLAN)
+    finally:
+        PLAN = None
+
+
+# # Usage: restore(fro, to, *targets)
+# Restores snapshots from the backups in 'fro' into 'to' (see
+# restore_from()), then shows how long each took.
+def restore(fro=None, to=None, *targets):
+    if to is None:
+        usage()
+        fatal("Restoring needs where the backups are and where to put them.")
+    ok = False
+    try:
+        ok = restore_from(fro, to, *targets)
+    finally:
+        summary()
+    if not ok:
+        fatal("Could not restore everything.")
+
+
+# Checks for each kind of config action verify() can check
+VERIFIERS = {'copy': verify_copy, 'archive': verify_archive,
+             'dedup': verify_dedup}
+
+
+# # Usage: verify()
+# Checks the newest copy, archive, or deduplicated stream of every
+# subvolume the config saves against what was recorded when it was
+# sent (see VERIFIERS), exiting with an error if any doesn't match.
+def verify():
+    path = check_config()
+    results = []
+    for action in compiled_config(path)['actions']:
+        if action['do'] not in VERIFIERS:
+            continue
+        check = VERIFIERS[action['do']]
+        for to in [action['to']] if isinstance(action['to'], str) \
+                else action['to']:
+            if not exists(to):
+                msg("Skipping '%s' since it isn't there." % to)
+                continue
+            for sv in action['subvolumes']:
+                # Copies are first checked against their sources.
+                sources = [(action['from'], sv)] * (action['do'] == 'copy')
+                with locked_dirs(reads=[(to, sv), *sources]):
+                    results.append(check(to, sv))
+    bad = results.count(False)
+    msg("Verified %d snapshot(s): %d matched, %d mismatched, %d unchecked." %
+        (len(results), results.count(True), bad, results.count(None)))
+    if bad:
+        fatal("%d snapshot(s) don't match what was sent." % bad)
+
+
+# # Usage: daemon()
+# Gets the backup config and runs backups by it as a daemon (see
+# serve()), reloading it from the config file on SIGHUP.
+def daemon():
+    path = check_config()
+    serve(lambda: compiled_config(path))
+
+
+# # Usage: status()
+# Shows the state of a running daemon, from its status socket.
+def status():
+    compiled = compiled_config(get_config_path())
+    path = compiled.get('daemon', {}).get('socket', STATUS_SOCKET)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(path)
+            state = json.loads(client.makefile().readline())
+    except OSError as e:
+        fatal("Could not get status from a daemon at '%s': %s" % (path, e))
+    when = lambda t: time.strftime('%F %T', time.localtime(t))
+    msg("Daemon %d is %s, with config '%s', after %d run(s)." %
+        (state['pid'], state['state'], state['config'], state['runs']))
+    if state['state'] == 'running':
+        msg("Running since %s (%s)." % (when(state['started']),
+                                        state['reason']))
+    last = state['last']
+    if last:
+        msg("Last run (%s) %s at %s after %d second(s), skipping %d "
+            "unchanged subvolume(s)." %
+            (last['reason'], 'worked' if last['ok'] else 'FAILED',
+             when(last['end']), last['end'] - last['start'],
+             last['skipped']))
+    msg("Next scheduled run at %s." % when(state['next']))
 
 
 INSTALL_PATH = "/sbin/backup-btrfs.installed"
@@ -621,7 +4520,7 @@ def install():
     msg("Installing script as system command.")
 
     # Make sure the config exists.
-    check_config()
+    path = check_config()
 
     # Read in every line of this script, stopping at the autogen stop
     # line that precedes the "# === main stuff ===" section.
@@ -641,19 +4540,26 @@ def install():
             else:
                 script += line
 
-    # Append function-wrapped config.
-    # TODO: sh->py: This logic should be pasted at the end.
-    script += """
-# === config from install time, wrapped in function ===
-def backup():
-    msg('Running backups.')
-    """ + get_config() + "\n\n\n"
-
-    # Append init-running and backup-running.
+    # Append the compiled config, and init-running and backup-running
+    # (or daemon-running, for the daemon service).
+    compiled = compiled_config(path)  # also cached for the daemon's reloads
     script += '''
+# === config from install time, compiled ===
+COMPILED_CONFIG = json.loads(%r)
+REPORT_PATH = COMPILED_CONFIG['report']
+METRICS_PATH = COMPILED_CONFIG['metrics']
 init()  # Run init manually; this has no main.
-backup()  # Run backup manually; this has no main.
-'''
+if argv[1:] == ['daemon']:
+    serve(lambda: COMPILED_CONFIG, lambda: cached_config(COMPILED_CONFIG))
+else:
+    ok = False
+    try:
+        # Plan and run backups; this has no main.
+        ok = scheduled(lambda: apply_config(COMPILED_CONFIG))
+    finally:
+        summary()
+        report(ok)
+''' % json.dumps(compiled)
 
     # Save to $install_path
     # TODO: sh->py: standard library functions for temp files?
@@ -669,12 +4575,17 @@ backup()  # Run backup manually; this has no main.
     cmd("remove temp file '%s'" % tmp_path, 'rm', tmp_path)
 
     # Copy systemd units.
-    fro = cmd('get-data', 'backup-btrfs2', '-path', root=False).trim()
+    fro = cmd("find systemd units", 'get-data', 'backup-btrfs', '-path',
+              root=False, side_effects=False).strip()
     # TODO: sh->py: use standard library copy function
     cmd("copy systemd service",
         'cp', join(fro, 'backup-btrfs.service'), SYSTEMD_TARGET)
     cmd("copy systemd timer",
         'cp', join(fro, 'backup-btrfs.timer'), SYSTEMD_TARGET)
+    # The daemon service is an alternative to the timer, so it's only
+    # copied, for the user to enable instead if wanted.
+    cmd("copy systemd daemon service",
+        'cp', join(fro, 'backup-btrfs-daemon.service'), SYSTEMD_TARGET)
 
     # Enable and start systemd service+timer pair.
     ##
@@ -707,12 +4618,18 @@ def uninstall():
         'systemctl', '--quiet', 'disable', 'backup-btrfs.timer')
     cmd("disable systemd service",
         'systemctl', 'disable', 'backup-btrfs.service')
+    cmd("stop systemd daemon service",
+        'systemctl', 'stop', 'backup-btrfs-daemon.service', fail_ok=True)
+    cmd("disable systemd daemon service", 'systemctl', '--quiet',
+        'disable', 'backup-btrfs-daemon.service', fail_ok=True)
 
     # Remove systemd units.
     cmd("remove systemd timer",
         'rm', join(SYSTEMD_TARGET, 'backup-btrfs.timer'))
     cmd("remove systemd service",
         'rm', join(SYSTEMD_TARGET, 'backup-btrfs.service'))
+    cmd("remove systemd daemon service",
+        'rm', '-f', join(SYSTEMD_TARGET, 'backup-btrfs-daemon.service'))
 
     # Remove from install_path.
     cmd("remove installed derived script",
@@ -730,19 +4647,42 @@ Run btrfs backups.
 Actions:
 
 backup     Run btrfs backups according to config.
+daemon     Keep running backups according to config on a schedule, and
+           when the drives it uses are mounted. SIGHUP reloads the
+           config. After install, use backup-btrfs-daemon.service
+           instead of backup-btrfs.timer to run this way; reloading
+           it loads the config as last compiled by backup or plan.
+plan       Show the actions backup would run, what each waits for, and
+           the predicted critical path, without running anything.
 install    Bundle script and config into no-arg system script and set
            systemd to automatically run it every hour or so.
 reinstall  Redo install with latest script and config versions.
+restore    Takes a backup path, a path to restore to, and optionally
+           subvolumes (like '@home') or snapshots (like
+           '@home/2026-04-01T00:00:00+00:00') to restore; by default,
+           the newest snapshot of every subvolume. Each is sent
+           incrementally from the nearest snapshot both paths have, so
+           restoring next to a recent snapshot only sends what
+           differs. The backup path may be a copy, archive, or dedup
+           destination from the config.
+status     Show what a running daemon is doing.
 uninstall  Remove installed file and systemd units.
 usage      Show this usage information.
+verify     Check the newest copies, archives, and deduplicated streams
+           against what was recorded when they were sent.
 
 
 Options:
 
 DEBUG      Simulate actions and increase verbosity to maximum. This is
            good for testing purposes, such as after changing the
-           control script.
+           config.
 quiet      Decrease verbosity by one level.
+trace      Record every command ran, with its timing, exit status, and
+           output size, to /var/log/backup-btrfs2/trace.jsonl (or the
+           file named by BACKUP_BTRFS2_TRACE, which also works for the
+           installed script). See bb2-trace.py to analyze or replay
+           traces.
 verbose    Increase verbosity by one level.
 
 
@@ -760,11 +4700,13 @@ def usage():
 # # Usage: main()
 # Run the script.
 def main():
-    global VERBOSITY, DEBUG
-    acts = ['backup', 'install', 'reinstall', 'uninstall', 'usage']
-    opts = ['DEBUG', 'quiet', 'verbose']
+    global VERBOSITY, DEBUG, TRACE_PATH
+    acts = ['backup', 'daemon', 'install', 'plan', 'reinstall', 'restore',
+            'status', 'uninstall', 'usage', 'verify']
+    opts = ['DEBUG', 'quiet', 'trace', 'verbose']
     VERBOSITY = 0
     action = ''
+    args = []  # for restore
     for arg in argv[1:]:
         if arg in acts:
             if action == '':
@@ -779,14 +4721,25 @@ def main():
                 VERBOSITY += 1
             elif arg == 'quiet':
                 VERBOSITY -= 1
+            elif arg == 'trace':
+                TRACE_PATH = TRACE_DEFAULT
             else:
                 fatal("WTF? (opt %s)" % arg)
+        elif action == 'restore':
+            args.append(arg)
         else:
             fatal("Unknown argument '%s'." % arg)
 
     if action in acts:
         if action == "usage":
             usage()
+        elif action == "plan":  # Runs nothing, so needs no lock.
+            plan()
+        elif action == "status":  # Likewise
+            status()
+        elif action == "restore":
+            init()
+            restore(*args)
         else:
             init()
             eval('%s()' % action, locals(), globals())
@@ -797,4 +4750,5 @@ def main():
         fatal("WTF? action=%s." % action)
 
 
-main()
+if __name__ == '__main__':
+    main()
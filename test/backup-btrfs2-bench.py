@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+## backup-btrfs2-bench.py
+# Benchmark how bb2.py's planning and pruning scale with the number of
+# snapshots, using synthetic snapshot trees (on tmpfs where possible)
+# and a fake 'btrfs', how fast it runs root commands, and what hashing
+# send streams costs. Results can be saved and compared against a
+# baseline from another commit, failing if anything got too slow.
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Assumes this is in "test" which is a sibling of "backup"
+HERE = os.path.dirname(os.path.realpath(__file__))
+BB2_PATH = os.path.join(HERE, '..', 'backup', 'bb2.py')
+
+# Stands in for 'btrfs', doing nothing but succeeding.
+FAKE_BTRFS = '#!/bin/sh\nexit 0\n'
+# Seconds the fake sudo takes to start, standing in for real sudo's
+# PAM, policy, and logging work (typically 10-30 ms)
+SUDO_DELAY = 0.01
+# Runs its arguments as the current user, after SUDO_DELAY.
+FAKE_SUDO = '#!/bin/sh\nsleep %s\nexec "$@"\n' % SUDO_DELAY
+
+# Grandfather-father-son rules for the retain/N cases
+RULES = {'hourly': 24, 'daily': 14, 'weekly': 8, 'monthly': 12}
+
+USAGE = """Time bb2.py's snapshot planning, pruning, and retention for
+synthetic snapshot trees of each given size, spread across several
+subvolumes. With --baseline, exit with status 1 if any case is more
+than --threshold times slower than in the baseline results."""
+
+
+def load_bb2():
+    spec = importlib.util.spec_from_file_location('bb2', BB2_PATH)
+    bb2 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bb2)
+    return bb2
+
+
+# Make 'count' hourly snapshot names spread over 'subvols' subvolume
+# directories in both 'src' and 'dst', with 'dst' missing the newest
+# tenth as if it hadn't been backed up lately.
+def make_tree(root, count, subvols):
+    start = datetime.datetime(2016, 3, 31, tzinfo=datetime.timezone.utc)
+    per = max(1, count // subvols)
+    svs = ['@vol%d' % i for i in range(min(subvols, count))]
+    for sv in svs:
+        os.makedirs(os.path.join(root, 'dst', sv))
+        for i in range(per):
+            name = (start + datetime.timedelta(hours=i)).isoformat(
+                timespec='seconds')
+            os.makedirs(os.path.join(root, 'src', sv, name))
+            if i < per - max(1, per // 10):
+                os.makedirs(os.path.join(root, 'dst', sv, name))
+    cutoff = start + datetime.timedelta(hours=per // 2)
+    return svs, cutoff.replace(tzinfo=None)
+
+
+# Time func() 'repeat' times, each after setup(), returning the best.
+def best_of(repeat, setup, func):
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench(bb2, root, count, subvols, repeat):
+    svs, cutoff = make_tree(root, count, subvols)
+    src, dst = os.path.join(root, 'src'), os.path.join(root, 'dst')
+
+    def cold():
+        bb2.SNAP_INDEX.clear()
+        bb2.SUBVOL_INDEX.clear()
+        bb2.STAGES.clear()
+
+    def plan():  # Find what to copy, without copying.
+        bb2.DEBUG = True
+        try:
+            bb2.copy_latest(src, dst, *svs)
+        finally:
+            bb2.DEBUG = False
+
+    def last():
+        for sv in svs:
+            bb2.last_backup([os.path.join(src, sv), os.path.join(dst, sv)])
+
+    def prune():  # The fake btrfs doesn't really delete anything.
+        for sv in svs:
+            bb2.delete_older_than(dst, cutoff, 1, sv)
+
+    def thin():
+        for sv in svs:
+            bb2.delete_unretained(dst, sv, RULES)
+
+    return {
+        'last_backup/%d' % count: best_of(repeat, cold, last),
+        'plan/%d' % count: best_of(repeat, cold, plan),
+        'prune/%d' % count: best_of(repeat, cold, prune),
+        'retain/%d' % count: best_of(repeat, cold, thin),
+    }
+
+
+# Time 100 root commands ran with a sudo each versus thru bb2.py's
+# root helper, which starts with a single sudo and runs every command
+# itself. The fake sudo takes SUDO_DELAY to start, as real sudo does,
+# and the helper's start is timed too.
+def bench_cmds(bb2, repeat):
+    def each():
+        for _ in range(100):
+            bb2.cmd('benchmark', 'true')
+
+    def thru_helper():
+        bb2.start_helper()
+        try:
+            each()
+        finally:
+            bb2.stop_helper()
+
+    bb2.SUDO = ['sudo']
+    try:
+        spawned = best_of(repeat, lambda: None, each)
+        helped = best_of(repeat, lambda: None, thru_helper)
+    finally:
+        bb2.SUDO = []
+    return {'cmd-sudo-each/100': spawned, 'cmd-helper/100': helped}
+
+
+# Time pumping 'size' bytes from a file thru a pipe as plain sends do
+# versus while hashing them for hash_streams(), to see what hashing
+# costs.
+def bench_pump(bb2, root, size, repeat):
+    path = os.path.join(root, 'stream')
+    with open(path, 'wb') as f:
+        for _ in range(size >> 20):
+            f.write(os.urandom(1 << 20))
+
+    def pumped(digest):
+        def each():
+            with open(path, 'rb') as f:
+                r, w = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(w)
+                    while os.read(r, 1 << 20):
+                        pass
+                    os._exit(0)
+                os.close(r)
+                bb2.pump(f.fileno(), w, digest=digest and digest())
+                os.close(w)
+                os.waitpid(pid, 0)
+        return best_of(repeat, lambda: None, each)
+
+    try:
+        return {'pump-plain/%dM' % (size >> 20): pumped(None),
+                'pump-hashed/%dM' % (size >> 20):
+                pumped(lambda: bb2.hashlib.new(bb2.STREAM_HASH))}
+    finally:
+        os.remove(path)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=USAGE)
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma-separated snapshot counts')
+    parser.add_argument('--subvols', type=int, default=8,
+                        help='subvolumes to spread snapshots over')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case; the best is kept')
+    parser.add_argument('--dir', default='/dev/shm' if
+                        os.path.isdir('/dev/shm') else None,
+                        help='where to make snapshot trees')
+    parser.add_argument('--stream', type=int, default=256,
+                        help='MiB to pump for the stream hashing cases')
+    parser.add_argument('--save', help='save results as JSON here')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='allowed slowdown factor vs the baseline')
+    parser.add_argument('--slack', type=float, default=0.005,
+                        help='seconds of slowdown always allowed')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bb2-bench.', dir=args.dir)
+    try:
+        bin = os.path.join(tmp, 'bin')
+        os.mkdir(bin)
+        for name, text in (('btrfs', FAKE_BTRFS), ('sudo', FAKE_SUDO)):
+            with open(os.path.join(bin, name), 'w') as f:
+                f.write(text)
+            os.chmod(os.path.join(bin, name), 0o755)
+        os.environ['PATH'] = bin + os.pathsep + os.environ['PATH']
+        bb2 = load_bb2()
+        bb2.SUDO = []
+        bb2.VERBOSITY = -2
+        bb2.TIMESTAMP = '2026-01-01T00:00:00+00:00'
+        results = bench_cmds(bb2, args.repeat)
+        results.update(bench_pump(bb2, tmp, args.stream << 20, args.repeat))
+        for count in map(int, args.sizes.split(',')):
+            root = os.path.join(tmp, str(count))
+            results.update(bench(bb2, root, count, args.subvols,
+                                 args.repeat))
+            shutil.rmtree(root)
+    finally:
+        shutil.rmtree(tmp)
+
+    for case, secs in results.items():
+        print('%-24s %10.4fs' % (case, secs))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'commit': git_commit(), 'results': results}, f,
+                      indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slow = [(case, secs, baseline['results'][case])
+                for case, secs in results.items()
+                if case in baseline['results'] and
+                secs > baseline['results'][case] * args.threshold + args.slack]
+        for case, secs, old in slow:
+            print('REGRESSION: %s took %.4fs, was %.4fs at %s' %
+                  (case, secs, old, baseline.get('commit')))
+        if slow:
+            sys.exit(1)
+        print('No regressions vs %s.' % baseline.get('commit'))
+
+
+if __name__ == '__main__':
+    main()
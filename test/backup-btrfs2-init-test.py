@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+## backup-btrfs2-init-test.py
+# Smoke test bb2.py's init(), which every action runs first, with fake
+# stand-ins for the programs it needs that aren't always installed.
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+# Assumes this is in "test" which is a sibling of "backup"
+BB2_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'backup', 'bb2.py')
+
+# Stand-ins doing nothing but succeeding, by name
+FAKES = {name: '#!/bin/sh\nexit 0\n'
+         for name in ('btrfs', 'get-config', 'get-data', 'systemctl')}
+# Runs its arguments as the current user.
+FAKES['sudo'] = '#!/bin/sh\nexec "$@"\n'
+
+
+def load_bb2():
+    spec = importlib.util.spec_from_file_location('bb2', BB2_PATH)
+    bb2 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bb2)
+    return bb2
+
+
+class InitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='bb2-init-test.')
+        self.bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(self.bin)
+        for name, text in FAKES.items():
+            with open(os.path.join(self.bin, name), 'w') as f:
+                f.write(text)
+            os.chmod(os.path.join(self.bin, name), 0o755)
+        self.env = dict(os.environ)
+        os.environ['PATH'] = self.bin + os.pathsep + '/usr/bin:/bin'
+        os.environ.pop('BACKUP_BTRFS2_TRACE', None)
+        self.bb2 = load_bb2()
+        self.bb2.VERBOSITY = -1
+        self.bb2.LOCK_DIR = os.path.join(self.tmp, 'lock')
+
+    def tearDown(self):
+        self.bb2.stop_helper()
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmp)
+
+    def test_init(self):
+        self.bb2.init()
+        self.assertIsNotNone(self.bb2.TIMESTAMP)
+        # Any user's runs can add lock files, but not remove others'.
+        self.assertEqual(os.stat(self.bb2.LOCK_DIR).st_mode & 0o7777, 0o1777)
+        fd = self.bb2.open_lock('test.lock')
+        os.close(fd)
+        path = os.path.join(self.bb2.LOCK_DIR, 'test.lock')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o666)
+
+    def test_missing_command(self):
+        os.remove(os.path.join(self.bin, 'get-data'))
+        with self.assertRaises(SystemExit):
+            self.bb2.init()
+
+
+if __name__ == '__main__':
+    unittest.main()
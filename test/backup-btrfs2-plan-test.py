@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+## backup-btrfs2-plan-test.py
+# Test that bb2.py's planned copies of different subvolumes don't wait
+# on each other, even while it estimates sends with clone sources from
+# other subvolumes, using plain directories as snapshot trees.
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+# Assumes this is in "test" which is a sibling of "backup"
+BB2_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'backup', 'bb2.py')
+
+SNAPS = ['2016-04-18T01:24:20+00:00', '2016-04-19T01:24:20+00:00']
+SUBVOLS = ['@a', '@b', '@c']
+
+
+def load_bb2():
+    spec = importlib.util.spec_from_file_location('bb2', BB2_PATH)
+    bb2 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bb2)
+    return bb2
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='bb2-plan-test.')
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        for sv in SUBVOLS:
+            for name in SNAPS:
+                os.makedirs(os.path.join(self.src, sv, name))
+            os.makedirs(os.path.join(self.dst, sv, SNAPS[0]))
+        self.bb2 = load_bb2()
+        self.bb2.VERBOSITY = -1
+        self.bb2.PLAN = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def deps(self, estimate):
+        self.bb2.estimate_sends(estimate)
+        self.bb2.copy_latest(self.src, self.dst, *SUBVOLS)
+        self.bb2.prune(self.dst, ['@b'], lambda sv: (0, 0))
+        return {a.id: a.deps for a in self.bb2.PLAN}
+
+    def test_copies_independent(self):
+        for estimate in (False, True):
+            self.bb2.PLAN = []
+            deps = self.deps(estimate)
+            self.assertEqual(deps[1], set())
+            self.assertEqual(deps[2], set())
+            self.assertEqual(deps[3], set())
+            self.assertEqual(deps[4], {2})  # Pruning @b waits on its copy.
+
+
+if __name__ == '__main__':
+    unittest.main()
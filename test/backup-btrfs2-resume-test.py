@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+## backup-btrfs2-resume-test.py
+# Test that bb2.py's spooled transfers resume after an interruption,
+# using a fake 'btrfs' instead of real filesystems.
+
+import importlib.util
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# Assumes this is in "test" which is a sibling of "backup"
+BB2_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'backup', 'bb2.py')
+
+# Stands in for 'btrfs'. 'send' outputs a deterministic stream of
+# FAKE_SEND_SIZE bytes named after the snapshot (dying partway if
+# FAKE_SEND_DIE_AFTER is set), and 'receive' saves the stream as a
+# directory named by its first line (failing if FAKE_RECEIVE_FAIL is
+# set). Every call is logged to FAKE_LOG.
+FAKE_BTRFS = r'''#!/usr/bin/env python3
+import os, random, shutil, sys
+args = sys.argv[1:]
+with open(os.environ['FAKE_LOG'], 'a') as log:
+    log.write(' '.join(args) + '\n')
+if args[0] == 'send':
+    snap, size = args[-1], int(os.environ['FAKE_SEND_SIZE'])
+    data = os.path.basename(snap).encode() + b'\n'
+    data += random.Random('%s %d' % (snap, size)).randbytes(size)
+    die = os.environ.get('FAKE_SEND_DIE_AFTER')
+    sys.stdout.buffer.write(data[:int(die)] if die else data)
+    sys.exit(1 if die else 0)
+elif args[0] == 'receive':
+    data = sys.stdin.buffer.read()
+    if os.environ.get('FAKE_RECEIVE_FAIL'):
+        sys.exit(1)
+    name = data.split(b'\n', 1)[0].decode()
+    os.mkdir(os.path.join(args[-1], name))
+    with open(os.path.join(args[-1], name, 'stream'), 'wb') as f:
+        f.write(data)
+elif args[:2] == ['subvolume', 'delete']:
+    for path in args[2:]:
+        if not path.startswith('-'):
+            shutil.rmtree(path)
+'''
+
+# Runs its arguments as the current user.
+FAKE_SUDO = '#!/bin/sh\nexec "$@"\n'
+
+CHUNK = 64 * 1024
+SNAP = '2016-04-18T01:24:20+00:00'
+
+
+def load_bb2():
+    spec = importlib.util.spec_from_file_location('bb2', BB2_PATH)
+    bb2 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bb2)
+    return bb2
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='bb2-resume-test.')
+        bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(bin)
+        for name, text in (('btrfs', FAKE_BTRFS), ('sudo', FAKE_SUDO)):
+            with open(os.path.join(bin, name), 'w') as f:
+                f.write(text)
+            os.chmod(os.path.join(bin, name), 0o755)
+        self.env = dict(os.environ)
+        os.environ['PATH'] = bin + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_LOG'] = os.path.join(self.tmp, 'log')
+        os.environ['FAKE_SEND_SIZE'] = str(5 * CHUNK + 1234)
+        self.bb2 = load_bb2()
+        self.bb2.SUDO = []
+        self.bb2.VERBOSITY = -1
+        self.bb2.CHUNK_SIZE = CHUNK
+        for dir in ('from/@vol/' + SNAP, 'to', 'staging'):
+            os.makedirs(os.path.join(self.tmp, dir))
+        self.spool = os.path.join(
+            self.tmp, 'staging',
+            self.bb2.escape_path(os.path.join(self.tmp, 'to')), '@vol', SNAP)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmp)
+
+    def copy(self):
+        self.bb2.SNAP_INDEX.clear()
+        self.bb2.clone_or_update(os.path.join(self.tmp, 'from'),
+                                 os.path.join(self.tmp, 'to'), '@vol',
+                                 staging=os.path.join(self.tmp, 'staging'))
+
+    def sends(self):
+        with open(os.environ['FAKE_LOG']) as log:
+            return sum(line.startswith('send') for line in log)
+
+    def chunk_ids(self):
+        return {name: os.stat(os.path.join(self.spool, name)).st_mtime_ns
+                for name in os.listdir(self.spool) if name.isdigit()}
+
+    def test_resume(self):
+        # Interrupt the send partway thru the third chunk.
+        os.environ['FAKE_SEND_DIE_AFTER'] = str(2 * CHUNK + CHUNK // 2)
+        with self.assertRaises(SystemExit):
+            self.copy()
+        first = self.chunk_ids()
+        self.assertEqual(sorted(first), ['000000', '000001'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'to', '@vol',
+                                                     SNAP)))
+
+        # Finish the send, but interrupt the receive.
+        del os.environ['FAKE_SEND_DIE_AFTER']
+        os.environ['FAKE_RECEIVE_FAIL'] = '1'
+        with self.assertRaises(SystemExit):
+            self.copy()
+        second = self.chunk_ids()
+        self.assertEqual(len(second), 6)
+        for name, mtime in first.items():  # Finished chunks weren't redone.
+            self.assertEqual(second[name], mtime)
+        self.assertEqual(self.sends(), 2)
+
+        # Receive without sending again.
+        del os.environ['FAKE_RECEIVE_FAIL']
+        self.copy()
+        self.assertEqual(self.sends(), 2)
+        self.assertFalse(os.path.exists(self.spool))
+        with open(os.path.join(self.tmp, 'to', '@vol', SNAP, 'stream'),
+                  'rb') as f:
+            got = f.read()
+        size = 5 * CHUNK + 1234
+        seed = '%s %d' % (os.path.join(self.tmp, 'from', '@vol', SNAP), size)
+        self.assertEqual(got, SNAP.encode() + b'\n' +
+                         random.Random(seed).randbytes(size))
+
+    def test_changed_stream_respools(self):
+        os.environ['FAKE_SEND_DIE_AFTER'] = str(2 * CHUNK + CHUNK // 2)
+        with self.assertRaises(SystemExit):
+            self.copy()
+        # A different stream for the same snapshot must not be mixed
+        # with the old chunks.
+        del os.environ['FAKE_SEND_DIE_AFTER']
+        os.environ['FAKE_SEND_SIZE'] = str(3 * CHUNK)
+        self.copy()
+        self.assertEqual(self.sends(), 3)
+        with open(os.path.join(self.tmp, 'to', '@vol', SNAP, 'stream'),
+                  'rb') as f:
+            self.assertEqual(len(f.read()), len(SNAP) + 1 + 3 * CHUNK)
+
+
+if __name__ == '__main__':
+    unittest.main()
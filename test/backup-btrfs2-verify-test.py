@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+## backup-btrfs2-verify-test.py
+# Test that bb2.py's verify_copy() checks a copy's file tree against
+# its source's as recorded when it was received, using plain
+# directories as snapshots and a fake btrfs that reports a UUID for
+# each and a received UUID from a hidden file beside it.
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+# Assumes this is in "test" which is a sibling of "backup"
+BB2_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'backup', 'bb2.py')
+
+FAKE_BTRFS = r'''#!/bin/sh
+if [ "$1" = subvolume ] && [ "$2" = show ]; then
+    dir=$(dirname "$3"); name=$(basename "$3")
+    printf '%s\n\tUUID: \t\tuuid-%s\n' "$name" "$name"
+    printf '\tReceived UUID: \t%s\n' \
+        "$(cat "$dir/.$name.received" 2>/dev/null || echo -)"
+fi
+exit 0
+'''
+# Runs its arguments as the current user.
+FAKE_SUDO = '#!/bin/sh\nexec "$@"\n'
+
+SNAP = '2016-04-18T01:24:20+00:00'
+
+
+def load_bb2():
+    spec = importlib.util.spec_from_file_location('bb2', BB2_PATH)
+    bb2 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bb2)
+    return bb2
+
+
+class VerifyCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='bb2-verify-test.')
+        bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(bin)
+        for name, text in (('btrfs', FAKE_BTRFS), ('sudo', FAKE_SUDO)):
+            with open(os.path.join(bin, name), 'w') as f:
+                f.write(text)
+            os.chmod(os.path.join(bin, name), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin + os.pathsep + self.path
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        snap = os.path.join(self.src, '@a', SNAP)
+        os.makedirs(os.path.join(snap, 'dir'))
+        with open(os.path.join(snap, 'dir', 'file'), 'w') as f:
+            f.write('data')
+        os.symlink('dir/file', os.path.join(snap, 'link'))
+        self.copy = os.path.join(self.dst, '@a', SNAP)
+        shutil.copytree(snap, self.copy, symlinks=True)
+        with open(os.path.join(self.dst, '@a', '.%s.received' % SNAP),
+                  'w') as f:
+            f.write('uuid-' + SNAP)
+        self.bb2 = load_bb2()
+        self.bb2.VERBOSITY = -1
+        self.bb2.STATE_DIR = os.path.join(self.tmp, 'state')
+        self.bb2.record_copy(self.src, self.dst, '@a', SNAP)
+
+    def tearDown(self):
+        self.bb2.stop_helper()
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp)
+
+    def test_matches(self):
+        self.assertTrue(self.bb2.verify_copy(self.dst, '@a'))
+        shutil.rmtree(self.src)  # The recorded digest is used from now on.
+        self.assertTrue(self.bb2.verify_copy(self.dst, '@a'))
+
+    def test_changed(self):
+        self.assertTrue(self.bb2.verify_copy(self.dst, '@a'))
+        path = os.path.join(self.copy, 'dir', 'file')
+        times = os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns
+        with open(path, 'w') as f:
+            f.write('date')
+        os.utime(path, ns=times)
+        self.assertFalse(self.bb2.verify_copy(self.dst, '@a'))
+
+    def test_source_gone(self):
+        shutil.rmtree(self.src)
+        self.assertIsNone(self.bb2.verify_copy(self.dst, '@a'))
+
+
+if __name__ == '__main__':
+    unittest.main()